@@ -0,0 +1,118 @@
+import click
+
+from isitfit.cli.click_descendents import IsitfitCommand, isitfit_group, IsitfitCliError, isitfit_option_profile
+from isitfit.cost.cacheStats import NAMESPACE_PREFIX
+
+
+@isitfit_group(help="Cache utilities (redis or local cache)", invoke_without_command=False, hidden=False)
+@click.pass_context
+def cache(ctx):
+  # FIXME click bug: `isitfit command subcommand --help` is calling the code in here. Workaround is to check --help and skip the whole section
+  import sys
+  if '--help' in sys.argv: return
+
+  # usage stats
+  from isitfit.utils import ping_matomo
+  ping_matomo("/cache")
+
+
+def get_cacheMan():
+  """
+  Connect to the cache, for the subcommands that read or write it (i.e. not `stats` which only reads the stats file)
+  """
+  from isitfit.cost.cacheManager import RedisPandas as RedisPandasCacheManager
+  cache_man = RedisPandasCacheManager()
+  cache_man.connect_auto()
+  if not cache_man.isReady():
+    raise IsitfitCliError("No cache configured. Set ISITFIT_REDIS_HOST, ISITFIT_REDIS_PORT, and ISITFIT_REDIS_DB, or unset ISITFIT_CACHE_LOCAL=0")
+
+  return cache_man
+
+
+@cache.command(help="Show the cache hits/misses/latency of the latest isitfit run", cls=IsitfitCommand)
+def stats():
+  from isitfit.utils import ping_matomo
+  ping_matomo("/cache/stats")
+
+  from isitfit.cost.cacheStats import load_stats, stats2table, latency2table
+  stats_d = load_stats()
+  if stats_d is None:
+    click.echo("No cache stats found. They are saved at the end of `isitfit cost analyze` and `isitfit cost optimize`")
+    return
+
+  import datetime as dt
+  click.echo("Cache usage of the latest run, at %s:"%dt.datetime.fromtimestamp(stats_d['dt_saved']).strftime("%Y-%m-%d %H:%M:%S"))
+  click.echo("")
+  click.echo(stats2table(stats_d))
+  click.echo("")
+  click.echo("Latency histograms:")
+  click.echo("")
+  click.echo(latency2table(stats_d))
+
+
+@cache.command(help="List the cached keys with their sizes", cls=IsitfitCommand)
+@click.option('--namespace', default=None, type=click.Choice(list(NAMESPACE_PREFIX.keys())), help='Only list the keys of this namespace')
+def ls(namespace):
+  from isitfit.utils import ping_matomo
+  ping_matomo("/cache/ls")
+
+  from isitfit.cost.cacheSerializer import CODEC_NAMES
+  from isitfit.cost.cacheStats import key2namespace
+  tab = []
+  for key, header in sorted(get_cacheMan().scan(namespace)):
+    tab.append([key2namespace(key), key, CODEC_NAMES.get(header['codec'], header['codec']), header['size_raw'], header['size_stored']])
+
+  if len(tab)==0:
+    click.echo("No keys found in cache")
+    return
+
+  from tabulate import tabulate
+  click.echo(tabulate(tab, headers=['Namespace', 'Key', 'Codec', 'Bytes (uncompressed)', 'Bytes (stored)']))
+  click.echo("")
+
+  # totals, for sizing redis memory
+  size_raw, size_stored = sum([x[3] for x in tab]), sum([x[4] for x in tab])
+  click.echo("Total: %i keys, %i bytes stored, compression ratio %.1f"%(len(tab), size_stored, size_raw/max(size_stored, 1)))
+
+
+@cache.command(help="Delete the cached keys", cls=IsitfitCommand)
+@click.option('--namespace', default=None, type=click.Choice(list(NAMESPACE_PREFIX.keys())), help='Only delete the keys of this namespace (default: all)')
+def purge(namespace):
+  from isitfit.utils import ping_matomo
+  ping_matomo("/cache/purge?namespace=%s"%namespace)
+
+  n_deleted = get_cacheMan().purge(namespace)
+  click.echo("Deleted %i keys from cache"%n_deleted)
+
+
+@cache.command(help="Fill the metrics and cloudtrail caches ahead of `isitfit cost analyze/optimize`, eg from a cron job", cls=IsitfitCommand)
+@isitfit_option_profile()
+@click.option('--ndays', default=90, type=click.IntRange(1, 90), help='number of days to fill (the cache is shared by any smaller --ndays)')
+@click.option('--filter-region', default=None, help='specify a single region to warm up')
+@click.option('--workers', default=4, type=click.IntRange(1, 64), help='number of concurrent fetches')
+@click.option('--rate', default=10., type=click.FloatRange(0, None), help='max number of API calls per second (0 for no limit)')
+@click.option('--restart', is_flag=True, help='Ignore the checkpoint of an interrupted run and start from scratch')
+@click.pass_context
+def warm(ctx, profile, ndays, filter_region, workers, rate, restart):
+  from isitfit.utils import ping_matomo, TokenBucket
+  ping_matomo("/cache/warm?ndays=%i"%ndays)
+
+  cache_man = get_cacheMan()
+
+  from isitfit.cost.cacheWarm import WarmCheckpoint, CacheWarmer
+  checkpoint = WarmCheckpoint(profile, ndays)
+  if not restart:
+    checkpoint.load()
+
+  # the same inventory snapshot is shared by both iterators
+  from isitfit.cost.inventory import InventorySnapshot
+  from isitfit.cost.ec2_analyze import Ec2Iterator
+  from isitfit.cost.redshift_common import RedshiftPerformanceIterator
+  from isitfit.tqdmman import TqdmL2Verbose
+  tqdmman = TqdmL2Verbose(ctx)
+  inventory = InventorySnapshot()
+  ec2_it = Ec2Iterator(filter_region, tqdmman, inventory)
+  redshift_it = RedshiftPerformanceIterator(filter_region, tqdmman, inventory)
+
+  warmer = CacheWarmer(cache_man, ndays, workers, TokenBucket(rate), checkpoint)
+  warmer.warm(ec2_it, redshift_it, tqdmman)
@@ -134,6 +134,7 @@ from .version import version as cli_version
 from isitfit.migrations.cli import migrations as cli_migrations
 from .issue10 import issue10 as cli_issue10
 from .datadog import datadog as cli_datadog
+from .cache import cache as cli_cache
 
 cli_core.add_command(cli_version)
 cli_core.add_command(cli_cost)
@@ -141,6 +142,7 @@ cli_core.add_command(cli_tags)
 cli_core.add_command(cli_migrations)
 cli_core.add_command(cli_issue10)
 cli_core.add_command(cli_datadog)
+cli_core.add_command(cli_cache)
 
 
 #-----------------------
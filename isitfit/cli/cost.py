@@ -20,8 +20,9 @@ from isitfit.utils import ping_matomo
   help='number of days to look back in the data history',
   type=click.IntRange(1, 90)
 )
+@click.option('--workers', default=1, type=click.IntRange(1, 64), help='number of resources to process concurrently (fetching metrics etc)')
 @click.pass_context
-def cost(ctx, filter_region, ndays, profile):
+def cost(ctx, filter_region, ndays, profile, workers):
   # FIXME click bug: `isitfit command subcommand --help` is calling the code in here. Workaround is to check --help and skip the whole section
   import sys
   if '--help' in sys.argv: return
@@ -32,6 +33,11 @@ def cost(ctx, filter_region, ndays, profile):
   # save to click context
   ctx.obj['ndays'] = ndays
   ctx.obj['filter_region'] = filter_region
+  ctx.obj['workers'] = workers
+
+  # snapshot of the AWS resources, listed once and shared by the ec2 and redshift pipelines
+  from isitfit.cost.inventory import InventorySnapshot
+  ctx.obj['inventory'] = InventorySnapshot()
 
   pass
 
@@ -69,6 +75,10 @@ def analyze(ctx, filter_tags, save_details):
     # Run pipeline
     mm_all.get_ifi(tqdml2)
 
+    # Update 2020-02 cache stats of both pipelines
+    from isitfit.cost.cacheStats import report_cacheStats
+    report_cacheStats()
+
 
 
 @cost.command(help='Generate recommendations of optimal EC2 sizes', cls=IsitfitCommand)
@@ -100,3 +110,7 @@ def optimize(ctx, n, filter_tags, allow_ec2_different_family):
 
     # Run pipeline
     mm_all.get_ifi(tqdml2)
+
+    # Update 2020-02 cache stats of both pipelines
+    from isitfit.cost.cacheStats import report_cacheStats
+    report_cacheStats()
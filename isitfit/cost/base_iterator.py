@@ -30,9 +30,9 @@ class SimpleCacheMan:
     k2 = self.key_with_namespace(key)
     return simple_cache.load_key(filename=self.filename, key=k2)
 
-  def save_key(self, key, value):
+  def save_key(self, key, value, ttl=SECONDS_PER_HOUR):
     k2 = self.key_with_namespace(key)
-    simple_cache.save_key(filename=self.filename, key=k2, value=value, ttl=SECONDS_PER_HOUR)
+    simple_cache.save_key(filename=self.filename, key=k2, value=value, ttl=ttl)
 
 
 class BaseIterator:
@@ -50,13 +50,30 @@ class BaseIterator:
   entry_keyId = None
   entry_keyCreated = None
 
+  # jmespath expressions of fields of the describe entry that are tracked for changes by the inventory cache, eg State.Name
+  entry_keysTracked = []
 
-  def __init__(self, filter_region=None, tqdmman=None):
+  # maximum number of regions described concurrently in iterate_core
+  region_max_workers = 10
+
+
+  def __init__(self, filter_region=None, tqdmman=None, inventory=None):
+    """
+    inventory - isitfit.cost.inventory.InventorySnapshot, eg shared between the ec2 and redshift iterators.
+                If None, a new snapshot is created for this iterator.
+    """
     # some defaults
     if tqdmman is None:
       from tqdm import tqdm
       tqdmman = tqdm
 
+    if inventory is None:
+      from isitfit.cost.inventory import InventorySnapshot
+      inventory = InventorySnapshot()
+
+    # snapshot of the describe entries, filled in the first iteration and replayed from memory afterwards
+    self.inventory = inventory
+
     # filter for certain region
     self.filter_region = filter_region
 
@@ -78,6 +95,7 @@ class BaseIterator:
 
     # init cache
     self._initCache()
+    self._initInventoryCache()
 
     # count of entries
     self.n_entry = None
@@ -134,6 +152,117 @@ class BaseIterator:
 
 
 
+  def _initInventoryCache(self):
+    """
+    On-disk cache of the describe entries, per profile, service, and region
+    """
+    import boto3
+    profile_name = boto3.session.Session().profile_name
+
+    from isitfit.cost.inventory import InventoryCache
+    self.inventoryCache = InventoryCache(profile_name, self.service_name, self.entry_keyId, self.entry_keysTracked)
+
+
+  def _regionIsScanned(self, region_name):
+    """
+    Check if a region should be described in iterate_core,
+    i.e. it was not skipped in a previous count (empty or inaccessible region)
+    """
+    if self.regionInclude_ready and self.filter_region is None:
+      if region_name not in self.region_include:
+        return False
+
+    return True
+
+
+  def _describe_region(self, region_name):
+    """
+    Describe all the service resources in a single region, eg ec2 instances, redshift clusters.
+    This runs in a worker thread of iterate_core, so it uses its own boto3 session
+    instead of the process-global default session (boto3.setup_default_session is not thread-safe).
+
+    Returns a tuple (entries, error)
+    - entries: list of describe entries, each with an additional "Region" field
+    - error: botocore ClientError raised during the pagination, or None
+    """
+    logger.debug("Region %s"%region_name)
+
+    import boto3
+    import botocore
+    import jmespath
+    session = boto3.session.Session(region_name = region_name)
+
+    # boto3 clients
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/redshift.html#Redshift.Client.describe_logging_status
+    # Update 2019-12-09
+    #   Unfolding the iterator can cause a rate limiting error for accounts with more than 200 EC2
+    #   as reported by u/moofishies on 2019-11-12
+    #   Similar to: https://github.com/boto/botocore/pull/891#issuecomment-303526763
+    #   The max_attempts config here is increased from the default 4 to decrease the rate limiting chances
+    #   https://github.com/boto/botocore/pull/1260
+    #   Note that with each extra retry, an exponential backoff is already implemented inside botocore
+    #   More: https://botocore.amazonaws.com/v1/documentation/api/latest/reference/config.html
+    from botocore.config import Config
+    service_client = session.client(self.service_name, config=Config(retries={'max_attempts': 10}))
+
+    # iterate on service resources, eg ec2 instances, redshift clusters
+    paginator = service_client.get_paginator(self.paginator_name)
+    rc_iterator = paginator.paginate()
+    rc_describe_all = []
+    try:
+      for rc_describe_page in rc_iterator:
+        rc_describe_entries = jmespath.search(self.paginator_entryJmespath, rc_describe_page)
+        for rc_describe_entry in rc_describe_entries:
+          # add field for region
+          rc_describe_entry['Region'] = region_name
+          rc_describe_all.append(rc_describe_entry)
+
+    except botocore.exceptions.ClientError as e:
+      # do not raise from the worker thread. Let iterate_core decide what to do with it
+      return rc_describe_all, e
+
+    return rc_describe_all, None
+
+
+  def _handle_regionError(self, e):
+    """
+    Filter the ClientError returned by _describe_region.
+    Errors that mean "no access to region" are swallowed (after which iterate_core proceeds to the next region),
+    all other errors are raised.
+    """
+    # Exception that means "no access to region"
+    if e.response['Error']['Code']==self.paginator_exception:
+      return
+
+    # eg if user doesnt have access arn:aws:redshift:ap-northeast-1:974668457921:cluster:*
+    # it could be because of specific access to region, or general access to the full redshift service
+    # Note: capturing this exception means that the region is no longer included in the iterator, but it will still iterate over other regions
+    if e.response['Error']['Code']=='AccessDenied':
+      self.region_accessdenied.append(e)
+      return
+
+    # Handle error:
+    # botocore.exceptions.ClientError: An error occurred (InvalidClientTokenId) when calling the AssumeRole operation: The security token included in the request is invalid.
+    # Not sure what this means, but maybe that a role is not allowed to assume into a region?
+    # This error can be raised for example with using my local AWS profile "afc_external_readCur".
+    # Here is an excerpt from my ~/.aws/credentials file
+    # # Role created in Autofitcloud giving access to shadiakiki1986 to read CUR S3
+    # [afc_external_readCur]
+    # role_arn = arn:aws:iam::123456789:role/external-read-athena-role-ExternalReadCURRole-abcdef
+    # source_profile = a_user_profile_not_a_role
+    # region = us-east-1
+    if e.response['Error']['Code']=='InvalidClientTokenId':
+      return
+
+    # after setting up the InvalidClientTokenId filter above on the profile afc_external_readCur,
+    # faced error: botocore.exceptions.ClientError: An error occurred (UnauthorizedOperation) when calling the DescribeInstances operation: You are not authorized to perform this operation.
+    if e.response['Error']['Code']=='UnauthorizedOperation':
+      return
+
+    # all other exceptions raised
+    raise e
+
+
   def iterate_core(self, display_tqdm=False):
     fx_l = ['service_name', 'service_description', 'paginator_name', 'paginator_entryJmespath', 'paginator_exception', 'entry_keyId', 'entry_keyCreated']
     for fx_i in fx_l:
@@ -142,9 +271,7 @@ class BaseIterator:
         raise Exception("Derived class should set %s"%fx_i)
 
     # iterate on regions
-    import botocore
     import boto3
-    import jmespath
     redshift_regions_full = boto3.Session().get_available_regions(self.service_name)
     import copy
     redshift_regions_sub = copy.deepcopy(redshift_regions_full)
@@ -176,84 +303,58 @@ class BaseIterator:
       desc = "%-50s"%desc
       region_iterator = self.tqdmman(region_iterator, total = len(redshift_regions_sub), desc=desc)
 
-
-    for region_name in region_iterator:
-      if self.regionInclude_ready and self.filter_region is None:
-        if region_name not in self.region_include:
+    # Update 2020-02 load the regions from the on-disk inventory cache if not expired
+    for region_name in redshift_regions_sub:
+      if self._regionIsScanned(region_name) and not self.inventory.has_region(self.service_name, region_name):
+        rc_cached = self.inventoryCache.load(region_name)
+        if rc_cached is not None:
+          self.inventory.set_region(self.service_name, region_name, rc_cached)
+
+    # regions to actually describe, i.e. excluding those that were found empty or inaccessible in a previous count,
+    # as well as those already in the inventory snapshot (replayed from memory below)
+    region_scan = [r for r in redshift_regions_sub if self._regionIsScanned(r) and not self.inventory.has_region(self.service_name, r)]
+
+    # Update 2020-02 Describe the regions concurrently, each in a worker thread with its own boto3 session.
+    # Previously, regions were iterated one after the other with boto3.setup_default_session,
+    # which took minutes on accounts with 20+ regions.
+    # Note that executor.map yields the results in the same order as region_scan,
+    # so the entries are still yielded in a deterministic order (region by region)
+    from concurrent.futures import ThreadPoolExecutor
+    n_workers = max(1, min(self.region_max_workers, len(region_scan)))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+      region_results = executor.map(self._describe_region, region_scan)
+
+      for region_name in region_iterator:
+        if not self._regionIsScanned(region_name):
           # skip since already failed to use it
           continue
 
-      logger.debug("Region %s"%region_name)
-      boto3.setup_default_session(region_name = region_name)
-
-      # boto3 clients
-      # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/redshift.html#Redshift.Client.describe_logging_status
-      # Update 2019-12-09
-      #   Unfolding the iterator can cause a rate limiting error for accounts with more than 200 EC2
-      #   as reported by u/moofishies on 2019-11-12
-      #   Similar to: https://github.com/boto/botocore/pull/891#issuecomment-303526763
-      #   The max_attempts config here is increased from the default 4 to decrease the rate limiting chances
-      #   https://github.com/boto/botocore/pull/1260
-      #   Note that with each extra retry, an exponential backoff is already implemented inside botocore
-      #   More: https://botocore.amazonaws.com/v1/documentation/api/latest/reference/config.html
-      from botocore.config import Config
-      service_client = boto3.client(self.service_name, config=Config(retries={'max_attempts': 10}))
-
-      # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudwatch.html#metric
-      self.cloudwatch_resource = boto3.resource('cloudwatch')
-
-      # iterate on service resources, eg ec2 instances, redshift clusters
-      paginator = service_client.get_paginator(self.paginator_name)
-      rc_iterator = paginator.paginate()
-      try:
-        region_anyClusterFound = False
-        for rc_describe_page in rc_iterator:
-          rc_describe_entries = jmespath.search(self.paginator_entryJmespath, rc_describe_page)
-          for rc_describe_entry in rc_describe_entries:
-            region_anyClusterFound = True
-            # add field for region
-            rc_describe_entry['Region'] = region_name
-            # yield
-            yield rc_describe_entry
+        region_error = None
+        if self.inventory.has_region(self.service_name, region_name):
+          # Update 2020-02 replay from the inventory snapshot if this region was already described in this run (or loaded from the inventory cache)
+          rc_describe_entries = self.inventory.get_region(self.service_name, region_name)
+        else:
+          # blocks until the results of this region are ready
+          rc_describe_entries, region_error = next(region_results)
+
+          # a region with an error is not snapshotted, so that it is described again (and the error handled again) on replay,
+          # instead of serving its partial list as complete
+          if region_error is None:
+            self.inventory.set_region(self.service_name, region_name, rc_describe_entries)
+            self.inventoryCache.save(region_name, rc_describe_entries)
+
+        for rc_describe_entry in rc_describe_entries:
+          yield rc_describe_entry
+
+        if region_error is not None:
+          self._handle_regionError(region_error)
+          continue
 
         if not self.regionInclude_ready and self.filter_region is None:
-          if region_anyClusterFound:
+          if len(rc_describe_entries)>0 and region_name not in self.region_include:
             # only include if found clusters in this region
             self.region_include.append(region_name)
 
-      except botocore.exceptions.ClientError as e:
-        # Exception that means "no access to region"
-        if e.response['Error']['Code']==self.paginator_exception:
-          continue
-
-        # eg if user doesnt have access arn:aws:redshift:ap-northeast-1:974668457921:cluster:*
-        # it could be because of specific access to region, or general access to the full redshift service
-        # Note: capturing this exception means that the region is no longer included in the iterator, but it will still iterate over other regions
-        if e.response['Error']['Code']=='AccessDenied':
-          self.region_accessdenied.append(e)
-          continue
-
-        # Handle error:
-        # botocore.exceptions.ClientError: An error occurred (InvalidClientTokenId) when calling the AssumeRole operation: The security token included in the request is invalid.
-        # Not sure what this means, but maybe that a role is not allowed to assume into a region?
-        # This error can be raised for example with using my local AWS profile "afc_external_readCur".
-        # Here is an excerpt from my ~/.aws/credentials file
-        # # Role created in Autofitcloud giving access to shadiakiki1986 to read CUR S3
-        # [afc_external_readCur]
-        # role_arn = arn:aws:iam::123456789:role/external-read-athena-role-ExternalReadCURRole-abcdef
-        # source_profile = a_user_profile_not_a_role
-        # region = us-east-1
-        if e.response['Error']['Code']=='InvalidClientTokenId':
-          continue
-
-        # after setting up the InvalidClientTokenId filter above on the profile afc_external_readCur,
-        # faced error: botocore.exceptions.ClientError: An error occurred (UnauthorizedOperation) when calling the DescribeInstances operation: You are not authorized to perform this operation.
-        if e.response['Error']['Code']=='UnauthorizedOperation':
-          continue
-
-        # all other exceptions raised
-        raise e
-
     # before exiting, check if a count just completed, and mark region_include as usable
     if not self.regionInclude_ready and self.filter_region is None:
       self.regionInclude_ready = True
@@ -0,0 +1,152 @@
+"""
+Embedded cache backend for RedisPandas when redis is not configured
+
+Update 2020-02 Implements the subset of the redis.Redis client used by RedisPandas (get, set with expiration, mget, pipeline, delete, scan_iter, getrange)
+on top of a sqlite file in the isitfit temporary directory.
+The WAL journal mode and the busy timeout allow several isitfit processes to use the same file concurrently,
+eg parallel CI jobs or a `cost analyze` while a cron job is running.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from isitfit.utils import logger
+
+
+# name of the sqlite file in DotMan().tempdir()
+LOCAL_FILENAME = 'cache.sqlite'
+
+# seconds to wait for a lock held by another process before failing
+LOCAL_BUSY_TIMEOUT = 30
+
+# max number of sql parameters per query, below the sqlite default limit of 999
+LOCAL_MAX_PARAMS = 500
+
+
+class LocalPipeline:
+  """
+  Same as redis.client.Pipeline, i.e. queue the commands and run them at once in execute
+  (in a single sqlite transaction)
+  """
+  def __init__(self, client):
+    self.client = client
+    self.commands = []
+
+  def set(self, name, value, ex=None):
+    self.commands.append(('set', (name, value, ex)))
+    return self
+
+  def mget(self, keys):
+    self.commands.append(('mget', (keys,)))
+    return self
+
+  def delete(self, *names):
+    self.commands.append(('delete', names))
+    return self
+
+  def execute(self):
+    with self.client.lock:
+      with self.client.conn:
+        out = [getattr(self.client, '_%s'%cmd)(*args) for cmd, args in self.commands]
+
+    self.commands = []
+    return out
+
+
+class LocalRedis:
+  """
+  Key-value store in sqlite with expiration, mimicking the redis.Redis client
+  """
+  def __init__(self, filename=None):
+    if filename is None:
+      from isitfit.dotMan import DotMan
+      filename = os.path.join(DotMan().tempdir(), LOCAL_FILENAME)
+
+    self.filename = filename
+
+    # single connection shared by the mainManager worker threads, serialized with a lock
+    self.lock = threading.Lock()
+    self.conn = sqlite3.connect(filename, timeout=LOCAL_BUSY_TIMEOUT, check_same_thread=False)
+    with self.lock:
+      self.conn.execute("PRAGMA journal_mode=WAL")
+      with self.conn:
+        self.conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)")
+
+        # drop the expired keys
+        self.conn.execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(), ))
+
+    logger.debug("Local cache at %s"%filename)
+
+
+  # core functions, called with the lock held
+  def _set(self, name, value, ex=None):
+    expires_at = None if ex is None else time.time() + ex
+    self.conn.execute("INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)", (name, bytes(value), expires_at))
+    return True
+
+  def _mget(self, keys):
+    keys = list(keys)
+    found = {}
+    dt_now = time.time()
+    for i_start in range(0, len(keys), LOCAL_MAX_PARAMS):
+      k_batch = keys[i_start:(i_start+LOCAL_MAX_PARAMS)]
+      sql = "SELECT key, value FROM kv WHERE key IN (%s) AND (expires_at IS NULL OR expires_at > ?)"%(",".join(["?"]*len(k_batch)))
+      found.update(self.conn.execute(sql, k_batch + [dt_now]).fetchall())
+
+    return [found.get(k, None) for k in keys]
+
+  def _delete(self, *names):
+    n_deleted = 0
+    for name in names:
+      n_deleted += self.conn.execute("DELETE FROM kv WHERE key = ?", (name, )).rowcount
+
+    return n_deleted
+
+
+  # public functions, same signatures as redis.Redis
+  def set(self, name, value, ex=None):
+    with self.lock:
+      with self.conn:
+        return self._set(name, value, ex)
+
+  def get(self, name):
+    return self.mget([name])[0]
+
+  def mget(self, keys):
+    with self.lock:
+      return self._mget(keys)
+
+  def delete(self, *names):
+    with self.lock:
+      with self.conn:
+        return self._delete(*names)
+
+  def pipeline(self, transaction=True):
+    return LocalPipeline(self)
+
+  def scan_iter(self, match=None, count=None):
+    """
+    Keys matching a glob-style pattern, eg "v2:cloudwatch:*". Same syntax in sqlite GLOB as in redis SCAN MATCH
+    """
+    sql = "SELECT key FROM kv WHERE (expires_at IS NULL OR expires_at > ?)"
+    params = [time.time()]
+    if match is not None:
+      sql += " AND key GLOB ?"
+      params.append(match)
+
+    with self.lock:
+      key_l = [row[0] for row in self.conn.execute(sql, params).fetchall()]
+
+    return iter(key_l)
+
+  def getrange(self, key, start, end):
+    """
+    Bytes of a value from start to end (both inclusive), eg to read the header without the payload
+    """
+    sql = "SELECT substr(value, ?, ?) FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)"
+    with self.lock:
+      row = self.conn.execute(sql, (start+1, end-start+1, key, time.time())).fetchone()
+
+    return b'' if row is None else bytes(row[0])
@@ -11,10 +11,31 @@ class RedisPandas:
   Python class that manages caching pandas dataframes to redis
   https://stackoverflow.com/a/57986261/4126114
   """
+  # number of keys per MGET command in mget
+  mget_batchSize = 500
+
+  # number of buffered writes that triggers a flush through a pipeline
+  write_batchSize = 100
+
   def __init__(self):
     self.redis_args = {}
     self.redis_client = None
-    self.pyarrow_context = None
+
+    # Update 2020-02 writes are buffered and sent in batches through a redis pipeline, check flush
+    # dict: versioned key -> (serialized value, expiration in seconds)
+    self.write_buffer = {}
+
+    # set is called from the worker threads of the mainManager
+    import threading
+    self.lock = threading.Lock()
+
+    # Update 2020-02 in-process cache of the deserialized values, shared by all the RedisPandas instances. None if disabled
+    from isitfit.cost.cacheMemory import get_memoryLRU
+    self.memory = get_memoryLRU()
+
+    # Update 2020-02 counters of hits/misses/bytes/latency, shared by all the RedisPandas instances
+    from isitfit.cost.cacheStats import get_cacheStats
+    self.stats = get_cacheStats()
 
   def fetch_envvars(self):
     # check redis parameters if set for caching
@@ -32,38 +53,103 @@ class RedisPandas:
   def connect(self):
     logger.info("Connecting to redis cache")
     logger.debug(self.redis_args)
-    import pyarrow as pa
 
     self.redis_client = redis.Redis(**self.redis_args)
-    self.pyarrow_context = pa.default_serialization_context()
+
+  def connect_local(self):
+    """
+    Update 2020-02 Use the embedded sqlite cache, which has the same interface as the redis client
+    """
+    from isitfit.cost.cacheLocal import LocalRedis
+    self.redis_client = LocalRedis()
+    logger.info("Using local cache at %s. To use redis instead, set ISITFIT_REDIS_HOST, ISITFIT_REDIS_PORT, and ISITFIT_REDIS_DB"%self.redis_client.filename)
+
+  def connect_auto(self):
+    """
+    Update 2020-02 Connect to redis if configured, otherwise to the local cache unless disabled with ISITFIT_CACHE_LOCAL=0
+    Returns True if redis is configured
+    """
+    self.fetch_envvars()
+    if self.isSetup():
+      self.connect()
+      return True
+
+    import os
+    if os.getenv("ISITFIT_CACHE_LOCAL", "1") != "0":
+      self.connect_local()
+
+    return False
 
   def isReady(self):
     return self.redis_client is not None
 
-  def set(self, key, df):
+  def set(self, key, df, ex=None):
+    import time
+    dt_start = time.time()
+
     # Note that in case data was not found, eg in mainManager._cloudwatch_metrics_core, an empty dataframe is returned (and thus passed in here)
-    pybytes = self.pyarrow_context.serialize(df).to_buffer().to_pybytes()
+    # Update 2020-02 use the versioned serialization instead of the deprecated pyarrow.default_serialization_context
+    from isitfit.cost.cacheSerializer import serialize, versioned_key
+    pybytes = serialize(df)
 
     # if dataframe with shape[0]==0, raise (no longer supported)
     # Update 2019-12-17 Actually Cloudtrail needs to store an empty dataframe if there are no events in the last 90 days
     if not callable(df):
       from isitfit.cli.click_descendents import IsitfitCliError
 
-      if type(df) != pd.DataFrame:
-        raise IsitfitCliError("Internal dev error: Only caching of callables or pandas dataframes supported as of isitfit 0.19")
+      # Update 2020-02 dicts are the cloudtrail histories of EventAggregatorCached
+      if type(df) not in [pd.DataFrame, dict]:
+        raise IsitfitCliError("Internal dev error: Only caching of callables, pandas dataframes, or dicts supported")
 
       # Check comment above about Cloudtrail needing to store empty dataframes
       #if df.shape[0]==0:
       #  raise IsitfitCliError("Internal dev error: caching empty dataframes is no longer supported as of isitfit 0.19")
 
     # set expiration of key-value pair to be 1 day if data was found, 10 minutes otherwise
-    ex = SECONDS_IN_10MINS if callable(df) else SECONDS_IN_ONE_DAY
-    # https://redis-py.readthedocs.io/en/latest/#redis.Redis.set
-    self.redis_client.set(name=key, value=pybytes, ex=ex)
+    # Update 2020-02 unless an explicit expiration is passed, eg the per-day metrics in MetricCacheMixin
+    if ex is None:
+      ex = SECONDS_IN_10MINS if callable(df) else SECONDS_IN_ONE_DAY
 
-  def get(self, key):
+    if self.memory is not None:
+      from isitfit.cost.cacheMemory import value_nbytes
+      self.memory.set(versioned_key(key), df, value_nbytes(df, pybytes), ex)
+
+    # buffer the write, and flush if the buffer is full
+    with self.lock:
+      self.write_buffer[versioned_key(key)] = (pybytes, ex)
+      do_flush = len(self.write_buffer) >= self.write_batchSize
+
+    if do_flush:
+      self.flush()
+
+    self.stats.record_set(key, len(pybytes))
+    self.stats.record_latency(key, 'set', time.time() - dt_start)
+
+  def flush(self):
+    """
+    Send the buffered writes in a single round trip through a redis pipeline
+    """
+    with self.lock:
+      buffer_l, self.write_buffer = self.write_buffer, {}
+
+    if len(buffer_l)==0:
+      return
+
+    logger.debug("Writing %i keys to redis cache"%len(buffer_l))
+    # https://redis-py.readthedocs.io/en/latest/#redis.Redis.pipeline
+    pipe = self.redis_client.pipeline(transaction=False)
+    for k, (v, ex) in buffer_l.items():
+      # https://redis-py.readthedocs.io/en/latest/#redis.Redis.set
+      pipe.set(name=k, value=v, ex=ex)
+
+    self._execute(pipe.execute)
+
+  def _execute(self, fx, *args):
+    """
+    Call a redis client function, converting errors to IsitfitCliError
+    """
     try:
-      v1 = self.redis_client.get(key)
+      return fx(*args)
     except redis.exceptions.ResponseError as e:
       msg = 'Redis error: {e.__class__.__module__}.{e.__class__.__name__}: {e}'.format(e=e)
       # eg, 'redis.exceptions.ResponseError: invalid DB index'
@@ -75,53 +161,143 @@ class RedisPandas:
       from isitfit.cli.click_descendents import IsitfitCliError
       raise IsitfitCliError(msg)
 
+  def _get_buffered(self, vkey):
+    # read the buffered writes that were not flushed yet
+    with self.lock:
+      v1 = self.write_buffer.get(vkey, None)
+
+    return v1[0] if v1 is not None else None
+
+  def _get_memory(self, vkey):
+    if self.memory is None:
+      return None
+
+    return self.memory.get(vkey)
+
+  def _set_memory(self, vkey, v1, v2):
+    """
+    Keep a value read from redis in the in-process cache.
+    The expiration of the key in redis is not fetched, so use the shortest one of RedisPandas.set
+    """
+    if self.memory is None or v2 is None:
+      return
+
+    from isitfit.cost.cacheMemory import value_nbytes
+    self.memory.set(vkey, v2, value_nbytes(v2, v1), SECONDS_IN_10MINS)
+
+  def get(self, key):
+    from isitfit.cost.cacheSerializer import deserialize, versioned_key
+    vkey = versioned_key(key)
+    v2 = self._get_memory(vkey)
+    if v2 is not None:
+      self.stats.record_get(key, v2, from_memory=True)
+      return v2
+
+    import time
+    dt_start = time.time()
+    v1 = self._get_buffered(vkey)
+    if v1 is None:
+      v1 = self._execute(self.redis_client.get, vkey)
+
+    v2 = deserialize(v1) if v1 else None
+    self._set_memory(vkey, v1, v2)
+    self.stats.record_get(key, v2, len(v1) if v1 else 0)
+    self.stats.record_latency(key, 'get', time.time() - dt_start)
     if not v1: return v1
-    v2 = self.pyarrow_context.deserialize(v1)
     return v2
 
+  def mget(self, key_l):
+    """
+    Update 2020-02 Get many keys at once, in MGET commands of mget_batchSize keys sent through a single pipeline
+    Returns dict: key -> value, for the keys found only
+    """
+    from isitfit.cost.cacheSerializer import deserialize, versioned_key
+
+    # Update 2020-02 only fetch from redis the keys that are not in the in-process cache
+    out = {}
+    for key in key_l:
+      v2 = self._get_memory(versioned_key(key))
+      if v2 is not None:
+        self.stats.record_get(key, v2, from_memory=True)
+        out[key] = v2
+
+    key_l = [k for k in key_l if k not in out]
+    vkey_l = [versioned_key(k) for k in key_l]
+    if len(key_l)==0:
+      return out
+
+    import time
+    dt_start = time.time()
+    pipe = self.redis_client.pipeline(transaction=False)
+    for i_start in range(0, len(vkey_l), self.mget_batchSize):
+      pipe.mget(vkey_l[i_start:(i_start+self.mget_batchSize)])
+
+    v1_l = [v1 for batch_l in self._execute(pipe.execute) for v1 in batch_l]
+
+    n_memory = len(out)
+    for key, vkey, v1 in zip(key_l, vkey_l, v1_l):
+      v1 = self._get_buffered(vkey) or v1
+      v2 = deserialize(v1) if v1 else None
+      self.stats.record_get(key, v2, len(v1) if v1 else 0)
+      if v2 is None: continue
+      self._set_memory(vkey, v1, v2)
+      out[key] = v2
+
+    # 1 latency sample per round trip, attributed to the namespace of the first key (all keys are usually of the same namespace)
+    self.stats.record_latency(key_l[0], 'get', time.time() - dt_start)
+    logger.debug("Found %i out of %i keys in redis cache"%(len(out) - n_memory, len(key_l)))
+    return out
+
+  def handle_all(self, context_all):
+    """
+    Listener flushing the buffered writes at the end of the pipeline
+    Update 2020-02 The cache stats are reported once by the CLI command, check cacheStats.report_cacheStats
+    """
+    if self.isReady():
+      self.flush()
+
+    return context_all
+
+  def scan(self, namespace=None):
+    """
+    Update 2020-02 Iterate over the keys of the current format version in the cache, eg for `isitfit cache ls`
+    namespace - eg cloudwatch, check cacheStats.NAMESPACE_PREFIX. None for all namespaces
+    Yields (key without the version prefix, header dict as returned by cacheSerializer.read_header)
+    """
+    from isitfit.cost.cacheSerializer import versioned_key, read_header, HEADER_STRUCT
+    from isitfit.cost.cacheStats import NAMESPACE_PREFIX
+    prefix = NAMESPACE_PREFIX[namespace] if namespace is not None else ''
+    vprefix = versioned_key('')
+    for vkey in self.redis_client.scan_iter(match=versioned_key(prefix)+'*'):
+      if type(vkey) == bytes: vkey = vkey.decode('utf-8')
+      # only the header is needed, not the whole value
+      header = read_header(self._execute(self.redis_client.getrange, vkey, 0, HEADER_STRUCT.size-1) or b'')
+      if header is None: continue
+      yield vkey[len(vprefix):], header
+
+  def purge(self, namespace=None):
+    """
+    Update 2020-02 Delete the keys of a namespace (or all namespaces if None) from the cache
+    Returns the number of deleted keys
+    """
+    from isitfit.cost.cacheSerializer import versioned_key
+    self.flush()
+    vkey_l = [versioned_key(k) for k, _ in self.scan(namespace)]
+    for vkey in vkey_l:
+      self._execute(self.redis_client.delete, vkey)
+      if self.memory is not None:
+        self.memory.delete(vkey)
+
+    return len(vkey_l)
+
   def handle_pre(self, context_pre):
         from isitfit.utils import ping_matomo
 
         # set up caching if requested
-        self.fetch_envvars()
-        if self.isSetup():
-          self.connect()
-          ping_matomo("/cost/setting?redis.is_configured=True")
-          return context_pre
-
-        # 0th pass to count
-        n_ec2_total = context_pre['n_ec2_total']
-        ping_matomo("/cost/setting?redis.is_configured=False")
-
-        # if more than 10 servers, recommend caching with redis
-        cond_prompt = n_ec2_total > 10 and not self.isSetup()
-        if cond_prompt:
-            from termcolor import colored
-            logger.warning(colored(
-"""Since the number of EC2 instances is %i,
-it is recommended to use redis for caching of downloaded CPU/memory metrics.
-To do so
-- install redis
-
-    [sudo] apt-get install redis-server
-
-- export environment variables
-
-    export ISITFIT_REDIS_HOST=localhost
-    export ISITFIT_REDIS_PORT=6379
-    export ISITFIT_REDIS_DB=0
-
-where ISITFIT_REDIS_DB is the ID of an unused database in redis.
-
-And finally re-run isitfit as usual.
-"""%n_ec2_total, "yellow"))
-            import click
-            # not using abort=True so that I can send a custom message in the abort
-            continue_wo_redis = click.confirm(colored('Would you like to continue without redis caching? ', 'cyan'), abort=False, default=True)
-            if not continue_wo_redis:
-                from isitfit.cli.click_descendents import IsitfitCliError
-                raise IsitfitCliError("Aborting to set up redis.", context_pre['click_ctx'])
-
+        # Update 2020-02 Instead of recommending to set up redis if there are more than 10 servers (and prompting to continue),
+        # use the embedded cache, unless disabled with ISITFIT_CACHE_LOCAL=0
+        is_redis = self.connect_auto()
+        ping_matomo("/cost/setting?redis.is_configured=%s"%is_redis)
 
         # done
         return context_pre
@@ -129,16 +305,85 @@ And finally re-run isitfit as usual.
 
 from isitfit.utils import logger, NoCloudwatchException, HostNotFoundInDdg, DataNotFoundForHostInDdg
 
+# Update 2020-02 expiration of the negative cache entries, doubling with each consecutive miss of a resource, up to 1 day
+NEGATIVE_TTL_MIN = SECONDS_IN_10MINS
+NEGATIVE_TTL_MAX = SECONDS_IN_ONE_DAY
+
+# exceptions that can be cached, by name
+NEGATIVE_REASONS = {cls.__name__: cls for cls in [NoCloudwatchException, HostNotFoundInDdg, DataNotFoundForHostInDdg]}
+
+
+class NegativeCacheEntry:
+    """
+    Cached when no data is found for a resource, eg the host is not in datadog.
+    Callable that raises the error of the miss, eg NoCloudwatchException.
+
+    Update 2020-02 Replaces CachedError, which pickled the exception itself and was cached for a flat 10 minutes.
+    The entry records the exception class name (reason), the metrics source (eg datadog), when the resource was first missing,
+    and the number of consecutive misses, which sets the expiration of the entry (check NEGATIVE_TTL_MIN).
+    The entry is kept in the cache for NEGATIVE_TTL_MAX after its expiration so that the next miss can increase it
+    """
+    def __init__(self, error, source, previous=None):
+      """
+      previous - the expired NegativeCacheEntry of the same resource, if any
+      """
+      import time
+      self.reason = type(error).__name__
+      self.message = str(error)
+      self.source = source
+      self.first_seen = time.time() if previous is None else previous.first_seen
+      self.miss_count = 1 if previous is None else previous.miss_count + 1
+      self.ttl = min(NEGATIVE_TTL_MIN * 2**(self.miss_count-1), NEGATIVE_TTL_MAX)
+      self.expires_at = time.time() + self.ttl
+
+    def is_expired(self):
+      import time
+      return self.expires_at <= time.time()
+
+    def get_error(self):
+      return NEGATIVE_REASONS.get(self.reason, Exception)(self.message)
+
+    def __call__(self):
+      raise self.get_error()
+
+
 from isitfit.utils import myreturn
+
+# Update 2020-02 Metrics are cached as per-day rows, independently of ndays, and only the missing days are fetched.
+# The cached days are kept for this many days (or longer if the ndays window is longer)
+METRICS_CACHE_MAXDAYS = 90
+
+# expiration of the per-day rows. Days are not re-fetched once cached (except the latest one), so they can be kept much longer than 1 day
+METRICS_CACHE_TTL = SECONDS_IN_ONE_DAY*METRICS_CACHE_MAXDAYS
+
+
 class MetricCacheMixin:
     """
     Mixin for metrics_* classes to get Caching
+
+    Update 2020-02 The cached value of a resource is a dataframe with one row per day (Timestamp column),
+    covering a contiguous range of days.
+    Days that were fetched but had no data have a row of NaN, so that they are not fetched again.
+    The metrics class should implement get_window, returning the (date start, date end) of the ndays window
     """
+    # exception raised when the resource has no data in the ndays window, eg NoCloudwatchException
+    nodata_exception = None
+
     def __init__(self, cache_man):
       """
       cache_man - RedisPandasCacheManager
       """
       self.cache_man = cache_man
+
+      # Update 2020-02 values fetched in bulk by cache_prefetch, by cache key
+      # and the keys that were checked in bulk but not found
+      self.cache_prefetched = {}
+      self.cache_missing = set()
+
+      # Update 2020-02 resources known to have no data, as found in the cache or fetched, checked before any network call
+      # dict: resource ID -> NegativeCacheEntry
+      self.known_missing = {}
+
       super().__init__()
 
 
@@ -146,65 +391,229 @@ class MetricCacheMixin:
       raise Exception("Define in derived/mixin")
 
 
-    def get_metrics_base(self, rc_describe_entry, rc_id, rc_created):
+    def get_metrics_base(self, rc_describe_entry, rc_id, rc_created, span=None):
+      """
+      span - (date start, date end) to fetch, or None for the ndays window
+      """
       raise Exception("Define in derived/mixin")
 
 
+    def cache_prefetch(self, rc_ids):
+        """
+        Update 2020-02 Fetch the cached values of many resources at once (pipelined MGET),
+        instead of a blocking get per resource in get_metrics_derived.
+        Returns the list of resource IDs not found in the cache
+        """
+        if self.cache_man is None or not self.cache_man.isReady():
+          return rc_ids
+
+        key_map = {self.get_key(rc_id): rc_id for rc_id in rc_ids}
+        found = self.cache_man.mget(list(key_map.keys()))
+        self.cache_prefetched.update(found)
+        self.cache_missing.update(set(key_map.keys()) - set(found.keys()))
+        for k, v in found.items():
+          self._known_missing_add(key_map[k], v)
+
+        return [rc_id for k, rc_id in key_map.items() if k not in found]
+
+
+    def cache_prefetch_spans(self, rc_ids):
+        """
+        Update 2020-02 Fetch the cached values of many resources at once, and return the spans of days to fetch for each
+        Returns list of (resource ID, span), with one entry per span (check cache_spans),
+        skipping the resources that do not need to be fetched
+        """
+        self.cache_prefetch(rc_ids)
+
+        out = []
+        for rc_id in rc_ids:
+          if self.get_known_missing(rc_id) is not None:
+            # cached error, raised in get_metrics_derived
+            continue
+
+          df_cache = self.cache_prefetched.get(self.get_key(rc_id), None)
+          if isinstance(df_cache, NegativeCacheEntry):
+            # expired, fetch again
+            df_cache = None
+
+          out += [(rc_id, span) for span in self.cache_spans(df_cache)]
+
+        return out
+
+
+    def _known_missing_add(self, rc_id, value):
+        if isinstance(value, NegativeCacheEntry) and not value.is_expired():
+          self.known_missing[rc_id] = value
+
+
+    def get_known_missing(self, rc_id):
+        """
+        Update 2020-02 Returns the NegativeCacheEntry of the resource if it is known to have no data, otherwise None
+        """
+        entry = self.known_missing.get(rc_id, None)
+        if entry is None or entry.is_expired():
+          return None
+
+        return entry
+
+
+    def cache_spans(self, df_cache):
+        """
+        List of spans of days (date start, date end) to fetch given the cached per-day rows, empty if the cache covers the ndays window.
+        These are the days before the cached ones (eg ndays increased from 7 to 30) and the days after them.
+        The latest cached day is fetched again since it might have been partial when it was cached
+        """
+        win_start, win_end = self.get_window()
+        if df_cache is None:
+          return [(win_start, win_end)]
+
+        cov_start, cov_end = df_cache.Timestamp.min(), df_cache.Timestamp.max()
+        if cov_end < win_start:
+          # the cached days are all before the window
+          return [(win_start, win_end)]
+
+        out = []
+        if cov_start > win_start:
+          import datetime as dt
+          out.append((win_start, cov_start - dt.timedelta(days=1)))
+
+        if cov_end < win_end:
+          out.append((cov_end, win_end))
+
+        return out
+
+
+    def cache_stitch(self, df_cache, df_fresh, span):
+        """
+        Merge the cached days with the days fetched in span.
+        The fetched days replace the cached ones, and the days of span without data get a row of NaN
+        """
+        d_start, d_end = span
+        df_l = []
+        day_nodata = set(pd.date_range(d_start, d_end, freq='D').date)
+
+        day_fresh = set()
+        if df_fresh is not None:
+          df_fresh = df_fresh[(df_fresh.Timestamp >= d_start) & (df_fresh.Timestamp <= d_end)]
+          df_l.append(df_fresh)
+          day_fresh = set(df_fresh.Timestamp)
+
+        # keep the cached days only if they are contiguous with the fetched ones
+        if df_cache is not None and df_cache.Timestamp.max() >= d_start:
+          df_cache = df_cache[~df_cache.Timestamp.isin(day_fresh)]
+          df_l.append(df_cache)
+          day_nodata = day_nodata - set(df_cache.Timestamp)
+
+        day_nodata = day_nodata - day_fresh
+        df_l.append(pd.DataFrame({'Timestamp': sorted(day_nodata)}))
+        df_all = pd.concat([df for df in df_l if df.shape[0]>0], sort=False)
+        df_all = df_all.sort_values('Timestamp').reset_index(drop=True)
+
+        # drop the days that are too old
+        import datetime as dt
+        win_start, win_end = self.get_window()
+        d_min = min(win_start, win_end - dt.timedelta(days=METRICS_CACHE_MAXDAYS))
+        return df_all[df_all.Timestamp >= d_min].reset_index(drop=True)
+
+
+    def cache_window(self, df_all, rc_id):
+        """
+        Days of the ndays window that have data
+        """
+        win_start, win_end = self.get_window()
+        df_win = df_all[(df_all.Timestamp >= win_start) & (df_all.Timestamp <= win_end)]
+        is_nodata = df_win.drop(columns=['Timestamp']).isna().all(axis=1)
+        df_win = df_win[~is_nodata].reset_index(drop=True)
+        if df_win.shape[0]==0:
+          raise self.nodata_exception("No data in the latest %i days for %s"%(self.ndays, rc_id))
+
+        return df_win
+
+
     def get_metrics_derived(self, rc_describe_entry, rc_id, rc_created):
         # check cache first
         cache_key = self.get_key(rc_id)
 
+        entry = self.get_known_missing(rc_id)
+        if entry is not None:
+          # no network call, nor cache call
+          entry()
+
+        df_cache, previous = None, None
         if self.cache_man.isReady():
-          df_cache = self.cache_man.get(cache_key)
+          if cache_key in self.cache_prefetched:
+            df_cache = self.cache_prefetched.pop(cache_key)
+          elif cache_key in self.cache_missing:
+            # already checked in cache_prefetch
+            df_cache = None
+          else:
+            df_cache = self.cache_man.get(cache_key)
+
           if df_cache is None:
             # not found
             pass
-          else:
-            if callable(df_cache):
-              # if one of the raise_* functions is cached
+          elif isinstance(df_cache, NegativeCacheEntry):
+            if not df_cache.is_expired():
+              self._known_missing_add(rc_id, df_cache)
               df_cache()
 
-            elif type(df_cache) is pd.DataFrame:
-              if df_cache.shape[0]==0:
-                # found but no data
-                raise Exception("As of isitfit 0.19, empty dataframes are no longer cached")
-              else:
-                logger.debug("Found metrics (datadog? cloudwatch?)  in redis cache for %s, and data.shape[0] = %i"%(rc_id, df_cache.shape[0]))
-                # replace with None if .shape[0]==0
-                df_cache = myreturn(df_cache)
-                # done
-                return df_cache
-            else:
-              raise ValueError("Invalid value in cache for %s"%cache_key)
-
-        # if no cache, then download
-        df_fresh = pd.DataFrame() # use an empty dataframe in order to distinguish when getting from cache if not available in cache or data not found but set in cache
-        def error2func(error):
-          def raiseme(): raise error
-          return raiseme
-
-        try:
-          df_fresh = self.get_metrics_base(rc_describe_entry, rc_id, rc_created)
-        except HostNotFoundInDdg as error:
-          df_fresh = error2func(error)
-        except DataNotFoundForHostInDdg as error:
-          df_fresh = error2func(error)
-        except NoCloudwatchException as error:
-          df_fresh = error2func(error)
-        except:
-          # anything else should bubble up
-          raise
+            # fetch again, and keep the entry to increase its expiration in case of another miss
+            previous, df_cache = df_cache, None
+          elif type(df_cache) is pd.DataFrame:
+            if df_cache.shape[0]==0:
+              # found but no data
+              raise Exception("As of isitfit 0.19, empty dataframes are no longer cached")
+
+            logger.debug("Found %i days of metrics (datadog? cloudwatch?) in cache for %s"%(df_cache.shape[0], rc_id))
+          else:
+            raise ValueError("Invalid value in cache for %s"%cache_key)
+
+        span_l = self.cache_spans(df_cache)
+        if len(span_l)==0:
+          # the cached days cover the window
+          return myreturn(self.cache_window(df_cache, rc_id))
+
+        # if no cache, then download, otherwise only download the missing days
+        df_all = df_cache
+        for span in span_l:
+          try:
+            df_fresh = self.get_metrics_base(rc_describe_entry, rc_id, rc_created, span)
+          except (DataNotFoundForHostInDdg, NoCloudwatchException) as error:
+            if df_cache is None:
+              # cache the error instead of the days so that the resource is fetched again soon
+              self._cache_error(rc_id, error, previous)
+
+            # no data in the missing days, but the cached days are still valid
+            df_fresh = None
+          except HostNotFoundInDdg as error:
+            self._cache_error(rc_id, error, previous)
+          except:
+            # anything else should bubble up
+            raise
+
+          df_all = self.cache_stitch(df_all, df_fresh, span)
 
         # if caching enabled, store it for later fetching
         # https://stackoverflow.com/a/57986261/4126114
-        # Note that this even stores the result if it was "None" (meaning that no data was found)
         if self.cache_man.isReady():
-          self.cache_man.set(cache_key, df_fresh)
-
-        # if exception
-        if callable(df_fresh):
-          df_fresh()
+          self.cache_man.set(cache_key, df_all, ex=METRICS_CACHE_TTL)
 
         # done
-        return myreturn(df_fresh)
+        return myreturn(self.cache_window(df_all, rc_id))
+
+
+    def _cache_error(self, rc_id, error, previous=None):
+        """
+        Cache the error (if caching enabled) and raise it
+        previous - NegativeCacheEntry of the previous miss of the resource
+        """
+        from isitfit.cost.cacheStats import key2namespace
+        cache_key = self.get_key(rc_id)
+        entry = NegativeCacheEntry(error, key2namespace(cache_key), previous)
+        self.known_missing[rc_id] = entry
+        logger.debug("Caching miss #%i of %s for %i seconds: %s"%(entry.miss_count, rc_id, entry.ttl, entry.reason))
+
+        if self.cache_man.isReady():
+          self.cache_man.set(cache_key, entry, ex=entry.ttl + NEGATIVE_TTL_MAX)
 
+        raise error
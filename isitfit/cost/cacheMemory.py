@@ -0,0 +1,140 @@
+"""
+In-process cache in front of the redis/local backend of RedisPandas
+
+Update 2020-02 A single CLI invocation can build several RedisPandas instances (eg the EC2 and Redshift pipelines of `cost analyze`)
+which read the same keys. The deserialized values are kept in a least-recently-used map shared by all the instances,
+bounded by the total in-memory size of the values, so that each key is fetched and deserialized once per process.
+"""
+
+import collections
+import os
+import threading
+import time
+
+import pandas as pd
+
+from isitfit.utils import logger
+
+
+# default budget of the in-process cache, over-ridable with the environment variable ISITFIT_CACHE_MEMORY_MB (0 to disable)
+MEMORY_MB_DEFAULT = 256
+
+
+class MemoryLRU:
+  """
+  Least-recently-used map with a budget in bytes.
+  Each value is set with its size (check value_nbytes) and its expiration in seconds
+  """
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+
+    # dict: key -> (value, size in bytes, expiration timestamp), ordered from least to most recently used
+    self.entries = collections.OrderedDict()
+    self.n_bytes = 0
+
+    # shared by the mainManager worker threads
+    self.lock = threading.Lock()
+
+
+  def _pop(self, key):
+    _, n_bytes, _ = self.entries.pop(key)
+    self.n_bytes -= n_bytes
+
+
+  def get(self, key):
+    """
+    Returns the value, or None if not found or expired.
+    Dataframes are copied so that the caller can modify them without affecting the cached value
+    """
+    with self.lock:
+      if key not in self.entries:
+        return None
+
+      value, _, expires_at = self.entries[key]
+      if expires_at is not None and expires_at <= time.time():
+        self._pop(key)
+        return None
+
+      self.entries.move_to_end(key)
+
+    if type(value) == pd.DataFrame:
+      return value.copy()
+
+    return value
+
+
+  def set(self, key, value, n_bytes, ex=None):
+    if n_bytes > self.max_bytes:
+      # would evict everything else
+      logger.debug("Value of %s too large for the in-process cache: %i bytes"%(key, n_bytes))
+      self.delete(key)
+      return
+
+    if type(value) == pd.DataFrame:
+      value = value.copy()
+
+    expires_at = None if ex is None else time.time() + ex
+    with self.lock:
+      if key in self.entries:
+        self._pop(key)
+
+      self.entries[key] = (value, n_bytes, expires_at)
+      self.n_bytes += n_bytes
+
+      # evict the least recently used
+      while self.n_bytes > self.max_bytes:
+        key_lru = next(iter(self.entries))
+        logger.debug("Evicting %s from the in-process cache"%key_lru)
+        self._pop(key_lru)
+
+
+  def delete(self, key):
+    with self.lock:
+      if key in self.entries:
+        self._pop(key)
+
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.n_bytes = 0
+
+
+
+def value_nbytes(value, data):
+  """
+  Size of a deserialized value, to charge the budget of MemoryLRU.
+  The compressed length of the serialized bytes can be many times smaller than the value held in memory,
+  so use the in-memory size of dataframes, and the uncompressed size from the serialization header otherwise (eg dicts)
+  data - bytes as returned by cacheSerializer.serialize
+  """
+  if type(value) == pd.DataFrame:
+    return int(value.memory_usage(deep=True).sum())
+
+  from isitfit.cost.cacheSerializer import read_header
+  header = read_header(data)
+  if header is None:
+    return len(data)
+
+  return header['size_raw']
+
+
+# instance shared by all the RedisPandas of the process
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def get_memoryLRU():
+  """
+  Returns the shared MemoryLRU, or None if disabled with ISITFIT_CACHE_MEMORY_MB=0
+  """
+  global _shared
+  max_bytes = int(float(os.getenv("ISITFIT_CACHE_MEMORY_MB", MEMORY_MB_DEFAULT))*1024*1024)
+  if max_bytes <= 0:
+    return None
+
+  with _shared_lock:
+    if _shared is None or _shared.max_bytes != max_bytes:
+      _shared = MemoryLRU(max_bytes)
+
+    return _shared
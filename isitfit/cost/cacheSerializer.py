@@ -0,0 +1,220 @@
+"""
+Versioned serialization of the values cached by RedisPandas
+
+Update 2020-02 Replaces pyarrow.default_serialization_context, which was deprecated in pyarrow 0.16 and removed later.
+Each value is stored as a fixed-size header followed by the payload:
+- dataframes: Arrow IPC stream format, or Parquet for larger frames
+- anything else (eg NegativeCacheEntry): pickle
+
+The header holds a magic string and the format version.
+Values with a different magic/version are treated as a cache miss instead of being deserialized into garbage.
+
+Update 2020-02 Format version 2: payloads above COMPRESS_MIN_BYTES are compressed with zstd or lz4 if installed
+(pip install isitfit[compression]). The header records the codec, and the uncompressed and stored sizes of the payload,
+which can be read without deserializing the value with read_header.
+The format version is also embedded in the cache keys (check versioned_key),
+so that different isitfit versions sharing the same redis do not overwrite each other's values.
+"""
+
+import os
+import struct
+import pickle
+
+import pandas as pd
+
+from isitfit.utils import logger
+
+
+# bump this when the header or payload format changes
+FORMAT_VERSION = 2
+
+# magic string at the beginning of each value
+FORMAT_MAGIC = b'IFC'
+
+# header: magic, format version, payload type, codec, uncompressed payload size, stored payload size
+HEADER_STRUCT = struct.Struct('>3sBBBII')
+
+# payload types
+PAYLOAD_ARROW = 1
+PAYLOAD_PARQUET = 2
+PAYLOAD_PICKLE = 3
+
+# dataframes larger than this (in memory) are stored as parquet, which is more compact but slower to read
+PARQUET_MIN_BYTES = 1024*1024
+
+# compression codecs
+CODEC_NONE = 0
+CODEC_LZ4 = 1
+CODEC_ZSTD = 2
+CODEC_NAMES = {CODEC_NONE: 'none', CODEC_LZ4: 'lz4', CODEC_ZSTD: 'zstd'}
+
+# payloads smaller than this are not compressed since the gain is not worth the cpu time
+COMPRESS_MIN_BYTES = 64*1024
+
+
+def get_codec_functions(codec):
+  """
+  Returns (compress, decompress) functions of a codec, or None if its library is not installed
+  """
+  try:
+    if codec == CODEC_ZSTD:
+      import zstandard
+      return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+
+    if codec == CODEC_LZ4:
+      import lz4.frame
+      return lz4.frame.compress, lz4.frame.decompress
+
+  except ImportError:
+    return None
+
+  raise ValueError("Unknown codec %s"%codec)
+
+
+def get_codec():
+  """
+  Codec to use for compression, from the environment variable ISITFIT_CACHE_COMPRESSION:
+  auto (default, zstd or lz4, whichever is installed), zstd, lz4, or none
+  """
+  codec_name = os.getenv("ISITFIT_CACHE_COMPRESSION", "auto").lower()
+  if codec_name == 'none':
+    return CODEC_NONE
+
+  if codec_name == 'auto':
+    codec_l = [CODEC_ZSTD, CODEC_LZ4]
+  else:
+    codec_l = [k for k, v in CODEC_NAMES.items() if v == codec_name]
+    if len(codec_l)==0:
+      from isitfit.cli.click_descendents import IsitfitCliError
+      raise IsitfitCliError("Invalid ISITFIT_CACHE_COMPRESSION=%s. Supported values: auto, %s"%(codec_name, ", ".join(CODEC_NAMES.values())))
+
+  for codec in codec_l:
+    if get_codec_functions(codec) is not None:
+      return codec
+
+  logger.debug("Compression library for ISITFIT_CACHE_COMPRESSION=%s not installed. Storing cache values uncompressed"%codec_name)
+  return CODEC_NONE
+
+
+def versioned_key(key):
+  return "v%i:%s"%(FORMAT_VERSION, key)
+
+
+def _df2arrow(df):
+  import pyarrow as pa
+  table = pa.Table.from_pandas(df)
+  sink = pa.BufferOutputStream()
+  writer = pa.RecordBatchStreamWriter(sink, table.schema)
+  writer.write_table(table)
+  writer.close()
+  return sink.getvalue()
+
+
+def _df2parquet(df):
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+  table = pa.Table.from_pandas(df)
+  sink = pa.BufferOutputStream()
+  pq.write_table(table, sink)
+  return sink.getvalue()
+
+
+def serialize(value):
+  """
+  Returns bytes (header + payload)
+  """
+  if type(value) == pd.DataFrame:
+    if value.memory_usage(deep=True).sum() >= PARQUET_MIN_BYTES:
+      payload_type, payload = PAYLOAD_PARQUET, _df2parquet(value)
+    else:
+      payload_type, payload = PAYLOAD_ARROW, _df2arrow(value)
+  else:
+    payload_type, payload = PAYLOAD_PICKLE, pickle.dumps(value)
+
+  size_raw = memoryview(payload).nbytes
+  codec = CODEC_NONE
+  if size_raw >= COMPRESS_MIN_BYTES:
+    codec = get_codec()
+
+  if codec != CODEC_NONE:
+    compress, _ = get_codec_functions(codec)
+    payload_c = compress(memoryview(payload))
+    if len(payload_c) < size_raw:
+      logger.debug("Compressed cache value with %s: %i -> %i bytes"%(CODEC_NAMES[codec], size_raw, len(payload_c)))
+      payload = payload_c
+    else:
+      codec = CODEC_NONE
+
+  size_stored = memoryview(payload).nbytes
+  header = HEADER_STRUCT.pack(FORMAT_MAGIC, FORMAT_VERSION, payload_type, codec, size_raw, size_stored)
+  return header + memoryview(payload)
+
+
+def read_header(data):
+  """
+  Returns dict of the header fields, or None if the header is not that of the current format version
+  """
+  if len(data) < HEADER_STRUCT.size:
+    logger.debug("Cache value too short to be deserialized")
+    return None
+
+  magic, version, payload_type, codec, size_raw, size_stored = HEADER_STRUCT.unpack_from(data, 0)
+  if magic != FORMAT_MAGIC or version != FORMAT_VERSION:
+    logger.debug("Cache value of a different format, magic=%s, version=%s"%(magic, version))
+    return None
+
+  return {
+    'version': version,
+    'payload_type': payload_type,
+    'codec': codec,
+    'size_raw': size_raw,
+    'size_stored': size_stored,
+  }
+
+
+def deserialize(data):
+  """
+  data - bytes as returned by serialize
+  Returns the value, or None if the header is not that of the current format version
+  """
+  header = read_header(data)
+  if header is None:
+    return None
+
+  payload_type = header['payload_type']
+
+  # zero-copy view of the payload, i.e. skipping the header without copying the bytes
+  payload = memoryview(data)[HEADER_STRUCT.size:]
+
+  codec = header['codec']
+  if codec != CODEC_NONE:
+    codec_functions = get_codec_functions(codec) if codec in CODEC_NAMES else None
+    if codec_functions is None:
+      # eg written by another machine with zstandard installed
+      logger.debug("Cache value compressed with codec %s, which is not installed"%CODEC_NAMES.get(codec, codec))
+      return None
+
+    _, decompress = codec_functions
+    payload = decompress(payload)
+
+  if payload_type == PAYLOAD_PICKLE:
+    try:
+      return pickle.loads(payload)
+    except (AttributeError, ImportError) as e:
+      # eg a class that was removed in a later isitfit version
+      logger.debug("Cache value that cannot be unpickled: %s"%str(e))
+      return None
+
+  import pyarrow as pa
+  buf = pa.py_buffer(payload)
+
+  if payload_type == PAYLOAD_ARROW:
+    table = pa.ipc.open_stream(buf).read_all()
+  elif payload_type == PAYLOAD_PARQUET:
+    import pyarrow.parquet as pq
+    table = pq.read_table(pa.BufferReader(buf))
+  else:
+    logger.debug("Cache value of unknown payload type %s"%payload_type)
+    return None
+
+  return table.to_pandas()
@@ -0,0 +1,204 @@
+"""
+Counters of the cache operations of RedisPandas, by namespace (cloudwatch, datadog, cloudtrail)
+
+Update 2020-02 Counts the hits (from the in-process cache or from redis), misses, negative hits (cached errors, eg no data for a resource),
+bytes read/written, and histograms of the get/set latencies.
+The counters are shared by all the RedisPandas instances of the process,
+summarized once at the end of `isitfit cost analyze/optimize` (report_cacheStats), and saved to a file in the isitfit temporary directory for `isitfit cache stats`.
+"""
+
+import json
+import os
+import threading
+import time
+
+from isitfit.utils import logger
+
+
+# name of the file in DotMan().tempdir() with the stats of the latest run
+STATS_FILENAME = 'cache_stats.json'
+
+# upper bounds of the latency histogram buckets, in milliseconds. The last bucket is for anything slower
+LATENCY_BUCKETS_MS = [1, 5, 10, 50, 100, 500, 1000]
+
+# namespace -> prefix of the cache keys
+NAMESPACE_PREFIX = {
+  'cloudwatch': 'cloudwatch:',
+  'datadog': 'datadog:',
+  'cloudtrail': 'cloudtrail',
+}
+
+COUNTER_NAMES = ['hits_memory', 'hits', 'hits_negative', 'misses', 'bytes_read', 'n_set', 'bytes_written']
+
+
+def key2namespace(key):
+  for namespace, prefix in NAMESPACE_PREFIX.items():
+    if key.startswith(prefix):
+      return namespace
+
+  return 'other'
+
+
+def latency2bucket(seconds):
+  """
+  Returns the label of the histogram bucket of a latency, eg "<=5ms" or ">1000ms"
+  """
+  ms = seconds*1000
+  for ub in LATENCY_BUCKETS_MS:
+    if ms <= ub:
+      return "<=%ims"%ub
+
+  return ">%ims"%LATENCY_BUCKETS_MS[-1]
+
+
+class CacheStats:
+  def __init__(self):
+    # dict: namespace -> dict: counter name -> value
+    self.counters = {}
+
+    # dict: namespace -> dict: operation (get or set) -> dict: bucket label -> count
+    self.latency = {}
+
+    self.lock = threading.Lock()
+
+
+  def _counters(self, namespace):
+    if namespace not in self.counters:
+      self.counters[namespace] = {k: 0 for k in COUNTER_NAMES}
+      self.latency[namespace] = {'get': {}, 'set': {}}
+
+    return self.counters[namespace]
+
+
+  def record_latency(self, key, operation, seconds):
+    namespace = key2namespace(key)
+    bucket = latency2bucket(seconds)
+    with self.lock:
+      self._counters(namespace)
+      hist = self.latency[namespace][operation]
+      hist[bucket] = hist.get(bucket, 0) + 1
+
+
+  def record_get(self, key, value, n_bytes=0, from_memory=False):
+    """
+    value - as returned by RedisPandas.get, i.e. None if not found, callable if cached error
+    n_bytes - number of bytes read from redis
+    """
+    namespace = key2namespace(key)
+    with self.lock:
+      c = self._counters(namespace)
+      if value is None:
+        c['misses'] += 1
+      elif callable(value):
+        c['hits_negative'] += 1
+      elif from_memory:
+        c['hits_memory'] += 1
+      else:
+        c['hits'] += 1
+
+      c['bytes_read'] += n_bytes
+
+
+  def record_set(self, key, n_bytes):
+    namespace = key2namespace(key)
+    with self.lock:
+      c = self._counters(namespace)
+      c['n_set'] += 1
+      c['bytes_written'] += n_bytes
+
+
+  def is_empty(self):
+    with self.lock:
+      return len(self.counters)==0
+
+
+  def to_dict(self):
+    with self.lock:
+      return {
+        'dt_saved': time.time(),
+        'counters': json.loads(json.dumps(self.counters)),
+        'latency': json.loads(json.dumps(self.latency)),
+      }
+
+
+  def save(self, filename=None):
+    if filename is None:
+      from isitfit.dotMan import DotMan
+      filename = os.path.join(DotMan().tempdir(), STATS_FILENAME)
+
+    with open(filename, 'w') as fh:
+      json.dump(self.to_dict(), fh)
+
+    logger.debug("Saved cache stats to %s"%filename)
+
+
+  def display(self):
+    import click
+    click.echo("Cache usage:")
+    click.echo(stats2table(self.to_dict()))
+
+
+
+def stats2table(stats_d):
+  """
+  Tabulate the counters of the output of CacheStats.to_dict, one row per namespace
+  """
+  tab = []
+  for namespace, c in sorted(stats_d['counters'].items()):
+    n_get = c['hits_memory'] + c['hits'] + c['hits_negative'] + c['misses']
+    hit_ratio = "%.0f%%"%(100*(n_get - c['misses'])/n_get) if n_get > 0 else "-"
+    tab.append([namespace, n_get, hit_ratio] + [c[k] for k in COUNTER_NAMES])
+
+  from tabulate import tabulate
+  return tabulate(tab, headers=['Namespace', 'Gets', 'Hit ratio'] + COUNTER_NAMES)
+
+
+def latency2table(stats_d):
+  """
+  Tabulate the latency histograms of the output of CacheStats.to_dict, one row per namespace and operation
+  """
+  bucket_l = ["<=%ims"%ub for ub in LATENCY_BUCKETS_MS] + [">%ims"%LATENCY_BUCKETS_MS[-1]]
+  tab = []
+  for namespace, op_d in sorted(stats_d['latency'].items()):
+    for operation, hist in sorted(op_d.items()):
+      tab.append([namespace, operation] + [hist.get(b, 0) for b in bucket_l])
+
+  from tabulate import tabulate
+  return tabulate(tab, headers=['Namespace', 'Operation'] + bucket_l)
+
+
+def load_stats(filename=None):
+  """
+  Returns the stats saved by the latest run, or None
+  """
+  if filename is None:
+    from isitfit.dotMan import DotMan
+    filename = os.path.join(DotMan().tempdir(), STATS_FILENAME)
+
+  if not os.path.exists(filename):
+    return None
+
+  with open(filename, 'r') as fh:
+    return json.load(fh)
+
+
+
+# instance shared by all the RedisPandas of the process
+_shared = CacheStats()
+
+
+def get_cacheStats():
+  return _shared
+
+
+def report_cacheStats():
+  """
+  Display and save the cache stats of the run, if any.
+  Called once by the CLI command rather than by each pipeline, since the ec2 and redshift pipelines share the stats
+  """
+  stats = get_cacheStats()
+  if stats.is_empty():
+    return
+
+  stats.display()
+  stats.save()
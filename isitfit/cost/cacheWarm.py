@@ -0,0 +1,205 @@
+"""
+Fill the metrics and cloudtrail caches ahead of `isitfit cost analyze/optimize`, eg from a cron job
+
+Update 2020-02 Used by `isitfit cache warm`.
+The resources are listed with the same iterators as the cost pipelines (Ec2Iterator, RedshiftPerformanceIterator),
+then their metrics are fetched through the cached classes (CloudwatchEc2, CloudwatchRedshift, DatadogCached) in a thread pool,
+while the cloudtrail events are fetched through EventAggregatorCached in the same pool.
+The API calls are kept under a budget with a TokenBucket, passed down to the fetchers which acquire a token per call.
+The cache keys that were filled are saved in a checkpoint file, so that an interrupted run resumes where it stopped.
+"""
+
+import datetime as dt
+import json
+import os
+import threading
+
+from isitfit.utils import logger, NoCloudwatchException, HostNotFoundInDdg, DataNotFoundForHostInDdg
+
+
+class WarmCheckpoint:
+  """
+  Set of cache keys filled by `isitfit cache warm`, saved to a file in the isitfit temporary directory.
+  The checkpoint is only valid for the same UTC day and ndays, since the next day has new data to fetch
+  """
+  def __init__(self, profile_name, ndays, filename=None):
+    if filename is None:
+      from isitfit.dotMan import DotMan
+      filename = os.path.join(DotMan().tempdir(), 'cache_warm-%s.json'%profile_name)
+
+    self.filename = filename
+    self.ndays = ndays
+    self.date = dt.datetime.utcnow().date().isoformat()
+    self.done = set()
+    self.lock = threading.Lock()
+
+
+  def load(self):
+    if not os.path.exists(self.filename):
+      return
+
+    with open(self.filename, 'r') as fh:
+      saved = json.load(fh)
+
+    if saved['date'] != self.date or saved['ndays'] != self.ndays:
+      logger.debug("Ignoring cache warm checkpoint of %s with ndays=%i"%(saved['date'], saved['ndays']))
+      return
+
+    self.done = set(saved['done'])
+    logger.info("Resuming cache warm-up: %i keys already done"%len(self.done))
+
+
+  def add(self, key):
+    with self.lock:
+      self.done.add(key)
+
+
+  def is_done(self, key):
+    with self.lock:
+      return key in self.done
+
+
+  def save(self):
+    with self.lock:
+      saved = {'date': self.date, 'ndays': self.ndays, 'done': sorted(self.done)}
+
+    # write to a temporary file and rename, so that an interruption does not leave a corrupt checkpoint
+    fn_tmp = self.filename + '.tmp'
+    with open(fn_tmp, 'w') as fh:
+      json.dump(saved, fh)
+
+    os.replace(fn_tmp, self.filename)
+
+
+  def remove(self):
+    if os.path.exists(self.filename):
+      os.remove(self.filename)
+
+
+
+class CacheWarmer:
+  # number of resources per prefetch call (GetMetricData batch) and per checkpoint save
+  chunk_size = 100
+
+  def __init__(self, cache_man, ndays, n_workers, bucket, checkpoint):
+    """
+    cache_man - RedisPandas, connected
+    bucket - isitfit.utils.TokenBucket
+    checkpoint - WarmCheckpoint
+    """
+    self.cache_man = cache_man
+    self.ndays = ndays
+    self.n_workers = n_workers
+    self.bucket = bucket
+    self.checkpoint = checkpoint
+
+    # number of cache keys filled, skipped (from checkpoint), failed
+    self.n_done = 0
+    self.n_skipped = 0
+    self.n_failed = 0
+    self.lock = threading.Lock()
+
+
+  def get_sources(self, ec2_l, redshift_l):
+    """
+    List of (metrics class, list of entries of the iterator)
+    """
+    from isitfit.cost.metrics_cloudwatch import CloudwatchEc2, CloudwatchRedshift
+    from isitfit.cost.metrics_datadog import DatadogCached
+
+    source_l = [
+      (CloudwatchEc2(self.cache_man), ec2_l),
+      (CloudwatchRedshift(self.cache_man), redshift_l),
+    ]
+
+    ddg = DatadogCached(self.cache_man)
+    if ddg.is_configured():
+      source_l.append((ddg, ec2_l))
+
+    for metrics, _ in source_l:
+      metrics.set_ndays(self.ndays)
+      metrics.set_bucket(self.bucket)
+
+    return source_l
+
+
+  def _count(self, counter):
+    with self.lock:
+      setattr(self, counter, getattr(self, counter) + 1)
+
+
+  def warm_one(self, metrics, entry):
+    rc_describe_entry, rc_id, rc_created, _ = entry
+
+    try:
+      metrics.get_metrics_derived(rc_describe_entry, rc_id, rc_created)
+    except (NoCloudwatchException, HostNotFoundInDdg, DataNotFoundForHostInDdg):
+      # no data, which is cached too
+      pass
+    except Exception as e:
+      # retry in the next run
+      logger.warning("Failed to warm the cache of %s: %s"%(rc_id, str(e)))
+      self._count('n_failed')
+      return
+
+    self.checkpoint.add(metrics.get_key(rc_id))
+    self._count('n_done')
+
+
+  def warm_cloudtrail(self, region_include, tqdmman):
+    from isitfit.cost.cloudtrail_iterator import EventAggregatorCached
+    eac = EventAggregatorCached(region_include, tqdmman, self.cache_man, self.bucket)
+    key_l = eac.get_keys()
+    if all([self.checkpoint.is_done(k) for k in key_l]):
+      self._count('n_skipped')
+      return
+
+    eac.get()
+    for k in key_l:
+      self.checkpoint.add(k)
+
+    self._count('n_done')
+
+
+  def warm(self, ec2_it, redshift_it, tqdmman):
+    # list the resources, from the inventory snapshot shared by both iterators
+    ec2_l, redshift_l = list(ec2_it), list(redshift_it)
+    region_include = sorted(set(ec2_it.get_regionInclude()) | set(redshift_it.get_regionInclude()))
+    logger.info("Warming up the cache of %i EC2 instances and %i Redshift clusters, ndays=%i"%(len(ec2_l), len(redshift_l), self.ndays))
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+      # cloudtrail in the background while the metrics are fetched
+      future_ct = executor.submit(self.warm_cloudtrail, region_include, tqdmman)
+
+      for metrics, entry_l in self.get_sources(ec2_l, redshift_l):
+        entry_todo = [e for e in entry_l if not self.checkpoint.is_done(metrics.get_key(e[1]))]
+        self.n_skipped += len(entry_l) - len(entry_todo)
+
+        # prefetch in bulk, then fetch the remaining resources one by one, each API call taking a token of the budget.
+        # Datadog is prefetched for the whole fleet at once (check prefetch_once), cloudwatch per chunk
+        if metrics.prefetch_once and len(entry_todo) > 0:
+          metrics.handle_pre({'ec2_instances': entry_todo})
+
+        for i_start in range(0, len(entry_todo), self.chunk_size):
+          entry_chunk = entry_todo[i_start:(i_start+self.chunk_size)]
+
+          if not metrics.prefetch_once:
+            metrics.handle_pre({'ec2_instances': entry_chunk})
+
+          list(executor.map(lambda e: self.warm_one(metrics, e), entry_chunk))
+
+          # flush before saving the checkpoint so that it never lists keys that are not in the cache
+          self.cache_man.flush()
+          self.checkpoint.save()
+
+      future_ct.result()
+
+    self.cache_man.flush()
+    if self.n_failed == 0:
+      # all done, the next run starts from scratch
+      self.checkpoint.remove()
+    else:
+      self.checkpoint.save()
+
+    logger.info("Cache warm-up done: %i keys filled, %i already done, %i failed"%(self.n_done, self.n_skipped, self.n_failed))
@@ -10,8 +10,11 @@ from isitfit.cost.cloudtrail_iterator import dict2service
 
 
 class CloudtrailCached:
-    def __init__(self, EndTime, cache_man, tqdmman):
+    def __init__(self, EndTime, cache_man, tqdmman, StartTime=None):
         self.EndTime = EndTime
+
+        # Update 2020-02 start of the ndays window, to only fetch the cloudtrail events needed. None for all 90 days
+        self.StartTime = StartTime
         self.tqdmman = tqdmman
         self.cache_man = cache_man
 
@@ -22,13 +25,35 @@ class CloudtrailCached:
 
         # get cloudtail ec2 type changes for all instances
         from isitfit.cost.cloudtrail_iterator import EventAggregatorPostprocessed
-        eap = EventAggregatorPostprocessed(region_include, self.tqdmman, self.cache_man, self.EndTime)
+        eap = EventAggregatorPostprocessed(region_include, self.tqdmman, self.cache_man, self.EndTime, self.StartTime)
         self.df_cloudtrail = eap.get(ec2_instances, n_ec2)
 
+        # Update 2020-02 index the history by resource for single
+        self.index_history()
+
         # done
         return context_pre
 
 
+    def index_history(self):
+        """
+        Update 2020-02 Split the cloudtrail history once into small arrays per resource,
+        instead of the chained .loc lookups on the 4-level index of df_cloudtrail in single, which copied a sub-frame at each level.
+        Sets self.history: dict (region, service name, resource ID) -> (EventTime, EventName, ResourceSize1, ResourceSize2) arrays,
+        sorted by decreasing EventTime like df_cloudtrail
+        """
+        self.history = {}
+        if self.df_cloudtrail.shape[0]==0:
+          return
+
+        df_flat = self.df_cloudtrail.reset_index()
+        col_l = [df_flat[c].array for c in ['EventTime', 'EventName', 'ResourceSize1', 'ResourceSize2']]
+
+        # groupby.indices keeps the positions in the order of df_cloudtrail
+        for key, pos in df_flat.groupby(['Region', 'ServiceName', 'ResourceName'], sort=False).indices.items():
+          self.history[key] = tuple([c[pos] for c in col_l])
+
+
     def single(self, context_ec2):
         ec2_dict = context_ec2['ec2_dict']
 
@@ -37,33 +62,20 @@ class CloudtrailCached:
         ServiceName = ec2_dict['ServiceName']
         region_name = ec2_dict['Region']
 
-        sub_ct = self.df_cloudtrail
-
-        sub_ct = sub_ct.loc[region_name]
-        if sub_ct.shape[0]==0:
-          raise NoCloudtrailException("No cloudtrail data #4 for %s"%ec2_id)
-
-        sub_ct = sub_ct.loc[ServiceName]
-        if sub_ct.shape[0]==0:
-          raise NoCloudtrailException("No cloudtrail data #3 for %s"%ec2_id)
-
         # continue
         # ec2_obj = context_ec2['ec2_obj']
         ec2_id = context_ec2['ec2_id']
 
         # pandas series of number of cpu's available on the machine over time, past 90 days
         # series_type_ts1 = self.cloudtrail_client.get_ec2_type(ec2_obj.instance_id)
-        if not ec2_id in sub_ct.index:
+        # Update 2020-02 look up the arrays of index_history (same rows as df_cloudtrail.loc[region, service, ID]).
+        # These are passed as-is instead of a dataframe per resource, check utils.mergeHistoryOnTimestampRange
+        history = self.history.get((region_name, ServiceName, ec2_id), None)
+        if history is None:
           raise NoCloudtrailException("No cloudtrail data #1 for %s"%ec2_id)
 
-        df_type_ts1 = sub_ct.loc[ec2_id]
-        if df_type_ts1 is None:
-          raise NoCloudtrailException("No cloudtrail data #2 for %s"%ec2_id)
-
-        # set in context
-        context_ec2['df_type_ts1'] = df_type_ts1
+        # set in context: tuple of arrays (EventTime, EventName, ResourceSize1, ResourceSize2)
+        context_ec2['type_history'] = history
 
         # done
         return context_ec2
-
-
@@ -14,8 +14,30 @@ import datetime as dt
 from dateutil.relativedelta import relativedelta
 import boto3
 import json
+import time
 
-from isitfit.utils import logger
+from isitfit.utils import logger, SECONDS_IN_ONE_DAY
+from isitfit.cost.cloudtrail_parser import loads_subtree, search
+
+
+# Update 2020-02 constants of EventAggregatorCached
+# Cloudtrail LookupEvents only returns the latest 90 days
+CLOUDTRAIL_MAXDAYS = 90
+
+# seconds after which the events after the cursor are fetched
+CLOUDTRAIL_CACHE_REFRESH = 60*60
+
+# seconds before the cursor to fetch again, for the events delivered late by cloudtrail
+CLOUDTRAIL_CURSOR_LAG = 60*60
+
+# Update 2020-02 days before the ndays window to fetch, check EventAggregatorOneRegion.get_fetchStart
+CLOUDTRAIL_WINDOW_LOOKBACK = 1
+
+# Update 2020-02 max number of LookupEvents calls per second, check https://docs.aws.amazon.com/awscloudtrail/latest/userguide/WhatIsCloudTrail-Limits.html
+CLOUDTRAIL_LOOKUP_RATE = 2
+
+# expiration of the cached history. Any event older than CLOUDTRAIL_MAXDAYS is dropped at each refresh anyway
+CLOUDTRAIL_CACHE_TTL = SECONDS_IN_ONE_DAY*CLOUDTRAIL_MAXDAYS
 
 
 #------------------------------
@@ -43,7 +65,20 @@ from isitfit.utils import logger
 #----------------------------------------
 class EventIterator:
     eventName = None
-  
+
+    def __init__(self, StartTime=None, EndTime=None, client=None, bucket=None):
+        # Update 2020-02 optional start/end of the events to fetch, eg to only fetch the events after those in the cache
+        self.StartTime = StartTime
+        self.EndTime = EndTime
+
+        # Update 2020-02 optional cloudtrail client, eg of a specific region (otherwise from the default boto3 session),
+        # and TokenBucket to acquire before each LookupEvents call
+        self.client = client
+        self.bucket = bucket
+
+        # latest EventTime seen in the responses, including the skipped events
+        self.cursor = None
+
     # get paginator
     def iterate_page(self):
         """
@@ -72,15 +107,22 @@ class EventIterator:
         # Note 2019-12-09 Cloudtrail can return a max of 90 days
         # In this class, the start/end dates are not specified so as to fetch the whole 90 days and cache them
         # Not very efficient, but works ATM. This is not a per EC2/Redshift call
+        # Update 2020-02 unless StartTime/EndTime are set, eg for the ndays window of EventAggregatorOneRegion.get_fetchStart
         # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudtrail.html#CloudTrail.Client.lookup_events
         # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudtrail.html#CloudTrail.Paginator.LookupEvents
-        client = boto3.client('cloudtrail')
+        client = self.client if self.client is not None else boto3.client('cloudtrail')
         self.region_name = client.meta.region_name
         cp = client.get_paginator(operation_name="lookup_events")
+        kwargs = {}
+        if self.StartTime is not None:
+          kwargs['StartTime'] = self.StartTime
+        if self.EndTime is not None:
+          kwargs['EndTime'] = self.EndTime
+
         iterator = cp.paginate(
           LookupAttributes=LookupAttributes, 
-          #StartTime=StartTime, 
-          PaginationConfig=PaginationConfig
+          PaginationConfig=PaginationConfig,
+          **kwargs
         )
         return iterator
 
@@ -89,17 +131,29 @@ class EventIterator:
       iter_wrap = self.iterate_page()
       # Update 2019-11-22 moved this tqdm to the region level since it's already super fast per event
       #iter_wrap = tqdm(iter_wrap, desc="Cloudtrail events for %s/%s"%(self.region_name, self.eventName))
-      for response in iter_wrap:
+      for response in self._rate_limited(iter_wrap):
         #with open('t2.json','w') as fh:
         #  json.dump(response, fh, default=json_serial)
 
         # print(response.keys())
         for event in response['Events']:
+          if 'EventTime' in event:
+            if self.cursor is None or event['EventTime'] > self.cursor:
+              self.cursor = event['EventTime']
+
           result = self._handleEvent(event)
           if result is None: continue
           yield result
 
 
+    def _rate_limited(self, iter_wrap):
+      """
+      Update 2020-02 Acquire a token before each page is requested, i.e. before the first page and after each page with a NextToken
+      """
+      from isitfit.utils import rate_limited_pages
+      return rate_limited_pages(iter_wrap, self.bucket)
+
+
     def _handleEvent(self, event):
         # raise Exception("Implement by derived classes")
         return event
@@ -134,13 +188,13 @@ class RedshiftCreate(EventIterator):
             logger.debug("No CloudTrailEvent key in event. Skipping")
             return None # ignore this situation
 
-          ce_dict = json.loads(event['CloudTrailEvent'])
-
-          import jmespath
-          nodeType = jmespath.search('requestParameters.nodeType', ce_dict)
-          numberOfNodes = jmespath.search('requestParameters.numberOfNodes', ce_dict)
+          # Update 2020-02 only decode the subtrees needed, with the jmespath expressions compiled once
+          rp_dict = loads_subtree(event['CloudTrailEvent'], 'requestParameters')
+          nodeType = search('nodeType', rp_dict)
+          numberOfNodes = search('numberOfNodes', rp_dict)
           if numberOfNodes is None:
-            numberOfNodes = jmespath.search('responseElements.numberOfNodes', ce_dict)
+            re_dict = loads_subtree(event['CloudTrailEvent'], 'responseElements')
+            numberOfNodes = search('numberOfNodes', re_dict)
 
           if nodeType is None:
             logger.debug("No nodeType key in event['CloudTrailEvent']['requestParameters']. Skipping")
@@ -200,17 +254,18 @@ class Ec2Run(EventIterator):
             logger.debug("No CloudTrailEvent key in event. Skipping")
             return None # ignore this situation
 
-          ce_dict = json.loads(event['CloudTrailEvent'])
+          # Update 2020-02 only decode the requestParameters subtree, skipping the large responseElements of RunInstances
+          rp_dict = loads_subtree(event['CloudTrailEvent'], 'requestParameters')
 
-          if 'requestParameters' not in ce_dict:
+          if rp_dict is None:
             logger.debug("No requestParameters key in event['CloudTrailEvent']. Skipping")
             return None # ignore this situation
 
-          if 'instanceType' not in ce_dict['requestParameters']:
+          if 'instanceType' not in rp_dict:
             logger.debug("No instanceType key in event['CloudTrailEvent']['requestParameters']. Skipping")
             return None # ignore this situation
 
-          newType = ce_dict['requestParameters']['instanceType']
+          newType = rp_dict['instanceType']
 
           if 'EventTime' not in event:
             logger.debug("No EventTime key in event. Skipping")
@@ -240,13 +295,12 @@ class Ec2Modify(EventIterator):
             logger.debug("No CloudTrailEvent key in event. Skipping")
             return None # ignore this situation
 
-          ce_dict = json.loads(event['CloudTrailEvent'])
+          # Update 2020-02 only decode the requestParameters subtree
+          rp_dict = loads_subtree(event['CloudTrailEvent'], 'requestParameters')
 
-          if 'requestParameters' not in ce_dict:
+          if rp_dict is None:
             logger.debug("No requestParameters key in event['CloudTrailEvent']. Skipping")
             return None # ignore this situation
-
-          rp_dict = ce_dict['requestParameters']
           newType = None
 
           #newType = jmespath.search('instanceType', rp_dict)
@@ -292,17 +346,15 @@ class RedshiftResize(EventIterator):
             logger.debug("No CloudTrailEvent key in event. Skipping")
             return None # ignore this situation
 
-          ce_dict = json.loads(event['CloudTrailEvent'])
+          # Update 2020-02 only decode the requestParameters subtree
+          rp_dict = loads_subtree(event['CloudTrailEvent'], 'requestParameters')
 
-          if 'requestParameters' not in ce_dict:
+          if rp_dict is None:
             logger.debug("No requestParameters key in event['CloudTrailEvent']. Skipping")
             return None # ignore this situation
 
-          rp_dict = ce_dict['requestParameters']
-
-          import jmespath
-          nodeType = jmespath.search('instanceType', rp_dict)
-          numberOfNodes = jmespath.search('numberOfNodes', rp_dict)
+          nodeType = search('instanceType', rp_dict)
+          numberOfNodes = search('numberOfNodes', rp_dict)
 
           ts_obj = event['EventTime']
           # ts_obj = dt.datetime.utcfromtimestamp(ts_int)
@@ -325,35 +377,26 @@ class RedshiftResize(EventIterator):
 import pandas as pd
 
 class EventAggregatorOneRegion:
-    def get(self):
-        from termcolor import colored
-        import botocore
-        import sys
+    # Update 2020-02 one iterator per eventName
+    iterator_classes = [Ec2Run, Ec2Modify, RedshiftCreate, RedshiftResize]
 
-        def run_iterator(man2_i):
-          try:
-            r_i = list(man2_i.iterate_event())
-          except botocore.exceptions.ClientError as e:
-            # display error message without the frightening traceback
-            from isitfit.cli.click_descendents import IsitfitCliError
-            raise IsitfitCliError(str(e))
+    # TokenBucket shared by all the LookupEvents calls, or None for no limit
+    bucket = None
 
-          return r_i
+    # Update 2020-02 start of the ndays window of the analysis, or None to fetch the whole 90 days of cloudtrail
+    StartTime = None
 
-        man2_ec2run = Ec2Run()
-        r_ec2run = run_iterator(man2_ec2run)
-        
-        man2_ec2mod = Ec2Modify()
-        r_ec2mod = run_iterator(man2_ec2mod)
-       
-        man2_rscre = RedshiftCreate()
-        r_rscre = run_iterator(man2_rscre)
+    def get(self):
+        # events of the region of the default boto3 session
+        r_all = []
+        for iterator_class in self.iterator_classes:
+          r_all += self.get_events(iterator_class)
+
+        return self.events2df(r_all)
 
-        man2_rsmod = RedshiftResize()
-        r_rsmod = run_iterator(man2_rsmod)
 
+    def events2df(self, r_all):
         # split on instance ID and gather
-        r_all = r_ec2run + r_ec2mod + r_rscre + r_rsmod
         # logging.error(r_all)
         df = pd.DataFrame(r_all)
 
@@ -366,29 +409,103 @@ class EventAggregatorOneRegion:
         return df
 
 
+    def get_fetchStart(self):
+        """
+        Update 2020-02 Start of the events to fetch for the ndays window, or None to fetch the whole 90 days.
+        With the semantics of utils.mergeSeriesOnTimestampRange, the size at a timestamp is that of the first event at or after it,
+        so the events before the window do not matter, except for those in the day of the window start,
+        since the metrics are daily rows at midnight
+        """
+        if self.StartTime is None:
+          return None
+
+        fetch_start = self.StartTime - dt.timedelta(days=CLOUDTRAIL_WINDOW_LOOKBACK)
+        if fetch_start <= dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=CLOUDTRAIL_MAXDAYS):
+          return None
+
+        return fetch_start
+
+
+    def get_events(self, iterator_class, region_name=None, client=None):
+        """
+        List of the events of iterator_class, as returned by its _handleEvent
+        region_name, client - region and its cloudtrail client, or None for the default boto3 session
+        """
+        return self.run_iterator(iterator_class(StartTime=self.get_fetchStart(), client=client, bucket=self.bucket))
+
+
+    def run_iterator(self, man2_i):
+        import botocore
+
+        try:
+          r_i = list(man2_i.iterate_event())
+        except botocore.exceptions.ClientError as e:
+          # display error message without the frightening traceback
+          from isitfit.cli.click_descendents import IsitfitCliError
+          raise IsitfitCliError(str(e))
+
+        return r_i
+
+
 
 class EventAggregatorAllRegions(EventAggregatorOneRegion):
-    def __init__(self, region_include, tqdmman):
+    # Update 2020-02 number of LookupEvents paginations running concurrently
+    max_workers = 8
+
+    def __init__(self, region_include, tqdmman, bucket=None):
+      """
+      bucket - TokenBucket of an overall budget of API calls (optional), eg of `isitfit cache warm`
+      """
       self.region_include = region_include
       self.tqdmman = tqdmman
 
+      # Update 2020-02 cloudtrail limits LookupEvents to 2 requests per second, so share a token bucket between the concurrent paginations
+      from isitfit.utils import TokenBucket
+      self.bucket = TokenBucket(CLOUDTRAIL_LOOKUP_RATE, parent=bucket)
+
+
+    def _get_client(self, region_name):
+      """
+      Cloudtrail client of a region, from its own boto3 session since the default session is not thread-safe
+      """
+      from botocore.config import Config
+      session = boto3.session.Session(region_name = region_name)
+      return session.client('cloudtrail', config=Config(retries={'max_attempts': 10}))
+
+
     def get(self):
         # get cloudtrail ec2 type changes for all instances
         logger.debug("Downloading cloudtrail data (from %i regions)"%len(self.region_include))
         df_2 = []
-        import boto3
 
         # add some spaces for aligning the progress bars
         desc="Cloudtrail events in all regions"
         desc = "%-50s"%desc
 
-        iter_wrap = self.region_include
-        iter_wrap = self.tqdmman(iter_wrap, desc=desc, total=len(self.region_include))
-        for region_name in iter_wrap:
-          boto3.setup_default_session(region_name = region_name)
-          df_1 = super().get()
-          df_1['Region'] = region_name # bugfix, field name was "region" (lower-case)
-          df_2.append(df_1.reset_index())
+        # Update 2020-02 Run the paginations of all regions and event names concurrently, with a cloudtrail client per region,
+        # instead of one after the other with boto3.setup_default_session
+        client_d = {region_name: self._get_client(region_name) for region_name in self.region_include}
+
+        from concurrent.futures import ThreadPoolExecutor
+        n_workers = max(1, min(self.max_workers, len(self.region_include)*len(self.iterator_classes)))
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+          future_d = {
+            (region_name, iterator_class): executor.submit(self.get_events, iterator_class, region_name, client_d[region_name])
+            for region_name in self.region_include
+            for iterator_class in self.iterator_classes
+          }
+
+          # gather in the order of the regions, i.e. the progress bar shows the regions that are done
+          iter_wrap = self.region_include
+          iter_wrap = self.tqdmman(iter_wrap, desc=desc, total=len(self.region_include))
+          for region_name in iter_wrap:
+            r_all = []
+            for iterator_class in self.iterator_classes:
+              r_all += future_d[(region_name, iterator_class)].result()
+
+            df_1 = self.events2df(r_all)
+            df_1['Region'] = region_name # bugfix, field name was "region" (lower-case)
+            df_2.append(df_1.reset_index())
 
         # concatenate
         df_3 = pd.concat(df_2, axis=0, sort=False)
@@ -406,38 +523,138 @@ class EventAggregatorAllRegions(EventAggregatorOneRegion):
 
 
 class EventAggregatorCached(EventAggregatorAllRegions):
-    cache_key = "cloudtrail_ec2type._fetch"
-
-    def __init__(self, region_include, tqdmman, cache_man):
-        super().__init__(region_include, tqdmman)
+    """
+    Update 2020-02 Cache the events per profile, region, and eventName, with the latest EventTime seen as a cursor.
+    A cached history older than CLOUDTRAIL_CACHE_REFRESH is completed by fetching only the events after the cursor,
+    instead of fetching all the 90 days again.
+    The start of the fetched events is tracked too, so that a history fetched for a smaller ndays window
+    is completed backwards for a larger one
+    """
+    cache_prefix = "cloudtrail"
+
+    def __init__(self, region_include, tqdmman, cache_man, bucket=None):
+        super().__init__(region_include, tqdmman, bucket)
         self.cache_man = cache_man
 
 
-    def get(self):
-        # get cloudtrail ec2 type changes for all instances
+    def get_key(self, region_name, eventName):
+        profile_name = boto3.session.Session().profile_name
+        return "%s:%s:%s:%s"%(self.cache_prefix, profile_name, region_name, eventName)
+
+
+    def get_keys(self):
+        return [self.get_key(region_name, iterator_class.eventName) for region_name in self.region_include for iterator_class in self.iterator_classes]
+
 
-        # if not configured, just return
-        if self.cache_man is None:
-          df_fresh = super().get()
-          return df_fresh
+    def get_events(self, iterator_class, region_name=None, client=None):
+        # if not configured, just fetch
+        if self.cache_man is None or not self.cache_man.isReady():
+          return super().get_events(iterator_class, region_name, client)
+
+        if region_name is None:
+          region_name = boto3.session.Session().region_name
+
+        cache_key = self.get_key(region_name, iterator_class.eventName)
+        fetch_start = self.get_fetchStart()
 
         # check cache first
-        if self.cache_man.isReady():
-          df_cache = self.cache_man.get(self.cache_key)
-          if df_cache is not None:
-            logger.debug("Found cloudtrail data in redis cache")
-            return df_cache
+        # The cached value is a dict with the keys:
+        # - events: list
+        # - cursor: latest EventTime seen, or None
+        # - dt_refreshed: timestamp
+        # - covered_from: start of the fetched events, or None if all 90 days were fetched (missing in histories cached before this key was added)
+        history = self.cache_man.get(cache_key)
+        if history is None:
+          # if no cache, then download the window
+          events_fresh, cursor = self._fetch(iterator_class, client, fetch_start, None)
+          history = {'events': [], 'cursor': cursor, 'dt_refreshed': time.time(), 'covered_from': fetch_start}
+          return self._store(cache_key, history, events_fresh)
+
+        is_fresh = history['dt_refreshed'] > time.time() - CLOUDTRAIL_CACHE_REFRESH
+        covered_from = history.get('covered_from', None)
+        is_covered = covered_from is None or (fetch_start is not None and covered_from <= fetch_start)
+        if is_fresh and is_covered:
+          logger.debug("Found cloudtrail data in cache for %s"%cache_key)
+          return history['events']
+
+        history = dict(history, covered_from=covered_from)
+        events_fresh = []
+        if not is_covered:
+          # the window starts before the cached events, eg a larger ndays than in the previous run, so complete the cache backwards
+          events_back, cursor = self._fetch(iterator_class, client, fetch_start, covered_from)
+          events_fresh += events_back
+          history['cursor'] = max_none(history['cursor'], cursor)
+          history['covered_from'] = fetch_start
+
+        if not is_fresh:
+          # only the events after the cursor, or after the start of the cached events if none
+          # Note that LookupEvents' StartTime is inclusive and that cloudtrail can deliver events a few minutes late,
+          # so the fetch starts a bit before the cursor and the events fetched again are dropped
+          StartTime = covered_from
+          if history['cursor'] is not None:
+            StartTime = history['cursor'] - dt.timedelta(seconds=CLOUDTRAIL_CURSOR_LAG)
+
+          history['dt_refreshed'] = time.time()
+          events_after, cursor = self._fetch(iterator_class, client, StartTime, None)
+          events_fresh += events_after
+          history['cursor'] = max_none(history['cursor'], cursor)
+
+        return self._store(cache_key, history, events_fresh)
+
+
+    def _fetch(self, iterator_class, client, StartTime, EndTime):
+        """
+        Returns (list of events, latest EventTime seen or None)
+        """
+        man2_i = iterator_class(StartTime=StartTime, EndTime=EndTime, client=client, bucket=self.bucket)
+        events_fresh = self.run_iterator(man2_i)
+        logger.debug("Fetched %i cloudtrail %s events between %s and %s"%(len(events_fresh), iterator_class.eventName, StartTime, EndTime))
+        return events_fresh, man2_i.cursor
 
-        # if no cache, then download
-        df_fresh = super().get()
 
-        # if caching enabled, store it for later fetching
-        # https://stackoverflow.com/a/57986261/4126114
-        if self.cache_man.isReady():
-          self.cache_man.set(self.cache_key, df_fresh)
+    def _store(self, cache_key, history, events_fresh):
+        """
+        Append the fetched events to the history, store it in the cache, and return its events
+        """
+        history['events'] = history_append(history['events'], events_fresh)
+
+        # fetching back to the oldest available events is the same as fetching all 90 days
+        dt_cutoff = dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=CLOUDTRAIL_MAXDAYS)
+        if history['covered_from'] is not None and history['covered_from'] <= dt_cutoff:
+          history['covered_from'] = None
+
+        # store it for later fetching
+        self.cache_man.set(cache_key, history, ex=CLOUDTRAIL_CACHE_TTL)
 
         # done
-        return df_fresh
+        return history['events']
+
+
+
+def max_none(a, b):
+    if a is None: return b
+    if b is None: return a
+    return max(a, b)
+
+
+def history_append(events_cache, events_fresh):
+    """
+    Append the fresh events to the cached events, skipping the duplicates,
+    and drop the events older than CLOUDTRAIL_MAXDAYS
+    """
+    def event2tuple(event):
+      return tuple((k, event[k]) for k in sorted(event.keys()))
+
+    seen = set([event2tuple(event) for event in events_cache])
+    events_all = list(events_cache)
+    for event in events_fresh:
+      event_t = event2tuple(event)
+      if event_t in seen: continue
+      seen.add(event_t)
+      events_all.append(event)
+
+    dt_cutoff = dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=CLOUDTRAIL_MAXDAYS)
+    return [event for event in events_all if event['EventTime'] >= dt_cutoff]
 
 
 
@@ -452,10 +669,13 @@ def dict2service(ec2_dict):
 
 
 class EventAggregatorPostprocessed(EventAggregatorCached):
-    def __init__(self, region_include, tqdmman, cache_man, EndTime):
+    def __init__(self, region_include, tqdmman, cache_man, EndTime, StartTime=None):
         super().__init__(region_include, tqdmman, cache_man)
         self.EndTime = EndTime
 
+        # Update 2020-02 only fetch the events of the ndays window, check get_fetchStart
+        self.StartTime = StartTime
+
 
     def get(self, ec2_instances, n_ec2):
         self.df_cloudtrail = super().get()
@@ -471,8 +691,12 @@ class EventAggregatorPostprocessed(EventAggregatorCached):
         # First pass through EC2 instances: 101it [00:05,  5.19it/s]
         t_iter = ec2_instances
         t_iter = self.tqdmman(t_iter, total=n_ec2, desc=desc, initial=0)
+        # Update 2020-02 collect the "now" rows and concatenate them once, instead of a pd.concat per resource (quadratic in the number of resources)
+        now_l = []
         for ec2_dict, ec2_id, ec2_launchtime, ec2_obj in t_iter:
-            self._appendNow(ec2_dict, ec2_id)
+            now_l.append(self._appendNow(ec2_dict, ec2_id))
+
+        self._concatNow(now_l)
 
         # if still no data, just return
         if self.df_cloudtrail.shape[0]==0:
@@ -490,22 +714,32 @@ class EventAggregatorPostprocessed(EventAggregatorCached):
         # artificially append an entry for "now" with the current type
         # This is useful for instance who have no entries in the cloudtrail
         # so that their type still shows up on merge
+        # Update 2020-02 returns the row, which is appended to df_cloudtrail in _concatNow
 
         ec2_dict['ServiceName'] = dict2service(ec2_dict)
 
         size1_key = 'NodeType' if ec2_dict['ServiceName']=='Redshift' else 'InstanceType'
         size2_val = ec2_dict['NumberOfNodes'] if ec2_dict['ServiceName']=='Redshift' else None
 
-        df_new = pd.DataFrame([
-              {
-                'Region': ec2_dict['Region'],
-                'ServiceName': ec2_dict['ServiceName'],
-                'ResourceName': ec2_id,
-                'EventTime': self.EndTime,
-                'ResourceSize1': ec2_dict[size1_key],
-                'ResourceSize2': size2_val
-              }
-            ])
+        return (ec2_dict['Region'], ec2_dict['ServiceName'], ec2_id, ec2_dict[size1_key], size2_val)
 
-        self.df_cloudtrail = pd.concat([self.df_cloudtrail, df_new], sort=True)
 
+    def _concatNow(self, now_l):
+        """
+        Append the rows returned by _appendNow to df_cloudtrail, in a single pd.concat
+        """
+        if len(now_l)==0:
+          return
+
+        region_l, service_l, id_l, size1_l, size2_l = zip(*now_l)
+        df_new = pd.DataFrame({
+                'Region': list(region_l),
+                'ServiceName': list(service_l),
+                'ResourceName': list(id_l),
+                'EventTime': [self.EndTime]*len(now_l),
+                'ResourceSize1': list(size1_l),
+                # keep None instead of converting to NaN, same as the one-row dataframes that used to be appended per resource
+                'ResourceSize2': pd.Series(list(size2_l), dtype=object),
+              })
+
+        self.df_cloudtrail = pd.concat([self.df_cloudtrail, df_new], sort=True)
@@ -0,0 +1,71 @@
+"""
+Parsing of the CloudTrailEvent field of the events returned by cloudtrail LookupEvents
+
+Update 2020-02 The CloudTrailEvent field is the JSON string of the whole API call, of which the iterators in cloudtrail_iterator.py
+only need a few fields of the requestParameters/responseElements subtrees.
+Only the needed subtree is decoded, with json.JSONDecoder.raw_decode, skipping eg the large responseElements of RunInstances.
+This is faster than decoding the whole event even with orjson.
+If the subtree cannot be located, the whole event is decoded, with orjson if installed (pip install isitfit[speedups]).
+The jmespath expressions are compiled once instead of at each jmespath.search call
+"""
+
+import functools
+import json
+import re
+
+from isitfit.utils import logger
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+
+# stdlib decoder, for raw_decode
+_decoder = json.JSONDecoder()
+
+# whitespace between a key and its value
+_whitespace = re.compile(r'\s*')
+
+
+def _loads_full(ct_str, key):
+  ce_dict = orjson.loads(ct_str) if orjson is not None else json.loads(ct_str)
+  return ce_dict.get(key, None)
+
+
+def loads_subtree(ct_str, key):
+  """
+  Returns the value of a top-level key of the CloudTrailEvent JSON string, or None if missing.
+  The value is decoded from the first occurrence of the key, which is assumed to be at the top level
+  (true of the requestParameters and responseElements keys of CloudTrailEvent)
+  """
+  key_str = '"%s"'%key
+  i_key = ct_str.find(key_str + ':')
+  if i_key == -1:
+    if key_str not in ct_str:
+      return None
+
+    # eg whitespace between the key and the colon
+    return _loads_full(ct_str, key)
+
+  i_value = _whitespace.match(ct_str, i_key + len(key_str) + 1).end()
+  try:
+    value, _ = _decoder.raw_decode(ct_str, i_value)
+  except ValueError as e:
+    logger.debug("Failed to decode %s of CloudTrailEvent, decoding the whole event: %s"%(key, str(e)))
+    return _loads_full(ct_str, key)
+
+  return value
+
+
+@functools.lru_cache(maxsize=None)
+def compile_expression(expression):
+  import jmespath
+  return jmespath.compile(expression)
+
+
+def search(expression, data):
+  """
+  Same as jmespath.search, with the expression compiled once
+  """
+  return compile_expression(expression).search(data)
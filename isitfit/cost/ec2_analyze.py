@@ -1,6 +1,28 @@
 from isitfit.utils import logger
 import pandas as pd
 
+
+class Ec2Record:
+  """
+  Lightweight replacement of the boto3 ec2.Instance resource,
+  built directly from an entry of the describe_instances paginator.
+  It exposes the attributes used by the listeners, without the extra DescribeInstances call per instance
+  that is needed to load a boto3 resource.
+  """
+  def __init__(self, ec2_dict):
+    self.instance_id = ec2_dict['InstanceId']
+    self.instance_type = ec2_dict.get('InstanceType', None)
+    self.launch_time = ec2_dict.get('LaunchTime', None)
+    self.region_name = ec2_dict['Region']
+
+    # similar to the boto3 resource, tags is None if the instance has no tags
+    self.tags = ec2_dict.get('Tags', None)
+
+  def __repr__(self):
+    return "Ec2Record(%s, %s)"%(self.region_name, self.instance_id)
+
+
+
 from isitfit.cost.base_iterator import BaseIterator
 class Ec2Iterator(BaseIterator):
   service_name = 'ec2'
@@ -12,40 +34,58 @@ class Ec2Iterator(BaseIterator):
   paginator_exception = 'AuthFailure'
   entry_keyId = 'InstanceId'
   entry_keyCreated = 'LaunchTime'
+  entry_keysTracked = ['State.Name', 'InstanceType']
+
+  # max number of instance IDs per DescribeInstances call in get_resources
+  resources_batchSize = 1000
 
   def __iter__(self):
-    # over-ride the __iter__ to get the ec2 resource object for the current code (backwards compatibility)
+    # over-ride the __iter__ to get the ec2 object for the current code (backwards compatibility)
 
     # method 1 for ec2
     # ec2_it = self.ec2_resource.instances.all()
     # return ec2_it
 
-    # boto3 ec2 and cloudwatch data
-    ec2_resource_all = {}
-    import boto3
-
     # TODO cannot use directly use the iterator exposed in "ec2_it"
     # because it would return the dataframes from Cloudwatch,
     # whereas in the cloudwatch data fetch here, the data gets cached to redis.
     # Once the redshift.iterator can cache to redis, then the cloudwatch part here
     # can also be dropped, as well as using the "ec2_it" iterator directly
     # for ec2_dict in self.ec2_it:
+    # Update 2020-02 Instead of calling ec2_resource.instances.filter(InstanceIds=[...]) for each instance,
+    # which is a 2nd DescribeInstances call per instance and the main source of throttling on large accounts,
+    # build the ec2 object from the dict that was already returned by the paginator.
+    # For code that still needs the boto3 resource, check get_resources below
     for ec2_dict, ec2_id, ec2_launchtime, _ in super().__iter__():
-      if ec2_dict['Region'] not in ec2_resource_all.keys():
-        boto3.setup_default_session(region_name = ec2_dict['Region'])
-        ec2_resource_all[ec2_dict['Region']] = boto3.resource('ec2')
+      ec2_obj = Ec2Record(ec2_dict)
+      yield ec2_dict, ec2_id, ec2_launchtime, ec2_obj
 
-      ec2_resource_single = ec2_resource_all[ec2_dict['Region']]
-      ec2_l = ec2_resource_single.instances.filter(InstanceIds=[ec2_dict['InstanceId']])
-      ec2_l = list(ec2_l)
-      if len(ec2_l)==0:
-        continue # not found
 
-      # yield first entry
-      ec2_obj = ec2_l[0]
-      ec2_obj.region_name = ec2_dict['Region']
+  def get_resources(self, ec2_records):
+    """
+    Get the boto3 ec2.Instance resources for a list of Ec2Record objects.
+    Instances are fetched in batches of up to resources_batchSize IDs per region,
+    instead of one DescribeInstances call per instance.
 
-      yield ec2_dict, ec2_id, ec2_launchtime, ec2_obj
+    Returns a dict mapping instance ID to boto3 resource. Instances not found are skipped.
+    """
+    # group by region
+    id_by_region = {}
+    for ec2_obj in ec2_records:
+      id_by_region.setdefault(ec2_obj.region_name, []).append(ec2_obj.instance_id)
+
+    import boto3
+    res_all = {}
+    for region_name, id_all in id_by_region.items():
+      ec2_resource = boto3.session.Session(region_name = region_name).resource('ec2')
+      for i in range(0, len(id_all), self.resources_batchSize):
+        id_batch = id_all[i:(i+self.resources_batchSize)]
+        for ec2_res in ec2_resource.instances.filter(InstanceIds=id_batch):
+          # for backwards compatibility with the code that used to set this
+          ec2_res.region_name = region_name
+          res_all[ec2_res.instance_id] = ec2_res
+
+    return res_all
 
 
 
@@ -88,7 +128,7 @@ class CalculatorAnalyzeEc2:
   def per_ec2(self, context_ec2):
     """
     Listener function to be called upon the download of each EC2 instance's data
-    ec2_obj - boto3 resource
+    ec2_obj - Ec2Record (lightweight replacement of the boto3 resource)
     ec2_df - pandas dataframe with data from cloudwatch or datadog + cloudtrail + ec2instances.info catalog
     mm - mainManager class
     """
@@ -574,14 +614,15 @@ def pipeline_factory(ctx, filter_tags, save_details):
 
     mm = MainManager("EC2 cost analyze", ctx)
     mm.set_ndays(ctx.obj['ndays'])
+    mm.set_workers(ctx.obj.get('workers', 1))
 
     # The allow_ec2_different_family is set to False because the "_smaller" fields are not used in "isitfit cost analyze"
     ec2_cat = Ec2Catalog(False)
     ec2_common = Ec2Common()
-    ec2_it = Ec2Iterator(ctx.obj['filter_region'], tqdml2_obj)
+    ec2_it = Ec2Iterator(ctx.obj['filter_region'], tqdml2_obj, ctx.obj.get('inventory', None))
 
     # boto3 cloudtrail data
-    cloudtrail_manager = CloudtrailCached(mm.EndTime, cache_man, tqdml2_obj)
+    cloudtrail_manager = CloudtrailCached(mm.EndTime, cache_man, tqdml2_obj, mm.StartTime)
 
     # update dict and return it
     # https://stackoverflow.com/a/1453013/4126114
@@ -598,12 +639,14 @@ def pipeline_factory(ctx, filter_tags, save_details):
     mm.add_listener('pre', ec2_cat.handle_pre)
     mm.add_listener('pre', ul.handle_pre)
     mm.add_listener('pre', bcs.handle_pre)
+    mm.add_listener('pre', metrics.handle_pre)
     mm.add_listener('ec2', etf.per_ec2)
     mm.add_listener('ec2', metrics.per_host)
     mm.add_listener('ec2', cloudtrail_manager.single)
     mm.add_listener('ec2', ec2_common._handle_ec2obj)
-    mm.add_listener('ec2', ul.per_ec2)
-    mm.add_listener('ec2', bcs.per_ec2)
+    mm.add_listener('ec2', ul.per_ec2, ordered=True)
+    mm.add_listener('ec2', bcs.per_ec2, ordered=True)
+    mm.add_listener('all', cache_man.handle_all)
     mm.add_listener('all', metrics.display_status)
     mm.add_listener('all', ec2_common.after_all)
     mm.add_listener('all', ul.after_all)
@@ -1,7 +1,7 @@
 from isitfit.utils import logger
 
 
-from isitfit.utils import mergeSeriesOnTimestampRange
+from isitfit.utils import mergeHistoryOnTimestampRange
 
 
 class Ec2Common:
@@ -15,8 +15,8 @@ class Ec2Common:
         df_metrics = context_ec2['df_metrics']
 
         # pandas series of number of cpu's available on the machine over time, past 90 days
-        df_type_ts1 = context_ec2['df_type_ts1']
-        df_type_ts1 = df_type_ts1.rename(columns={'ResourceSize1': 'instanceType'})
+        # Update 2020-02 arrays of the cloudtrail history instead of a dataframe, check CloudtrailCached.single
+        event_time, _, size1, _ = context_ec2['type_history']
 
         # this is redundant with the implementation in _cloudwatch_metrics_core,
         # and it's here just in case the cached redis version is not a date,
@@ -29,7 +29,7 @@ class Ec2Common:
 
         # convert type timeseries to the same timeframes as pcpu and n5mn
         #if ec2_obj.instance_id=='i-069a7808addd143c7':
-        ec2_df = mergeSeriesOnTimestampRange(df_metrics, df_type_ts1, ['instanceType'])
+        ec2_df = mergeHistoryOnTimestampRange(df_metrics, event_time, {'instanceType': size1})
         #logger.debug("\nafter merge series on timestamp range")
         #logger.debug(ec2_df.head())
 
@@ -441,13 +441,14 @@ def pipeline_factory(ctx, n, filter_tags):
 
     mm = MainManager("EC2 cost optimize", ctx)
     mm.set_ndays(ctx.obj['ndays'])
+    mm.set_workers(ctx.obj.get('workers', 1))
 
     ec2_cat = Ec2Catalog(ctx.obj['allow_ec2_different_family'])
     ec2_common = Ec2Common()
-    ec2_it = Ec2Iterator(ctx.obj['filter_region'], tqdml2_obj)
+    ec2_it = Ec2Iterator(ctx.obj['filter_region'], tqdml2_obj, ctx.obj.get('inventory', None))
 
     # boto3 cloudtrail data
-    cloudtrail_manager = CloudtrailCached(mm.EndTime, cache_man, tqdml2_obj)
+    cloudtrail_manager = CloudtrailCached(mm.EndTime, cache_man, tqdml2_obj, mm.StartTime)
 
     # update dict and return it
     # https://stackoverflow.com/a/1453013/4126114
@@ -459,11 +460,13 @@ def pipeline_factory(ctx, n, filter_tags):
     mm.add_listener('pre', cloudtrail_manager.init_data)
     mm.add_listener('pre', ol.handle_pre)
     mm.add_listener('pre', ec2_cat.handle_pre)
+    mm.add_listener('pre', metrics.handle_pre)
     mm.add_listener('ec2', etf.per_ec2)
     mm.add_listener('ec2', metrics.per_host)
     mm.add_listener('ec2', cloudtrail_manager.single)
     mm.add_listener('ec2', ec2_common._handle_ec2obj)
-    mm.add_listener('ec2', ol.per_ec2)
+    mm.add_listener('ec2', ol.per_ec2, ordered=True)
+    mm.add_listener('all', cache_man.handle_all)
     mm.add_listener('all', metrics.display_status)
     mm.add_listener('all', ec2_common.after_all)
     mm.add_listener('all', inject_analyzer)
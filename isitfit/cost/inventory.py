@@ -0,0 +1,173 @@
+from isitfit.utils import logger
+
+
+class InventorySnapshot:
+  """
+  In-memory snapshot of the describe_* entries of the AWS resources (eg ec2 instances, redshift clusters)
+
+  It is filled once per run by BaseIterator.iterate_core, one list call per region,
+  and then replayed from memory by every consumer of the iterator, i.e.
+  - the 0th pass in MainManager.get_ifi that counts the resources
+  - the 1st pass in EventAggregatorPostprocessed.get (cloudtrail)
+  - the 2nd pass in MainManager.get_ifi (main loop of listeners)
+
+  The same object can be shared by the iterators of the EC2 and Redshift pipelines
+  since the entries are indexed by service and region.
+  """
+
+  def __init__(self):
+    # dict: service name -> dict: region name -> list of describe entries
+    self.entries = {}
+
+    # the regions are described concurrently from worker threads
+    import threading
+    self.lock = threading.Lock()
+
+
+  def has_region(self, service_name, region_name):
+    with self.lock:
+      return region_name in self.entries.get(service_name, {})
+
+
+  def set_region(self, service_name, region_name, region_entries):
+    logger.debug("Inventory snapshot: %i %s in %s"%(len(region_entries), service_name, region_name))
+    with self.lock:
+      self.entries.setdefault(service_name, {})[region_name] = region_entries
+
+
+  def get_region(self, service_name, region_name):
+    with self.lock:
+      return self.entries[service_name][region_name]
+
+
+  def count(self, service_name, region_name=None):
+    """
+    Number of entries of a service, in all regions or in a single region
+    """
+    with self.lock:
+      service_entries = self.entries.get(service_name, {})
+      if region_name is not None:
+        return len(service_entries.get(region_name, []))
+
+      return sum([len(v) for v in service_entries.values()])
+
+
+
+# default time-to-live of the on-disk inventory cache, over-ridable with the environment variable ISITFIT_INVENTORY_TTL (in seconds, 0 to disable)
+INVENTORY_TTL_DEFAULT = 60*10
+
+
+class InventoryCache:
+  """
+  On-disk cache of the inventory, keyed by profile, service and region.
+
+  Each region is saved with the time at which it was listed.
+  Regions whose entry is older than the TTL are considered expired, and are re-listed from AWS,
+  i.e. the refresh is incremental per region.
+  The expired entries are kept on disk a bit longer so that the re-listed region can be compared to them
+  to track resource state changes (new, removed, changed state/size).
+  """
+
+  def __init__(self, profile_name, service_name, entry_keyId, entry_keysTracked, ttl=None):
+    """
+    entry_keyId - key of the resource ID in the describe entry, eg InstanceId
+    entry_keysTracked - list of jmespath expressions of fields to track for changes, eg State.Name
+    ttl - time-to-live of a region in seconds. If None, read from ISITFIT_INVENTORY_TTL
+    """
+    import os
+    if ttl is None:
+      ttl = int(os.getenv("ISITFIT_INVENTORY_TTL", INVENTORY_TTL_DEFAULT))
+
+    self.ttl = ttl
+    self.service_name = service_name
+    self.entry_keyId = entry_keyId
+    self.entry_keysTracked = entry_keysTracked
+
+    # cache filename, similar to the one of BaseIterator._initCache
+    from isitfit.dotMan import DotMan
+    cache_filename = 'inventory_cache-%s-%s.pkl'%(profile_name, service_name)
+    cache_filename = os.path.join(DotMan().tempdir(), cache_filename)
+
+    from isitfit.cost.base_iterator import SimpleCacheMan
+    self.simpleCacheMan = SimpleCacheMan(filename=cache_filename, namespace="inventory")
+
+    # expired entries loaded from disk, for comparison upon saving the re-listed region
+    self.stale = {}
+
+    # list of changes detected upon saving re-listed regions
+    self.changes = []
+
+
+  def is_enabled(self):
+    return self.ttl > 0
+
+
+  def load(self, region_name):
+    """
+    Returns the list of cached describe entries if not expired, None otherwise
+    """
+    if not self.is_enabled():
+      return None
+
+    cached = self.simpleCacheMan.load_key(key=region_name)
+    if cached is None:
+      return None
+
+    import time
+    if time.time() - cached['dt_saved'] > self.ttl:
+      logger.debug("Inventory cache of %s in %s expired"%(self.service_name, region_name))
+      self.stale[region_name] = cached['entries']
+      return None
+
+    logger.debug("Loading %s in %s from inventory cache"%(self.service_name, region_name))
+    return cached['entries']
+
+
+  def save(self, region_name, region_entries):
+    if not self.is_enabled():
+      return
+
+    # track changes compared to the expired entry, if any
+    if region_name in self.stale:
+      self._diff(region_name, self.stale.pop(region_name), region_entries)
+
+    # keep the entry on disk for at least a day so that it's still available for the diff after it expires
+    import time
+    from isitfit.utils import SECONDS_IN_ONE_DAY
+    cached = {'dt_saved': time.time(), 'entries': region_entries}
+    self.simpleCacheMan.save_key(key=region_name, value=cached, ttl=max(self.ttl, SECONDS_IN_ONE_DAY))
+
+
+  def _diff(self, region_name, entries_old, entries_new):
+    import jmespath
+    def to_dict(entries):
+      return {e[self.entry_keyId]: e for e in entries if self.entry_keyId in e}
+
+    def to_tracked(entry):
+      return {k: jmespath.search(k, entry) for k in self.entry_keysTracked}
+
+    d_old, d_new = to_dict(entries_old), to_dict(entries_new)
+    changes_region = []
+    for rc_id in sorted(d_new.keys() - d_old.keys()):
+      changes_region.append({'change': 'new', 'old': None, 'new': to_tracked(d_new[rc_id]), 'id': rc_id})
+
+    for rc_id in sorted(d_old.keys() - d_new.keys()):
+      changes_region.append({'change': 'removed', 'old': to_tracked(d_old[rc_id]), 'new': None, 'id': rc_id})
+
+    for rc_id in sorted(d_new.keys() & d_old.keys()):
+      t_old, t_new = to_tracked(d_old[rc_id]), to_tracked(d_new[rc_id])
+      if t_old != t_new:
+        changes_region.append({'change': 'changed', 'old': t_old, 'new': t_new, 'id': rc_id})
+
+    if len(changes_region)==0:
+      return
+
+    for c in changes_region:
+      c.update({'service': self.service_name, 'region': region_name})
+      logger.debug("Inventory change: %s"%c)
+
+    n_by = {k: len([c for c in changes_region if c['change']==k]) for k in ['new', 'removed', 'changed']}
+    msg = "%s in %s since the cached inventory: %i new, %i removed, %i changed"
+    logger.info(msg%(self.service_name, region_name, n_by['new'], n_by['removed'], n_by['changed']))
+
+    self.changes += changes_region
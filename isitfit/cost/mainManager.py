@@ -36,6 +36,12 @@ class EventBus:
         # listeners post ec2 data fetch and post all activities
         self.listeners = {'pre':[], 'ec2': [], 'all': []}
 
+        # ec2 listeners that need to be called in the order of the resources, eg because they accumulate shared state
+        self.listeners_ordered = []
+
+        # number of worker threads for the ec2 listeners, 1 means sequential
+        self.n_workers = 1
+
         # click context for errors
         self.ctx = ctx
 
@@ -55,7 +61,16 @@ class EventBus:
         self.ec2_it = ec2_it
 
 
-    def add_listener(self, event, listener):
+    def set_workers(self, n_workers):
+        self.n_workers = n_workers
+
+
+    def add_listener(self, event, listener, ordered=False):
+      """
+      ordered - for ec2 listeners with shared state, eg summing capacity over resources.
+                With multiple workers, this listener and all the ones after it in the chain
+                are called from the main thread, one resource at a time, in the order of the iterator
+      """
       if event not in self.listeners:
         from isitfit.cli.click_descendents import IsitfitCliError
         err_msg = "Internal dev error: Event %s is not supported for listeners. Use: %s"%(event, ",".join(self.listeners.keys()))
@@ -63,6 +78,9 @@ class EventBus:
 
       self.listeners[event].append(listener)
 
+      if ordered:
+        self.listeners_ordered.append(listener)
+
 
     def get_ifi(self, tqdml2_obj):
       raise Exception("Define in derived class")
@@ -71,6 +89,88 @@ class EventBus:
 
 class MainManager(EventBus):
 
+    def _split_listeners(self):
+        """
+        Split the ec2 listeners into the part that can run concurrently for several resources (map)
+        and the part starting at the first ordered listener (reduce)
+        """
+        l_ec2 = self.listeners['ec2']
+        i_split = len(l_ec2)
+        for i, l in enumerate(l_ec2):
+          if l in self.listeners_ordered:
+            i_split = i
+            break
+
+        return l_ec2[:i_split], l_ec2[i_split:]
+
+
+    def _run_listeners(self, listener_l, context_ec2):
+        # Listener can return None to break out of loop,
+        # i.e. to stop processing with other listeners
+        for l in listener_l:
+          ec2_id = context_ec2['ec2_id']
+          context_ec2 = l(context_ec2)
+
+          # skip rest of listeners if one of them returned None
+          if context_ec2 is None:
+            logger.debug("Listener %s is breaking per_resource for resource %s"%(l, ec2_id))
+            return None
+
+        return context_ec2
+
+
+    def _iterate_map(self, ec2_it, context_pre, listeners_map):
+        """
+        Update 2020-02 Call the map part of the ec2 listeners, concurrently for several resources if n_workers > 1.
+        Most of the time in these listeners is I/O wait on cloudwatch, datadog, and boto3.
+
+        Yields (ec2_id, get_result) in the order of the iterator,
+        where get_result() returns the context after the map listeners (or None if the chain was broken),
+        or raises the exception raised by one of the listeners, eg NoCloudtrailException
+        """
+        def get_context(ec2_dict, ec2_id, ec2_launchtime, ec2_obj):
+          # context dict to be passed between listeners
+          context_ec2 = {}
+          context_ec2['mainManager'] = self
+          if 'df_cat' in context_pre: context_ec2['df_cat'] = context_pre['df_cat'] # copy object between contexts
+          context_ec2['ec2_dict'] = ec2_dict
+          context_ec2['ec2_id'] = ec2_id
+          context_ec2['ec2_launchtime'] = ec2_launchtime
+          context_ec2['ec2_obj'] = ec2_obj
+          return context_ec2
+
+        if self.n_workers <= 1:
+          # sequential: the listeners are called lazily by the caller
+          for ec2_args in ec2_it:
+            context_ec2 = get_context(*ec2_args)
+            yield ec2_args[1], (lambda c=context_ec2: self._run_listeners(listeners_map, c))
+
+          return
+
+        import collections
+        from concurrent.futures import ThreadPoolExecutor
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+          try:
+            for ec2_args in ec2_it:
+              context_ec2 = get_context(*ec2_args)
+              pending.append((ec2_args[1], executor.submit(self._run_listeners, listeners_map, context_ec2)))
+
+              # bound the number of resources in flight
+              if len(pending) >= 2*self.n_workers:
+                ec2_id, future = pending.popleft()
+                yield ec2_id, future.result
+
+            while len(pending) > 0:
+              ec2_id, future = pending.popleft()
+              yield ec2_id, future.result
+
+          finally:
+            # eg if the caller broke out of the loop, drop the resources that did not start yet
+            for _, future in pending:
+              future.cancel()
+
+
     def get_ifi(self, tqdml2_obj):
         # display name of runner
         logger.info(self.description)
@@ -108,30 +208,19 @@ class MainManager(EventBus):
         desc="Pass 2/2 through %s"%self.ec2_it.service_description
         desc = "%-50s"%desc
 
-        # Edit 2019-11-12 use "initial=0" instead of "=1". Check more details in a similar note in "cloudtrail_ec2type.py"
-        iter_wrap = tqdml2_obj(self.ec2_it, total=n_ec2_total, desc=desc, initial=0)
-        for ec2_dict, ec2_id, ec2_launchtime, ec2_obj in iter_wrap:
-
-          # context dict to be passed between listeners
-          context_ec2 = {}
-          context_ec2['mainManager'] = self
-          if 'df_cat' in context_pre: context_ec2['df_cat'] = context_pre['df_cat'] # copy object between contexts
-          context_ec2['ec2_dict'] = ec2_dict
-          context_ec2['ec2_id'] = ec2_id
-          context_ec2['ec2_launchtime'] = ec2_launchtime
-          context_ec2['ec2_obj'] = ec2_obj
+        # Update 2020-02 The map part of the listeners can run in worker threads,
+        # whereas the reduce part (ordered listeners) is always called here in the main thread
+        listeners_map, listeners_reduce = self._split_listeners()
 
+        # Edit 2019-11-12 use "initial=0" instead of "=1". Check more details in a similar note in "cloudtrail_ec2type.py"
+        # Update 2020-02 wrap the results instead of the resource iterator,
+        # so that the progress bar moves as each result is reduced, not as resources are submitted to the workers
+        iter_wrap = tqdml2_obj(self._iterate_map(self.ec2_it, context_pre, listeners_map), total=n_ec2_total, desc=desc, initial=0)
+        for ec2_id, get_result in iter_wrap:
           try:
-            # call listeners
-            # Listener can return None to break out of loop,
-            # i.e. to stop processing with other listeners
-            for l in self.listeners['ec2']:
-              context_ec2 = l(context_ec2)
-
-              # skip rest of listeners if one of them returned None
-              if context_ec2 is None:
-                logger.debug("Listener %s is breaking per_resource for resource %s"%(l, ec2_id))
-                break
+            context_ec2 = get_result()
+            if context_ec2 is not None:
+              self._run_listeners(listeners_reduce, context_ec2)
 
           except NoCloudtrailException:
             ec2_noCloudtrail.append(ec2_id)
@@ -26,8 +26,15 @@ class MetricsAuto:
     if not self.datadog.is_configured():
       return None, "not configured"
 
+    # Update 2020-02 skip the hosts known to be missing from datadog, i.e. without any network call
+    entry = self.datadog.get_known_missing(aws_id)
+    if entry is not None:
+      logger.debug("Datadog: %s known to be missing since %i misses: %s"%(aws_id, entry.miss_count, entry.reason))
+      return None, "host not found" if entry.reason == 'HostNotFoundInDdg' else "no data"
+
     try:
-      df_ddg = self.datadog.get_metrics_all(aws_id)
+      # Update 2020-02 use get_metrics_derived instead of get_metrics_all to go through the cache
+      df_ddg = self.datadog.get_metrics_derived(None, aws_id, None)
       return df_ddg, "ok"
     except HostNotFoundInDdg as e:
       logger.debug("Datadog: host not found for aws ID %s: %s"%(aws_id, str(e)))
@@ -39,7 +46,8 @@ class MetricsAuto:
 
   def _try_cloudwatch(self, host_id, host_region, host_created):
     try:
-      df_cw  = self.cloudwatch.handle_main({'Region': host_region}, host_id, host_created)
+      # Update 2020-02 use get_metrics_derived instead of handle_main to go through the cache
+      df_cw  = self.cloudwatch.get_metrics_derived({'Region': host_region}, host_id, host_created)
       return df_cw, "ok"
     except NoCloudwatchException:
       logger.debug("Cloudwatch: data not found for %s"%host_id)
@@ -123,6 +131,25 @@ class MetricsListener(MetricsAuto):
   """
   Listener for event bus defined in mainManager.py
   """
+  def handle_pre(self, context_pre):
+    # Update 2020-02 prefetch the metrics in batches, from datadog if configured, otherwise from cloudwatch.
+    # Cloudwatch is not prefetched if datadog is configured since it is then only a fallback for the hosts not found in datadog
+    if self.datadog.is_configured():
+      self.datadog.handle_pre(context_pre)
+
+      # Update 2020-02 the hosts known to be missing from datadog (negative cache entries) fall back to cloudwatch without any datadog call,
+      # so prefetch them from cloudwatch
+      ec2_missing = [entry for entry in context_pre['ec2_instances'] if self.datadog.get_known_missing(entry[1]) is not None]
+      if len(ec2_missing) > 0:
+        logger.debug("Prefetching cloudwatch metrics of %i hosts known to be missing from datadog"%len(ec2_missing))
+        context_missing = dict(context_pre)
+        context_missing['ec2_instances'] = ec2_missing
+        self.cloudwatch.handle_pre(context_missing)
+    else:
+      self.cloudwatch.handle_pre(context_pre)
+
+    return context_pre
+
   def per_host(self, context_host):
     host_id = context_host['ec2_id']
     host_region, host_created = None, None
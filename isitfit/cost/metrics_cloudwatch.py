@@ -12,6 +12,7 @@ def raise_noCwExc(rc_id):
 
 
 import numpy as np
+import threading
 
 
 class CloudwatchAssistant:
@@ -19,51 +20,41 @@ class CloudwatchAssistant:
   Manager for cloudwatch
   """
 
-  def __init__(self):
-    self.set_ndays(90) # default is 90 days
-
+  # max number of metric queries in a single GetMetricData call
+  # https://docs.aws.amazon.com/AmazonCloudWatch/latest/APIReference/API_GetMetricData.html
+  metricData_maxQueries = 500
 
-  def set_resource(self, region_name):
-        """
-        Easy-to-mock function since moto mock of cloudwatch is giving pagination error
-        """
-        boto3.setup_default_session(region_name = region_name)
-        self.cloudwatch_resource = boto3.resource('cloudwatch')
+  # daily statistics of the CPUUtilization metric
+  metricData_statistics = ['Minimum', 'Average', 'Maximum', 'SampleCount']
 
+  def __init__(self):
+    self.set_ndays(90) # default is 90 days
 
-  def id2iterator(self, rc_id, cloudwatch_namespace, entry_keyId):
-
-    if cloudwatch_namespace is None:
-      raise Exception("Derived class should set cloudwatch_namespace")
-
-    metrics_iterator = self.cloudwatch_resource.metrics.filter(
-        Namespace = cloudwatch_namespace,
-        MetricName = 'CPUUtilization',
-        Dimensions=[
-            {'Name': entry_keyId, 'Value': rc_id},
-        ]
-      )
-    return metrics_iterator
+    # dict: region name -> boto3 cloudwatch client
+    self.clients = {}
 
+    # dict: (region name, namespace) -> dict: resource ID -> dimensions of its CPUUtilization metric
+    self.metricIndex = {}
 
-  def iterator2metric(self, metrics_iterator, rc_id):
+    # Update 2020-02 TokenBucket to acquire before each cloudwatch call, or None for no limit, eg set by `isitfit cache warm`
+    self.bucket = None
 
-    #logger.debug("redshift cluster details")
-    #logger.debug(rc_describe_entry)
+    # dict: (region name, namespace) -> lock held while building the index of this key
+    self.metricIndex_locks = {}
 
-    for m_i in metrics_iterator:
+    # the clients and index are shared between threads
+    self.lock = threading.Lock()
 
-        # skip node stats for now, and focus on cluster stats
-        # i.e. dimensions only ClusterIdentifier, without the NodeID key
-        if len(m_i.dimensions)>1:
-          continue
 
-        # exit the for loop and return this particular metric (cluster)
-        return m_i
+  def get_client(self, region_name):
+    """
+    Cloudwatch client per region, with a session per region instead of the process-global boto3.setup_default_session
+    """
+    with self.lock:
+      if region_name not in self.clients:
+        self.clients[region_name] = boto3.session.Session(region_name=region_name).client('cloudwatch')
 
-    # in case no cluster metrics found
-    logger.debug("No cloudwatch metrics found for %s"%rc_id)
-    raise_noCwExc(rc_id)
+      return self.clients[region_name]
 
 
   def set_ndays(self, ndays):
@@ -82,34 +73,176 @@ class CloudwatchAssistant:
     self.EndTime = self.EndTime.replace(hour=23, minute=59, second=59)
 
 
-  def metric2stats(self, metric):
+  def span2times(self, span):
+    """
+    Update 2020-02 Convert a span of days (date start, date end) to the StartTime/EndTime of cloudwatch,
+    same hours/minutes/seconds as in set_ndays. If span is None, returns the ndays window
+    """
+    if span is None:
+      return self.StartTime, self.EndTime
+
+    d_start, d_end = span
+    StartTime = dt.datetime.combine(d_start, dt.time(hour=0, minute=0, second=0))
+    EndTime = dt.datetime.combine(d_end, dt.time(hour=23, minute=59, second=59))
+    return StartTime, EndTime
+
+
+  def metricIndex_get(self, region_name, cloudwatch_namespace, entry_keyId):
     """
+    Update 2020-02 Index of the CPUUtilization metrics of a region, built from a single paginated ListMetrics sweep,
+    instead of a ListMetrics call per resource.
+    Only the metrics with a single dimension are kept, eg ClusterIdentifier without NodeID, i.e. the cluster stats and not the node stats.
+
+    Returns dict: resource ID -> dimensions
+    """
+    if cloudwatch_namespace is None:
+      raise Exception("Derived class should set cloudwatch_namespace")
+
+    # Update 2020-02 a lock per (region, namespace) so that exactly one thread builds each index, and the others wait for it
+    index_key = (region_name, cloudwatch_namespace)
+    with self.lock:
+      lock_key = self.metricIndex_locks.setdefault(index_key, threading.Lock())
+
+    with lock_key:
+      if index_key not in self.metricIndex:
+        self.metricIndex[index_key] = self._metricIndex_build(region_name, cloudwatch_namespace, entry_keyId)
+
+      return self.metricIndex[index_key]
+
+
+  def _metricIndex_build(self, region_name, cloudwatch_namespace, entry_keyId):
+    logger.debug("Listing %s cloudwatch metrics in %s"%(cloudwatch_namespace, region_name))
+    paginator = self.get_client(region_name).get_paginator('list_metrics')
+    response_iterator = paginator.paginate(Namespace=cloudwatch_namespace, MetricName='CPUUtilization')
+    index_region = {}
+    from isitfit.utils import rate_limited_pages
+    for response in rate_limited_pages(response_iterator, self.bucket):
+      for metric in response['Metrics']:
+        if len(metric['Dimensions'])!=1:
+          continue
+
+        dim_single = metric['Dimensions'][0]
+        if dim_single['Name'] != entry_keyId:
+          continue
+
+        index_region[dim_single['Value']] = metric['Dimensions']
+
+    logger.debug("Found cloudwatch metrics for %i resources in %s"%(len(index_region), region_name))
+    return index_region
+
+
+  def id2dimensions(self, region_name, rc_id, cloudwatch_namespace, entry_keyId):
+    """
+    Dimensions of the CPUUtilization metric of a resource, from the index of metrics.
+    Raises NoCloudwatchException without any further network call if the resource has no metrics
+    """
+    index_region = self.metricIndex_get(region_name, cloudwatch_namespace, entry_keyId)
+    if rc_id not in index_region:
+      logger.debug("No cloudwatch metrics found for %s"%rc_id)
+      raise_noCwExc(rc_id)
+
+    return index_region[rc_id]
+
+
+  def dimensions2stats(self, region_name, cloudwatch_namespace, dimensions, span=None):
+    """
+    Daily CPU statistics of a single resource with GetMetricStatistics, given the dimensions from id2dimensions.
+
     For newly created instances, the Timestamp field is not reliable from here.
     It needs postprocessing by stats2df.
     For example, if today is 2019-12-17, an instance created today could return
     Timestamp=datetime.datetime(2019, 12, 13, 9, 0, tzinfo=tzutc())
     """
     logger.debug("fetch cw")
-    logger.debug(metric.dimensions)
-
-    # util func
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudwatch.html#CloudWatch.Metric.get_statistics
-    # https://docs.aws.amazon.com/redshift/latest/mgmt/metrics-listing.html
-    #
-    # Note for redshift cluster
-    # remember that max for redshift cluster = max of stats of all nodes
-    response = metric.get_statistics(
-        Dimensions=metric.dimensions,
-        StartTime=self.StartTime,
-        EndTime=self.EndTime,
+    logger.debug(dimensions)
+
+    StartTime, EndTime = self.span2times(span)
+    if self.bucket is not None:
+      self.bucket.acquire()
+
+    response = self.get_client(region_name).get_metric_statistics(
+        Namespace=cloudwatch_namespace,
+        MetricName='CPUUtilization',
+        Dimensions=dimensions,
+        StartTime=StartTime,
+        EndTime=EndTime,
         Period=SECONDS_IN_ONE_DAY,
-        Statistics=['Minimum', 'Average', 'Maximum', 'SampleCount'],
+        Statistics=self.metricData_statistics,
         Unit = 'Percent'
     )
     logger.debug(response)
     return response
 
 
+  def metricData_batch(self, region_name, rc_ids, cloudwatch_namespace, entry_keyId, span=None):
+    """
+    Update 2020-02 Fetch the daily CPU statistics of many resources of a region at once with GetMetricData,
+    instead of metrics.filter + metric.get_statistics per resource (at least 2 calls per resource).
+    Each resource requires 1 query per statistic, so up to 500/4 = 125 resources fit in a single call.
+
+    Returns dict: resource ID -> response in the same format as that of dimensions2stats, i.e. ready for stats2df.
+    Resources without data have an empty list of datapoints, for which stats2df raises NoCloudwatchException
+
+    span - (date start, date end) to fetch, or None for the ndays window
+    """
+    if cloudwatch_namespace is None:
+      raise Exception("Derived class should set cloudwatch_namespace")
+
+    stat_l = self.metricData_statistics
+    StartTime, EndTime = self.span2times(span)
+    batch_size = self.metricData_maxQueries // len(stat_l)
+
+    client = self.get_client(region_name)
+    paginator = client.get_paginator('get_metric_data')
+
+    # dict: resource ID -> dict: timestamp -> datapoint
+    datapoints = {rc_id: {} for rc_id in rc_ids}
+
+    for i_start in range(0, len(rc_ids), batch_size):
+      batch_ids = rc_ids[i_start:(i_start+batch_size)]
+      logger.debug("GetMetricData for %i resources in %s"%(len(batch_ids), region_name))
+
+      # query ID needs to start with a lower-case letter, so use the indeces of the resource and statistic
+      query_l = []
+      for i_id, rc_id in enumerate(batch_ids):
+        for i_stat, stat_name in enumerate(stat_l):
+          query_l.append({
+            'Id': 'm%i_%i'%(i_id, i_stat),
+            'MetricStat': {
+              'Metric': {
+                'Namespace': cloudwatch_namespace,
+                'MetricName': 'CPUUtilization',
+                'Dimensions': [{'Name': entry_keyId, 'Value': rc_id}],
+              },
+              'Period': SECONDS_IN_ONE_DAY,
+              'Stat': stat_name,
+              'Unit': 'Percent',
+            },
+            'ReturnData': True,
+          })
+
+      # the paginator follows the NextToken in case of partial data
+      response_iterator = paginator.paginate(
+        MetricDataQueries=query_l,
+        StartTime=StartTime,
+        EndTime=EndTime,
+        ScanBy='TimestampAscending'
+      )
+      from isitfit.utils import rate_limited_pages
+      for response in rate_limited_pages(response_iterator, self.bucket):
+        for result in response['MetricDataResults']:
+          i_id, i_stat = [int(x) for x in result['Id'][1:].split('_')]
+          dp_id = datapoints[batch_ids[i_id]]
+          for ts, value in zip(result['Timestamps'], result['Values']):
+            if ts not in dp_id:
+              dp_id[ts] = {'Timestamp': ts, 'Unit': 'Percent'}
+
+            dp_id[ts][stat_l[i_stat]] = value
+
+    # convert to the response format of get_statistics
+    return {rc_id: {'Datapoints': list(dp_id.values())} for rc_id, dp_id in datapoints.items()}
+
+
   def stats2df(self, response_metric, rc_id, ClusterCreateTime, cloudwatch_namespace):
     if len(response_metric['Datapoints'])==0:
       raise_noCwExc(rc_id)
@@ -191,12 +324,24 @@ class CloudwatchBase:
   cloudwatch_namespace = None
   entry_keyId = None
 
+  # Update 2020-02 `isitfit cache warm` calls handle_pre per chunk of resources, to bound the GetMetricData responses kept in memory
+  prefetch_once = False
+
   def __init__(self):
     self.assistant = CloudwatchAssistant()
 
+    # dict: resource ID -> dict: span -> response of GetMetricData, filled in handle_pre and consumed in handle_main
+    self.prefetched = {}
+
   def set_ndays(self, ndays):
     self.assistant.set_ndays(ndays)
 
+  def set_bucket(self, bucket):
+    """
+    Update 2020-02 TokenBucket to acquire before each cloudwatch call, eg the budget of `isitfit cache warm`
+    """
+    self.assistant.bucket = bucket
+
   @property
   def ndays(self):
     """
@@ -204,17 +349,64 @@ class CloudwatchBase:
     """
     return self.assistant.ndays
 
-  def handle_main(self, rc_describe_entry, rc_id, rc_created):
-    logger.debug("Fetching cloudwatch data for resource %s"%rc_id)
+  def get_window(self):
+    return self.assistant.StartTime.date(), self.assistant.EndTime.date()
 
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudwatch.html#metric
-    self.assistant.set_resource(region_name = rc_describe_entry['Region'])
-
-    metrics_iterator = self.assistant.id2iterator(rc_id, self.cloudwatch_namespace, self.entry_keyId)
+  def _prefetch_entries(self, context_pre):
+    """
+    List of (describe entry, resource ID, span of days) to prefetch in handle_pre
+    """
+    span = self.get_window()
+    return [(rc_describe_entry, rc_id, span) for rc_describe_entry, rc_id, _, _ in context_pre['ec2_instances']]
 
-    # filter for 1 metric
-    metric_single = self.assistant.iterator2metric(metrics_iterator, rc_id)
-    response = self.assistant.metric2stats(metric_single)
+  def handle_pre(self, context_pre):
+    """
+    Prefetch the metrics of all the resources with GetMetricData, batched per region.
+    Resources that are not prefetched (eg missing cloudwatch:GetMetricData permission) fall back to the per-resource calls in handle_main
+    """
+    # group resource IDs by region and span of days to fetch
+    region_ids = {}
+    for rc_describe_entry, rc_id, span in self._prefetch_entries(context_pre):
+      region_ids.setdefault((rc_describe_entry['Region'], span), []).append(rc_id)
+
+    from botocore.exceptions import ClientError
+    for (region_name, span), rc_ids in region_ids.items():
+      # Update 2020-02 skip the resources without metrics, which are then caught in handle_main without any network call
+      index_region = self.assistant.metricIndex_get(region_name, self.cloudwatch_namespace, self.entry_keyId)
+      rc_ids = [rc_id for rc_id in rc_ids if rc_id in index_region]
+      if len(rc_ids)==0:
+        continue
+
+      try:
+        response_d = self.assistant.metricData_batch(region_name, rc_ids, self.cloudwatch_namespace, self.entry_keyId, span)
+        for rc_id, response in response_d.items():
+          self.prefetched.setdefault(rc_id, {})[span] = response
+      except ClientError as e:
+        logger.debug("Failed to prefetch cloudwatch metrics in %s, will fetch per resource: %s"%(region_name, str(e)))
+
+    logger.debug("Prefetched cloudwatch metrics of %i resources"%len(self.prefetched))
+    return context_pre
+
+  def handle_main(self, rc_describe_entry, rc_id, rc_created, span=None):
+    """
+    span - (date start, date end) to fetch, or None for the ndays window
+    """
+    if span is None:
+      span = self.get_window()
+
+    span_d = self.prefetched.get(rc_id, {})
+    if span in span_d:
+      # pop to free the memory since each span of a resource is handled once
+      logger.debug("Using prefetched cloudwatch data for resource %s"%rc_id)
+      response = span_d.pop(span)
+      if len(span_d)==0: del self.prefetched[rc_id]
+    else:
+      logger.debug("Fetching cloudwatch data for resource %s"%rc_id)
+
+      # Update 2020-02 Use the per-region index of metrics instead of a ListMetrics call for each resource
+      region_name = rc_describe_entry['Region']
+      dimensions = self.assistant.id2dimensions(region_name, rc_id, self.cloudwatch_namespace, self.entry_keyId)
+      response = self.assistant.dimensions2stats(region_name, self.cloudwatch_namespace, dimensions, span)
 
     # dataframe of CPU Utilization, max and min, over 90 days
     df = self.assistant.stats2df(response, rc_id, rc_created, self.cloudwatch_namespace)
@@ -229,6 +421,7 @@ class CloudwatchCached(MetricCacheMixin, CloudwatchBase):
     """
     Manager for cloudwatch
     """
+    nodata_exception = NoCloudwatchException
 
     def get_key(self, rc_id):
         # build key out of the same parameters in metric.get_statistics and metrics.filter
@@ -241,11 +434,17 @@ class CloudwatchCached(MetricCacheMixin, CloudwatchBase):
         #)
 
         # KISS for now
-        cache_key = "cloudwatch:cpu:%s:%i"%(rc_id, self.ndays)
+        # Update 2020-02 drop ndays from the key since the cached value is per-day rows, check MetricCacheMixin
+        cache_key = "cloudwatch:cpu:%s"%rc_id
         return cache_key
 
-    def get_metrics_base(self, rc_describe_entry, rc_id, rc_created):
-      return self.handle_main(rc_describe_entry, rc_id, rc_created)
+    def get_metrics_base(self, rc_describe_entry, rc_id, rc_created, span=None):
+      return self.handle_main(rc_describe_entry, rc_id, rc_created, span)
+
+    def _prefetch_entries(self, context_pre):
+      # Update 2020-02 get the cached resources in bulk, and only prefetch their missing days from cloudwatch
+      entry_d = {rc_id: e for e, rc_id, _ in super()._prefetch_entries(context_pre)}
+      return [(entry_d[rc_id], rc_id, span) for rc_id, span in self.cache_prefetch_spans(list(entry_d.keys()))]
 
 
 
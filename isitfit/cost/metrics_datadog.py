@@ -33,19 +33,169 @@ class DataQueryError(ValueError):
   pass
 
 
+# Update 2020-02 Queries of the metrics fetched per host,
+# shared between the single-host queries of DatadogAssistant and the multi-host queries of DatadogManager.prefetch_metrics
+# dict: key -> (query template, metric name in the returned series, column name of the raw data)
+# The %s in the query template is the scope, eg "{host:i-123456}" or "{host:a OR host:b} by {host}"
+# query language: https://docs.datadoghq.com/graphing/functions/
+# Note that minimum cpu idle is used so that cpu_used will be the maximum (same for ram)
+METRIC_SPECS = {
+  'cpu_max': ('system.cpu.idle%%s.rollup(min,%i)'%SECONDS_IN_ONE_DAY, 'system.cpu.idle', 'cpu_idle_min'),
+  'cpu_min': ('system.cpu.idle%%s.rollup(max,%i)'%SECONDS_IN_ONE_DAY, 'system.cpu.idle', 'cpu_idle_max'),
+  'cpu_avg': ('system.cpu.idle%%s.rollup(avg,%i)'%SECONDS_IN_ONE_DAY, 'system.cpu.idle', 'cpu_idle_avg'),
+  'ram_max': ('system.mem.free%%s.rollup(min,%i)'%SECONDS_IN_ONE_DAY, 'system.mem.free', 'ram_free_min'),
+  'ram_min': ('system.mem.free%%s.rollup(max,%i)'%SECONDS_IN_ONE_DAY, 'system.mem.free', 'ram_free_max'),
+  'ram_avg': ('system.mem.free%%s.rollup(avg,%i)'%SECONDS_IN_ONE_DAY, 'system.mem.free', 'ram_free_avg'),
+  'count':   ('count_not_null(system.mem.free%s)', 'count_not_null(system.mem.free)', 'nhours'),
+}
+
+
+def metric_postprocess(spec_key, df, get_memory_total):
+  """
+  Convert the raw dataframe of a metric from METRIC_SPECS to the isitfit columns, eg cpu_idle_min to cpu_used_max
+  get_memory_total - callable returning the total memory of the host, only called for the ram metrics
+  """
+  col_i = METRIC_SPECS[spec_key][2]
+  col_used = spec_key.replace('cpu_', 'cpu_used_').replace('ram_', 'ram_used_')
+
+  if spec_key.startswith('cpu_'):
+    # calculate cpu used as 100 - cpu_idle
+    df[col_used] = 100 - df[col_i]
+    df[col_used] = df[col_used].astype(int)
+    return df
+
+  if spec_key.startswith('ram_'):
+    memory_total = get_memory_total()
+    df[col_i] = df[col_i] / memory_total * 100
+    df[col_i] = df[col_i].astype(int)
+    df[col_used] = 100 - df[col_i]
+    return df
+
+  if spec_key == 'count':
+    # yields data per hour, so process in pandas to daily
+    return df.set_index('ts_dt').resample('1D').nhours.sum().reset_index()
+
+  raise Exception("Invalid metric spec %s"%spec_key)
+
+
+def merge_metrics(df_d):
+  """
+  Merge the dataframes of all the METRIC_SPECS of a host into the single dataframe returned by DatadogManager.get_metrics_all
+  df_d - dict: spec key -> dataframe
+  """
+  df_all = df_d['cpu_max']
+  for spec_key in ['cpu_min', 'cpu_avg', 'ram_max', 'ram_min', 'ram_avg', 'count']:
+    df_all = df_all.merge(df_d[spec_key], how='outer', on=['ts_dt'])
+
+  df_all = df_all[['ts_dt', 'cpu_used_max', 'cpu_used_min', 'cpu_used_avg', 'ram_used_max', 'ram_used_min', 'ram_used_avg', 'nhours']]
+
+  # convert from datetime to date to be able to merge with cloudtrail
+  df_all['ts_dt'] = df_all.ts_dt.dt.date
+
+  # rename like cloudwatch
+  df_all.rename(columns={'ts_dt': 'Timestamp'}, inplace=True)
+
+  return df_all
+
+
+def host2meta(h_i):
+    """
+    Extract the metadata used by isitfit from a host entry of Hosts.search
+    """
+    gohai = json.loads(h_i['meta']['gohai'])
+    memory_total = int(gohai['memory']['total'].replace('kB',''))*1024
+    out = {'cpuCores': h_i['meta']['cpuCores'], 'memory_total': memory_total}
+    return out
+
+
+class HostMetaStore:
+    """
+    Update 2020-02 Store of the datadog host metadata (memory_total, cpuCores), by datadog hostname.
+    Filled once from the bulk host list downloaded in DatadogApiWrap.map_aws_datadog,
+    and shared between all the DatadogAssistant objects,
+    instead of 3 identical Hosts.search requests per host (one per get_metrics_ram_*).
+    Misses fall back to a single-host search, which is memoized (including HostNotFoundInDdg)
+    """
+    def __init__(self):
+        # dict: datadog hostname -> metadata dict or HostNotFoundInDdg
+        self.meta = {}
+
+        import threading
+        self.lock = threading.Lock()
+
+
+    def fill(self, host_list):
+        n_added = 0
+        with self.lock:
+          for h_i in host_list:
+            if 'name' not in h_i:
+              continue
+
+            try:
+              self.meta[h_i['name']] = host2meta(h_i)
+              n_added += 1
+            except (KeyError, TypeError, ValueError) as e:
+              # eg host without the gohai block, left for the single-host search
+              logger.debug("Skipping datadog host metadata of %s: %s"%(h_i['name'], str(e)))
+
+        logger.debug("Datadog host metadata store: added %i hosts"%n_added)
+
+
+    def dump(self):
+        """
+        Metadata dicts by hostname, without the memoized HostNotFoundInDdg misses, eg for HostIndexCache
+        """
+        with self.lock:
+          return {k: v for k, v in self.meta.items() if not isinstance(v, Exception)}
+
+
+    def load(self, meta):
+        with self.lock:
+          self.meta.update(meta)
+
+
+    def get(self, dd_hostname, apiwrap):
+        with self.lock:
+          out = self.meta.get(dd_hostname, None)
+
+        if out is None:
+          try:
+            out = apiwrap.hosts_search(dd_hostname)
+          except HostNotFoundInDdg as e:
+            out = e
+
+          with self.lock:
+            self.meta[dd_hostname] = out
+
+        if isinstance(out, Exception): raise out
+        return out
+
+
 class DatadogApiWrap:
     """
     Assisting the datadog assistant
     """
 
-    def map_aws_datadog(self):
-      # Build a map from AWS ID to Datadog hostname
-      # FIXME Should probably paginate in pages of 100 hosts using combinations of start and count
-      # Leaving for later until this proves to be a problem for isitfit memory consumption during execution.
+    # page size of Hosts.search, which is the max count allowed by datadog
+    hosts_pageSize = 1000
+
+    # number of pages fetched concurrently
+    hosts_maxWorkers = 4
+
+    def __init__(self, bucket=None):
+      """
+      bucket - Update 2020-02 TokenBucket to acquire before each datadog API call, or None for no limit, eg set by `isitfit cache warm`
+      """
+      self.bucket = bucket
+
+    def _acquire(self):
+      if self.bucket is not None:
+        self.bucket.acquire()
+
+    def _hosts_page(self, start):
       # https://docs.datadoghq.com/api/?lang=python#search-hosts
-      # https://docs.datadoghq.com/agent/faq/how-datadog-agent-determines-the-hostname/?tab=agentv6v7#potential-host-names
-      MAX_COUNT = 1000 # safety net, will cause problems for larger infra
-      h_rev = datadog.api.Hosts.search(count=MAX_COUNT)
+      self._acquire()
+      h_rev = datadog.api.Hosts.search(start=start, count=self.hosts_pageSize)
 
       if 'status' in h_rev:
         if h_rev['status']=='error':
@@ -54,15 +204,57 @@ class DatadogApiWrap:
           from isitfit.cli.click_descendents import IsitfitCliError
           raise IsitfitCliError(msg)
 
-      # alternatively, can use host_name here.
-      # Note the similar field used in self.hosts_search below.
-      # If this field is changed from name to host_name, remember to change it below also
-      h_rev = {x['aws_id']: x['name'] for x in h_rev['host_list'] if 'aws_id' in x and 'name' in x}
+      return h_rev
+
+
+    def hosts_iterate(self):
+      """
+      Update 2020-02 Iterate over the pages of the host list, i.e. yields one list of hosts per page.
+      Pages after the 1st are fetched concurrently, a few at a time so that only a few pages are in memory at once
+      """
+      h_rev = self._hosts_page(0)
+      yield h_rev['host_list']
+
+      # total_matching is the number of hosts over all pages
+      n_total = h_rev.get('total_matching', len(h_rev['host_list']))
+      start_l = list(range(self.hosts_pageSize, n_total, self.hosts_pageSize))
+      if len(start_l)==0:
+        return
+
+      logger.debug("Fetching %i pages of %i datadog hosts"%(len(start_l)+1, self.hosts_pageSize))
+      from concurrent.futures import ThreadPoolExecutor
+      with ThreadPoolExecutor(max_workers=self.hosts_maxWorkers) as executor:
+        for i_window in range(0, len(start_l), self.hosts_maxWorkers):
+          start_window = start_l[i_window:(i_window+self.hosts_maxWorkers)]
+          for h_rev in executor.map(self._hosts_page, start_window):
+            yield h_rev['host_list']
+
+
+    def map_aws_datadog(self, host_meta=None):
+      """
+      host_meta - HostMetaStore to fill with the metadata of the hosts listed here (optional)
+      """
+      # Build a map from AWS ID to Datadog hostname
+      # Update 2020-02 Paginate instead of a single request with count=1000 which missed hosts in larger infra.
+      # Only the compact map and the metadata are kept from each page.
+      # https://docs.datadoghq.com/api/?lang=python#search-hosts
+      # https://docs.datadoghq.com/agent/faq/how-datadog-agent-determines-the-hostname/?tab=agentv6v7#potential-host-names
+      h_rev = {}
+      for host_list in self.hosts_iterate():
+        if host_meta is not None:
+          host_meta.fill(host_list)
+
+        # alternatively, can use host_name here.
+        # Note the similar field used in self.hosts_search below.
+        # If this field is changed from name to host_name, remember to change it below also
+        h_rev.update({x['aws_id']: x['name'] for x in host_list if 'aws_id' in x and 'name' in x})
+
       return h_rev
 
 
     def hosts_search(self, dd_hostname):
       # https://docs.datadoghq.com/api/?lang=bash#search-hosts
+      self._acquire()
       h_all = datadog.api.Hosts.search(filter='host:%s'%dd_hostname)
 
       # check if found
@@ -97,11 +289,7 @@ class DatadogApiWrap:
       # at this stage we can take the first entry
       h_i = h_i[0]
 
-      # 
-      gohai = json.loads(h_i['meta']['gohai'])
-      memory_total = int(gohai['memory']['total'].replace('kB',''))*1024
-      out = {'cpuCores': h_i['meta']['cpuCores'], 'memory_total': memory_total}
-      return out
+      return host2meta(h_i)
 
 
     def metric_query(self, dd_hostname, start, end, query, metric_name, dfcol_name):
@@ -121,6 +309,7 @@ class DatadogApiWrap:
 
       # query datadog
       # https://docs.datadoghq.com/api/?lang=python#query-timeseries-points
+      self._acquire()
       m = datadog.api.Metric.query(start=ue_start, end=ue_end, query=query)
 
       if m['status'] != 'ok':
@@ -153,116 +342,192 @@ class DatadogApiWrap:
       m = m[0]
 
       # convert to pandas dataframe
-      df = pd.DataFrame(m['pointlist'], columns=['ts_int', dfcol_name])
+      return self._pointlist2df(m['pointlist'], dfcol_name)
+
+
+    def _pointlist2df(self, pointlist, dfcol_name):
+      df = pd.DataFrame(pointlist, columns=['ts_int', dfcol_name])
       df['ts_dt'] = pd.to_datetime(df.ts_int, origin='unix', unit='ms')
       del df['ts_int']
       return df
 
 
+    def metric_query_grouped(self, start, end, query, metric_name, dfcol_name, hostnames=None):
+      """
+      Update 2020-02 Similar to metric_query, but for a query grouped "by {host}" covering multiple hosts.
+      Returns dict: datadog hostname -> dataframe.
+      Hosts without data are missing from the returned dict
+
+      hostnames - set of datadog hostnames to keep from the returned series (optional)
+      """
+      self._acquire()
+      m = datadog.api.Metric.query(start=start, end=end, query=query)
+
+      if m.get('status', None) != 'ok':
+        msg = m.get('error', m.get('errors', m.get('status', 'n/a')))
+        raise DataQueryError(msg)
+
+      if 'errors' in m:
+        raise DataQueryError(m['errors'])
+
+      df_d = {}
+      for series in m['series']:
+        if series['metric']!=metric_name:
+          continue
+
+        # get the hostname from the tag set, eg ['host:i-123456'], otherwise from the scope, eg 'host:i-123456'
+        tag_l = series.get('tag_set', None) or series['scope'].split(',')
+        tag_l = [x for x in tag_l if x.startswith('host:')]
+        if len(tag_l)==0:
+          continue
+
+        dd_hostname = tag_l[0][len('host:'):]
+        if hostnames is not None and dd_hostname not in hostnames:
+          continue
+
+        df_d[dd_hostname] = self._pointlist2df(series['pointlist'], dfcol_name)
+
+      return df_d
+
+
+# default number of seconds after which the persisted aws-datadog host map is re-downloaded.
+# Hosts launched in the meantime are only found after it expires, hence not longer than an hour.
+# Over-ridable with the environment variable ISITFIT_DATADOG_INDEX_TTL (0 to disable persisting the map)
+HOST_INDEX_TTL_DEFAULT = 60*60
+
+
+class HostIndexCache:
+    """
+    Update 2020-02 Persist the map from AWS ID to datadog hostname, along with the host metadata,
+    in the local cache directory, so that runs within the TTL skip the paginated download of the host list.
+    Once older than the TTL, the full host list is downloaded again.
+    The file is per datadog API key
+    """
+    def __init__(self, ttl=None):
+        if ttl is None:
+          ttl = int(os.getenv("ISITFIT_DATADOG_INDEX_TTL", HOST_INDEX_TTL_DEFAULT))
+
+        self.ttl = ttl
+
+        import hashlib
+        key_hash = hashlib.sha1(os.getenv('DATADOG_API_KEY', '').encode('utf-8')).hexdigest()[:8]
+        from isitfit.dotMan import DotMan
+        self.filename = os.path.join(DotMan().tempdir(), 'datadog_hostIndex-%s.json'%key_hash)
+
+
+    def is_enabled(self):
+        return self.ttl > 0
+
+
+    def load(self):
+        """
+        Returns dict with keys dt_saved, index, meta. None if not available or if older than the TTL
+        """
+        if not self.is_enabled():
+          return None
+
+        if not os.path.exists(self.filename):
+          return None
+
+        try:
+          with open(self.filename, 'r') as fh:
+            cached = json.load(fh)
+        except ValueError as e:
+          logger.debug("Ignoring corrupt datadog host index %s: %s"%(self.filename, str(e)))
+          return None
+
+        if time.time() - cached['dt_saved'] > self.ttl:
+          return None
+
+        return cached
+
+
+    def save(self, index, meta):
+        if not self.is_enabled():
+          return
+
+        # write to a temporary file and rename, so that concurrent or interrupted runs do not leave a corrupt index
+        fn_tmp = self.filename + '.tmp'
+        with open(fn_tmp, 'w') as fh:
+          json.dump({'dt_saved': time.time(), 'index': index, 'meta': meta}, fh)
+
+        os.replace(fn_tmp, self.filename)
+
+
 class DatadogAssistant:
-    def __init__(self, start, end, dd_hostname):
+    def __init__(self, start, end, dd_hostname, host_meta=None, bucket=None):
+        """
+        host_meta - HostMetaStore shared between assistants. If None, a new one is used
+        bucket - check DatadogApiWrap
+        """
         self.end = end
         self.start = start
         self.dd_hostname = dd_hostname
-        self.apiwrap = DatadogApiWrap()
+        self.apiwrap = DatadogApiWrap(bucket)
+        self.host_meta = host_meta if host_meta is not None else HostMetaStore()
 
 
     def _get_metrics_core(self, query, metric_name, col_i):
         return self.apiwrap.metric_query(dd_hostname=self.dd_hostname, start=self.start, end=self.end, query=query, metric_name=metric_name, dfcol_name=col_i)
 
     def _get_meta(self):
-        return self.apiwrap.hosts_search(self.dd_hostname)
+        return self.host_meta.get(self.dd_hostname, self.apiwrap)
         
-    def get_metrics_cpu_max(self):
-        # query language
-        # https://docs.datadoghq.com/graphing/functions/
-        # Use minimum so that cpu_used will be the maximum
-        query = 'system.cpu.idle{host:%s}.rollup(min,%i)'%(self.dd_hostname, SECONDS_IN_ONE_DAY)
-        col_i = 'cpu_idle_min'
-        metric_name = 'system.cpu.idle'
+    def _get_metrics_spec(self, spec_key):
+        query, metric_name, col_i = METRIC_SPECS[spec_key]
+        query = query%('{host:%s}'%self.dd_hostname)
         df = self._get_metrics_core(query, metric_name, col_i)
-        # calculate cpu used as 100 - cpu_idle
-        df['cpu_used_max'] = 100 - df.cpu_idle_min
-        df['cpu_used_max'] = df['cpu_used_max'].astype(int)
-        return df
+        return metric_postprocess(spec_key, df, lambda: self._get_meta()['memory_total'])
+
+    def get_metrics_cpu_max(self):
+        return self._get_metrics_spec('cpu_max')
 
     def get_metrics_cpu_min(self):
-        # query language
-        # https://docs.datadoghq.com/graphing/functions/
-        # Use minimum so that cpu_used will be the maximum
-        query = 'system.cpu.idle{host:%s}.rollup(max,%i)'%(self.dd_hostname, SECONDS_IN_ONE_DAY)
-        col_i = 'cpu_idle_max'
-        metric_name = 'system.cpu.idle'
-        df = self._get_metrics_core(query, metric_name, col_i)
-        # calculate cpu used as 100 - cpu_idle
-        df['cpu_used_min'] = 100 - df.cpu_idle_max
-        df['cpu_used_min'] = df['cpu_used_min'].astype(int)
-        return df
-        
+        return self._get_metrics_spec('cpu_min')
+
     def get_metrics_cpu_avg(self):
-        # repeat for average
-        query = 'system.cpu.idle{host:%s}.rollup(avg,%i)'%(self.dd_hostname, SECONDS_IN_ONE_DAY)
-        col_i = 'cpu_idle_avg'
-        metric_name = 'system.cpu.idle'
-        df = self._get_metrics_core(query, metric_name, col_i)
-        df['cpu_used_avg'] = 100 - df.cpu_idle_avg
-        df['cpu_used_avg'] = df['cpu_used_avg'].astype(int)
-        return df
+        return self._get_metrics_spec('cpu_avg')
 
     def get_metrics_ram_max(self):
-        # query language, check note above in get_metrics_cpu
-        query = 'system.mem.free{host:%s}.rollup(min,%i)'%(self.dd_hostname, SECONDS_IN_ONE_DAY)
-        col_i = 'ram_free_min'
-        metric_name = 'system.mem.free'
-        df =  self._get_metrics_core(query, metric_name, col_i)
-        memory_total = self._get_meta()['memory_total']
-        df['ram_free_min'] = df.ram_free_min / memory_total * 100
-        df['ram_free_min'] = df['ram_free_min'].astype(int)
-        df['ram_used_max'] = 100 - df['ram_free_min']
-        return df
+        return self._get_metrics_spec('ram_max')
 
     def get_metrics_ram_min(self):
-        # query language, check note above in get_metrics_cpu
-        query = 'system.mem.free{host:%s}.rollup(max,%i)'%(self.dd_hostname, SECONDS_IN_ONE_DAY)
-        col_i = 'ram_free_max'
-        metric_name = 'system.mem.free'
-        df =  self._get_metrics_core(query, metric_name, col_i)
-        memory_total = self._get_meta()['memory_total']
-        df['ram_free_max'] = df.ram_free_max / memory_total * 100
-        df['ram_free_max'] = df['ram_free_max'].astype(int)
-        df['ram_used_min'] = 100 - df['ram_free_max']
-        return df
+        return self._get_metrics_spec('ram_min')
 
     def get_metrics_ram_avg(self):
-        # query language, check note above in get_metrics_cpu
-        query = 'system.mem.free{host:%s}.rollup(avg,%i)'%(self.dd_hostname, SECONDS_IN_ONE_DAY)
-        col_i = 'ram_free_avg'
-        metric_name = 'system.mem.free'
-        df =  self._get_metrics_core(query, metric_name, col_i)
-        memory_total = self._get_meta()['memory_total']
-        df['ram_free_avg'] = df.ram_free_avg / memory_total * 100
-        df['ram_free_avg'] = df['ram_free_avg'].astype(int)
-        df['ram_used_avg'] = 100 - df['ram_free_avg']
-        return df
+        return self._get_metrics_spec('ram_avg')
 
     def get_metrics_count(self):
-        # query language, check note above in get_metrics_cpu
-        query = 'count_not_null(system.mem.free{host:%s})'%(self.dd_hostname)
-        col_i = 'nhours'
-        metric_name = 'count_not_null(system.mem.free)'
-        df1 =  self._get_metrics_core(query, metric_name, col_i)
-        # yields data per hour, so process in pandas to daily
-        df2 = df1.set_index('ts_dt').resample('1D').nhours.sum().reset_index()
-        return df2
+        return self._get_metrics_spec('count')
 
 
 class DatadogManager:
+    # max number of hosts per grouped query in prefetch_metrics, to keep the query string short
+    prefetch_hostsPerQuery = 50
+
+    # Update 2020-02 handle_pre is called once with all the hosts by `isitfit cache warm` instead of once per chunk,
+    # since prefetch_metrics already chunks the hosts and queries the union of their spans
+    prefetch_once = True
+
     def __init__(self):
         datadog.initialize()
         self.set_ndays(90) # default is 90 days
         self.print_configured = True
         self.map_aws_dd = None
 
+        # metadata of the hosts, filled in build_map_aws_dd
+        self.host_meta = HostMetaStore()
+
+        # the map is built lazily in get_metrics_all, which can be called from several worker threads
+        import threading
+        self.lock_map = threading.Lock()
+
+        # dict: aws ID -> dict: span -> dataframe of get_metrics_all or exception to raise, filled by prefetch_metrics
+        self.prefetched = {}
+
+        # Update 2020-02 TokenBucket to acquire before each datadog API call, or None for no limit, eg set by `isitfit cache warm`
+        self.bucket = None
+
 
     def set_ndays(self, ndays):
         self.ndays = ndays
@@ -277,6 +542,33 @@ class DatadogManager:
         self.start = self.end - n_secs
 
 
+    def set_bucket(self, bucket):
+        self.bucket = bucket
+
+
+    def get_window(self):
+        """
+        Update 2020-02 (date start, date end) of the ndays window, in UTC like the datadog timestamps
+        """
+        import datetime as dt
+        return dt.datetime.utcfromtimestamp(self.start).date(), dt.datetime.utcfromtimestamp(self.end).date()
+
+
+    def span2epoch(self, span):
+        """
+        Update 2020-02 Convert a span of days (date start, date end) to the start/end timestamps of the datadog queries.
+        If span is None, returns the ndays window
+        """
+        if span is None:
+          return self.start, self.end
+
+        import calendar
+        d_start, d_end = span
+        start = calendar.timegm(d_start.timetuple())
+        end = min(self.end, calendar.timegm(d_end.timetuple()) + SECONDS_IN_ONE_DAY - 1)
+        return start, end
+
+
     def is_configured(self):
       from isitfit.utils import ping_matomo
 
@@ -303,16 +595,28 @@ class DatadogManager:
 
 
     def build_map_aws_dd(self):
-        apiwrap = DatadogApiWrap()
-        self.map_aws_dd = apiwrap.map_aws_datadog()
+        apiwrap = DatadogApiWrap(self.bucket)
+
+        # Update 2020-02 use the persisted map if not expired
+        index_cache = HostIndexCache()
+        cached = index_cache.load()
+        if cached is not None:
+          logger.debug("Using the datadog host index of %i hosts from %s"%(len(cached['index']), index_cache.filename))
+          self.map_aws_dd = cached['index']
+          self.host_meta.load(cached['meta'])
+          return
+
+        self.map_aws_dd = apiwrap.map_aws_datadog(self.host_meta)
+        index_cache.save(self.map_aws_dd, self.host_meta.dump())
 
 
-    def get_metrics_all(self, aws_id):
+    def get_metrics_all(self, aws_id, span=None):
         # convert aws ID to datadog hostname
-        if self.map_aws_dd is None:
-          self.build_map_aws_dd()
+        with self.lock_map:
           if self.map_aws_dd is None:
-            raise Exception("Failed to build aws-datadog ID map")
+            self.build_map_aws_dd()
+            if self.map_aws_dd is None:
+              raise Exception("Failed to build aws-datadog ID map")
 
         # fail if not found
         if aws_id not in self.map_aws_dd:
@@ -320,46 +624,155 @@ class DatadogManager:
 
         dd_hostname = self.map_aws_dd[aws_id]
 
+        # Update 2020-02 use the data from the grouped queries if available
+        if span is None:
+          span = self.get_window()
+
+        span_d = self.prefetched.get(aws_id, {})
+        if span in span_d:
+          logger.debug("Using prefetched datadog data for aws ID %s"%aws_id)
+          df_all = span_d.pop(span)
+          if len(span_d)==0: del self.prefetched[aws_id]
+          if isinstance(df_all, Exception): raise df_all
+          return df_all
+
         # FIXME: we already have cpu from cloudwatch, so maybe just focus on ram from datadog
         logger.debug("Fetching datadog data for aws ID %s, datadog hostname %s"%(aws_id, dd_hostname))
-        ddgL2 = DatadogAssistant(self.start, self.end, dd_hostname)
-        df_cpu_max = ddgL2.get_metrics_cpu_max()
-        df_cpu_min = ddgL2.get_metrics_cpu_min()
-        df_cpu_avg = ddgL2.get_metrics_cpu_avg()
-        df_ram_max = ddgL2.get_metrics_ram_max()
-        df_ram_min = ddgL2.get_metrics_ram_min()
-        df_ram_avg = ddgL2.get_metrics_ram_avg()
-        df_count   = ddgL2.get_metrics_count()
-        df_all = (
-            df_cpu_max
-            .merge(df_cpu_min, how='outer', on=['ts_dt'])
-            .merge(df_cpu_avg, how='outer', on=['ts_dt'])
-            .merge(df_ram_max, how='outer', on=['ts_dt'])
-            .merge(df_ram_min, how='outer', on=['ts_dt'])
-            .merge(df_ram_avg, how='outer', on=['ts_dt'])
-            .merge(df_count,   how='outer', on=['ts_dt'])
-        )
-        df_all = df_all[['ts_dt', 'cpu_used_max', 'cpu_used_min', 'cpu_used_avg', 'ram_used_max', 'ram_used_min', 'ram_used_avg', 'nhours']]
-
-        # convert from datetime to date to be able to merge with cloudtrail
-        df_all['ts_dt'] = df_all.ts_dt.dt.date
-
-        # rename like cloudwatch
-        df_all.rename(columns={'ts_dt': 'Timestamp'}, inplace=True)
-
-        return df_all
+        start, end = self.span2epoch(span)
+        ddgL2 = DatadogAssistant(start, end, dd_hostname, self.host_meta, self.bucket)
+        df_d = {
+          'cpu_max': ddgL2.get_metrics_cpu_max(),
+          'cpu_min': ddgL2.get_metrics_cpu_min(),
+          'cpu_avg': ddgL2.get_metrics_cpu_avg(),
+          'ram_max': ddgL2.get_metrics_ram_max(),
+          'ram_min': ddgL2.get_metrics_ram_min(),
+          'ram_avg': ddgL2.get_metrics_ram_avg(),
+          'count':   ddgL2.get_metrics_count(),
+        }
+        return merge_metrics(df_d)
+
+
+    def prefetch_metrics(self, id_spans):
+        """
+        Update 2020-02 Fetch the metrics of many hosts with queries grouped "by {host}",
+        i.e. 7 queries per chunk of hosts instead of 7 queries per host in get_metrics_all.
+        The hosts of all the spans are fetched together over the union of the spans, then each host is sliced to its own span.
+        The results are stored in self.prefetched and consumed by get_metrics_all
+
+        id_spans - list of (aws ID, span of days to fetch), eg as returned by _prefetch_ids. An aws ID can have several spans
+        """
+        if len(id_spans)==0:
+          return
+
+        if self.map_aws_dd is None:
+          self.build_map_aws_dd()
+
+        # hosts not found in datadog are skipped, and get_metrics_all raises HostNotFoundInDdg for them later
+        # dict: datadog hostname -> (aws ID, list of spans)
+        host_map = {}
+        for aws_id, span in id_spans:
+          if aws_id in self.map_aws_dd:
+            host_map.setdefault(self.map_aws_dd[aws_id], (aws_id, []))[1].append(span)
+
+        if len(host_map)==0:
+          return
+
+        # union of the spans
+        span_all = set([span for _, span_l in host_map.values() for span in span_l])
+        start = min([self.span2epoch(span)[0] for span in span_all])
+        end = max([self.span2epoch(span)[1] for span in span_all])
+
+        apiwrap = DatadogApiWrap(self.bucket)
+        host_list = sorted(host_map.keys())
+        for i_start in range(0, len(host_list), self.prefetch_hostsPerQuery):
+          host_chunk = host_list[i_start:(i_start+self.prefetch_hostsPerQuery)]
+          scope = '{%s} by {host}'%(' OR '.join(['host:%s'%x for x in host_chunk]))
+          logger.debug("Fetching datadog data for %i hosts"%len(host_chunk))
+
+          # dict: spec key -> dict: hostname -> dataframe
+          try:
+            df_spec = {}
+            for spec_key, (query, metric_name, col_i) in METRIC_SPECS.items():
+              df_spec[spec_key] = apiwrap.metric_query_grouped(start, end, query%scope, metric_name, col_i, set(host_chunk))
+          except DataQueryError as e:
+            # fall back to the per-host queries in get_metrics_all
+            logger.debug("Failed to prefetch datadog data of %i hosts, will fetch per host: %s"%(len(host_chunk), str(e)))
+            continue
+
+          for dd_hostname in host_chunk:
+            aws_id, span_l = host_map[dd_hostname]
+            self.prefetched[aws_id] = {span: self._prefetch_host(apiwrap, df_spec, dd_hostname, span) for span in span_l}
+
+        logger.debug("Prefetched datadog data of %i hosts"%len(self.prefetched))
+
+
+    def _prefetch_host(self, apiwrap, df_spec, dd_hostname, span):
+        """
+        Dataframe of get_metrics_all of a single host, from the results of the grouped queries sliced to the span of the host,
+        or the exception to raise in get_metrics_all
+        """
+        d_start, d_end = span
+        df_host = {}
+        for spec_key, df_d in df_spec.items():
+          if dd_hostname not in df_d:
+            continue
+
+          df = df_d[dd_hostname]
+          ts_date = df.ts_dt.dt.date
+          df = df[(ts_date >= d_start) & (ts_date <= d_end)]
+          if df.shape[0] > 0:
+            df_host[spec_key] = df.copy()
+
+        spec_missing = [k for k in df_spec.keys() if k not in df_host]
+        if len(spec_missing)>0:
+          # same exception as in DatadogApiWrap.metric_query when a single host has no data
+          return DataNotFoundForHostInDdg("No %s found for %s"%(", ".join(spec_missing), dd_hostname))
+
+        # the memory total is looked up once per host, and can raise HostNotFoundInDdg (eg duplicated hostname or no gohai data),
+        # which is kept for this host only so that get_metrics_all raises it as with the per-host queries
+        try:
+          memory_total = self.host_meta.get(dd_hostname, apiwrap)['memory_total']
+          df_d = {k: metric_postprocess(k, v, lambda: memory_total) for k, v in df_host.items()}
+        except DdgNoData as e:
+          return e
+
+        return merge_metrics(df_d)
+
+
+    def _prefetch_ids(self, context_pre):
+        """
+        List of (aws ID, span of days) to prefetch in handle_pre
+        """
+        span = self.get_window()
+        return [(rc_id, span) for _, rc_id, _, _ in context_pre['ec2_instances']]
+
+
+    def handle_pre(self, context_pre):
+        """
+        Listener prefetching the metrics of all the resources of the iterator
+        """
+        # all the spans of days to fetch at once
+        self.prefetch_metrics(self._prefetch_ids(context_pre))
+        return context_pre
 
 
 from .cacheManager import MetricCacheMixin
 
 
 class DatadogCached(MetricCacheMixin, DatadogManager):
+    nodata_exception = DataNotFoundForHostInDdg
+
     def get_key(self, aws_id):
-        cache_key = "datadog:cpu+ram:%s:%i"%(aws_id, self.ndays)
+        # Update 2020-02 drop ndays from the key since the cached value is per-day rows, check MetricCacheMixin
+        cache_key = "datadog:cpu+ram:%s"%aws_id
         return cache_key
 
-    def get_metrics_base(self, rc_describe_entry, rc_id, rc_created):
-      return self.get_metrics_all(rc_id)
+    def get_metrics_base(self, rc_describe_entry, rc_id, rc_created, span=None):
+      return self.get_metrics_all(rc_id, span)
+
+    def _prefetch_ids(self, context_pre):
+      # Update 2020-02 get the cached hosts in bulk, and only prefetch their missing days from datadog
+      return self.cache_prefetch_spans([rc_id for rc_id, _ in super()._prefetch_ids(context_pre)])
 
 
 #class DatadogListener(DatadogCached):
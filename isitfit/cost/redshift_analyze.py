@@ -15,7 +15,7 @@ def get_dtNowD():
 import math
 dt_now_d = get_dtNowD()
 
-from isitfit.utils import mergeSeriesOnTimestampRange
+from isitfit.utils import mergeHistoryOnTimestampRange
 
 
 # convert above dict to pandas dataframe
@@ -34,8 +34,8 @@ class CalculatorAnalyzeRedshift(CalculatorBaseRedshift):
       rc_describe_entry, rc_id, rc_created = context_ec2['ec2_dict'], context_ec2['ec2_id'], context_ec2['ec2_launchtime']
 
       # pandas series of number of nodes available, and node type, over time, past 90 days
-      df_type_ts1 = context_ec2['df_type_ts1']
-      df_type_ts1 = df_type_ts1.rename(columns={'ResourceSize1': 'NodeType', 'ResourceSize2': 'NumberOfNodes'})
+      # Update 2020-02 arrays of the cloudtrail history instead of a dataframe, check CloudtrailCached.single
+      event_time, _, size1, size2 = context_ec2['type_history']
 
       # get all performance dataframes, on the cluster-aggregated level
       df_single = context_ec2['df_single']
@@ -76,9 +76,9 @@ class CalculatorAnalyzeRedshift(CalculatorBaseRedshift):
       #
       #df_single['nhours'] = df_single.Timestamp.apply(calc_nhours)
 
-      # merge df_single (metrics) with df_type_ts1 (cloudtrail history)
+      # merge df_single (metrics) with type_history (cloudtrail history)
       # (adds column NodeType, NumberOfNodes)
-      df_single = mergeSeriesOnTimestampRange(df_single, df_type_ts1, ['NodeType', 'NumberOfNodes'])
+      df_single = mergeHistoryOnTimestampRange(df_single, event_time, {'NodeType': size1, 'NumberOfNodes': size2})
 
       # merge with the price catalog (adds column Cost)
       df_single = df_single.merge(redshiftPricing_df, left_on='NodeType', right_on='NodeType', how='left')
@@ -13,6 +13,7 @@ class RedshiftPerformanceIterator(BaseIterator):
   paginator_exception = 'InvalidClientTokenId'
   entry_keyId = 'ClusterIdentifier'
   entry_keyCreated = 'ClusterCreateTime'
+  entry_keysTracked = ['ClusterStatus', 'NodeType', 'NumberOfNodes']
 
 
 
@@ -139,7 +140,8 @@ def redshift_cost_core(ra, rr, share_email, filter_region, ctx, filter_tags):
     from isitfit.tqdmman import TqdmL2Verbose
     tqdmman = TqdmL2Verbose(ctx)
 
-    ri = RedshiftPerformanceIterator(filter_region, tqdmman)
+    # Use the inventory snapshot shared with the ec2 pipeline, if any
+    ri = RedshiftPerformanceIterator(filter_region, tqdmman, ctx.obj.get('inventory', None))
 
     # pipeline
     from isitfit.cost.mainManager import MainManager
@@ -150,6 +152,7 @@ def redshift_cost_core(ra, rr, share_email, filter_region, ctx, filter_tags):
 
     mm = MainManager("Redshift cost analyze or optimize", ctx)
     mm.set_ndays(ctx.obj['ndays'])
+    mm.set_workers(ctx.obj.get('workers', 1))
 
     cache_man = RedisPandasCacheManager()
 
@@ -164,7 +167,7 @@ def redshift_cost_core(ra, rr, share_email, filter_region, ctx, filter_tags):
     # FIXME note that if two pipelines are run, one for ec2 and one for redshift, then this Object fetches the same data twice
     # because the base class behind it does both ec2+redshift at once
     # in the init_data phase
-    cloudtrail_manager = CloudtrailCached(mm.EndTime, cache_man, tqdmman)
+    cloudtrail_manager = CloudtrailCached(mm.EndTime, cache_man, tqdmman, mm.StartTime)
 
     # update dict and return it
     # https://stackoverflow.com/a/1453013/4126114
@@ -193,16 +196,19 @@ def redshift_cost_core(ra, rr, share_email, filter_region, ctx, filter_tags):
     if do_binning:
       mm.add_listener('pre', bcs.handle_pre)
 
+    mm.add_listener('pre', cwman.handle_pre)
+
     rtf = RedshiftTagFilter(filter_tags)
     mm.add_listener('ec2', rtf.per_cluster)
 
     mm.add_listener('ec2', cwman.per_ec2)
     mm.add_listener('ec2', cloudtrail_manager.single)
-    mm.add_listener('ec2', ra.per_ec2)
+    mm.add_listener('ec2', ra.per_ec2, ordered=True)
 
     if do_binning:
-      mm.add_listener('ec2', bcs.per_ec2)
+      mm.add_listener('ec2', bcs.per_ec2, ordered=True)
 
+    mm.add_listener('all', cache_man.handle_all)
     mm.add_listener('all', ec2_common.after_all) # just show IDs missing cloudwatch/cloudtrail
     mm.add_listener('all', ra.after_all)
     mm.add_listener('all', ra.calculate)
@@ -0,0 +1,13 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def localCache_disabled(monkeypatch):
+  """
+  Disable the on-disk inventory cache, datadog host index, local metrics cache, and in-process cache by default so that tests do not leak data into each other.
+  Tests of the caches themselves pass an explicit ttl or filename
+  """
+  monkeypatch.setenv("ISITFIT_INVENTORY_TTL", "0")
+  monkeypatch.setenv("ISITFIT_DATADOG_INDEX_TTL", "0")
+  monkeypatch.setenv("ISITFIT_CACHE_LOCAL", "0")
+  monkeypatch.setenv("ISITFIT_CACHE_MEMORY_MB", "0")
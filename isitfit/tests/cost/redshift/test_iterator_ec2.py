@@ -96,7 +96,33 @@ def test_iteratorBuiltin(mocker):
   rpi = Ec2Iterator()
   x = list(rpi)
   assert len(x) == 1
-  assert x[0][3] == response_created
+  assert x[0][3].instance_id == response_created.instance_id
+  assert x[0][3].region_name == 'us-east-1'
+  assert x[0][3].launch_time == dt_now
+
+
+@mock_ec2
+def test_getResources():
+  # create instances
+  import boto3
+  ec2_client = boto3.resource('ec2', region_name='us-east-1')
+  response_created = ec2_client.create_instances(
+    MinCount = 3,
+    MaxCount = 3,
+    InstanceType='t2.medium'
+  )
+
+  # build records like in the iterator
+  from ....cost.ec2_analyze import Ec2Record
+  ec2_records = [Ec2Record({'Region': 'us-east-1', 'InstanceId': x.instance_id}) for x in response_created]
+
+  # test with a small batch size to check batching
+  rpi = Ec2Iterator()
+  rpi.resources_batchSize = 2
+  actual = rpi.get_resources(ec2_records)
+  assert sorted(actual.keys()) == sorted([x.instance_id for x in response_created])
+  assert all([x.instance_type == 't2.medium' for x in actual.values()])
+  assert all([x.region_name == 'us-east-1' for x in actual.values()])
 
 
 
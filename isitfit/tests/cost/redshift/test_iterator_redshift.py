@@ -81,3 +81,44 @@ def test_iteratorBuiltin(mocker):
   assert x[0][0] == ex_iterateCore[1]
   assert x[0][1] == 'abc' # 'a dataframe'
 
+
+
+@mock_redshift
+def test_iterateCore_multiRegion(mocker, monkeypatch):
+  # undo the profile and default session set by earlier tests
+  monkeypatch.delenv('AWS_PROFILE', raising=False)
+  monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+  mocker.patch('boto3.DEFAULT_SESSION', None)
+
+  # mock the get regions part
+  region_all = ['us-west-2', 'us-east-1', 'eu-west-1']
+  mockreturn = lambda service, *args, **kwargs: region_all
+  mockee = 'boto3.session.Session.get_available_regions'
+  mocker.patch(mockee, side_effect=mockreturn)
+
+  # neither load from nor save to the local cache files (region_include and inventory)
+  mocker.patch('isitfit.cost.base_iterator.SimpleCacheMan.load_key', return_value=None)
+  mocker.patch('isitfit.cost.base_iterator.SimpleCacheMan.save_key', autospec=True)
+  monkeypatch.setenv('ISITFIT_INVENTORY_TTL', '0')
+
+  # create mock redshift clusters in 2 out of 3 regions
+  import boto3
+  for region_name, cluster_id in [('us-east-1', 'abc'), ('us-west-2', 'def')]:
+    redshift_client = boto3.client('redshift', region_name=region_name)
+    redshift_client.create_cluster(
+      ClusterIdentifier=cluster_id,
+      NodeType='abc',
+      MasterUsername='abc',
+      MasterUserPassword='abc'
+    )
+
+  # test, with a fresh inventory snapshot
+  from isitfit.cost.inventory import InventorySnapshot
+  rpi = RedshiftPerformanceIterator(inventory=InventorySnapshot())
+  assert not rpi.regionInclude_ready
+  x = list(rpi.iterate_core())
+
+  # results are in the order of the regions, despite being fetched concurrently
+  assert [(e['Region'], e['ClusterIdentifier']) for e in x] == [('us-west-2', 'def'), ('us-east-1', 'abc')]
+  assert rpi.region_include == ['us-west-2', 'us-east-1']
+  assert rpi.regionInclude_ready
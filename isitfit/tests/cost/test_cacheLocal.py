@@ -0,0 +1,81 @@
+import pytest
+
+from isitfit.cost.cacheLocal import LocalRedis
+
+
+@pytest.fixture
+def local_redis(tmpdir):
+  return LocalRedis(str(tmpdir.join('cache.sqlite')))
+
+
+class TestLocalRedis:
+  def test_setGet(self, local_redis):
+    assert local_redis.get('k1') is None
+    local_redis.set(name='k1', value=b'v1', ex=60)
+    local_redis.set(name='k2', value=memoryview(b'v2'))
+    assert local_redis.get('k1') == b'v1'
+    assert local_redis.mget(['k2', 'k3', 'k1']) == [b'v2', None, b'v1']
+
+    assert local_redis.delete('k1', 'k3') == 1
+    assert local_redis.get('k1') is None
+
+  def test_expiration(self, local_redis, mocker):
+    mock_time = mocker.patch('time.time', return_value=1000)
+    local_redis.set(name='k1', value=b'v1', ex=600)
+    mock_time.return_value = 1000 + 599
+    assert local_redis.get('k1') == b'v1'
+    mock_time.return_value = 1000 + 601
+    assert local_redis.get('k1') is None
+
+  def test_scanGetrange(self, local_redis):
+    local_redis.set(name='v2:cloudwatch:i-1', value=b'abcdef')
+    local_redis.set(name='v2:datadog:i-1', value=b'abc')
+    local_redis.set(name='v2:cloudwatch_foo', value=b'abc')
+    assert list(local_redis.scan_iter(match='v2:cloudwatch:*')) == ['v2:cloudwatch:i-1']
+    assert len(list(local_redis.scan_iter())) == 3
+    assert local_redis.getrange('v2:cloudwatch:i-1', 0, 2) == b'abc'
+    assert local_redis.getrange('v2:cloudwatch:i-2', 0, 2) == b''
+
+  def test_pipeline(self, local_redis):
+    pipe = local_redis.pipeline(transaction=False)
+    pipe.set(name='k1', value=b'v1', ex=60)
+    pipe.set(name='k2', value=b'v2', ex=60)
+    pipe.mget(['k1', 'k2'])
+    assert pipe.execute() == [True, True, [b'v1', b'v2']]
+
+  def test_multipleConnections(self, tmpdir):
+    # eg 2 isitfit processes sharing the same file
+    fn = str(tmpdir.join('cache.sqlite'))
+    lr1, lr2 = LocalRedis(fn), LocalRedis(fn)
+    lr1.set(name='k1', value=b'v1', ex=60)
+    assert lr2.get('k1') == b'v1'
+
+
+def test_redisPandas_local(mocker, monkeypatch, tmpdir):
+  import pandas as pd
+  mocker.patch('isitfit.dotMan.DotMan.tempdir', return_value=str(tmpdir))
+  mocker.patch('isitfit.utils.ping_matomo')
+  for k in ['ISITFIT_REDIS_HOST', 'ISITFIT_REDIS_PORT', 'ISITFIT_REDIS_DB']:
+    monkeypatch.delenv(k, raising=False)
+
+  from isitfit.cost.cacheManager import RedisPandas
+
+  # disabled in tests by default
+  rp = RedisPandas()
+  rp.handle_pre({'n_ec2_total': 100})
+  assert not rp.isReady()
+
+  # chosen automatically when redis is not configured, without any prompt
+  monkeypatch.setenv("ISITFIT_CACHE_LOCAL", "1")
+  rp.handle_pre({'n_ec2_total': 100})
+  assert rp.isReady()
+
+  df = pd.DataFrame({'a': [1,2,3]})
+  rp.set('k1', df)
+  rp.flush()
+
+  # another process
+  rp2 = RedisPandas()
+  rp2.handle_pre({'n_ec2_total': 100})
+  pd.testing.assert_frame_equal(rp2.get('k1'), df)
+  assert list(rp2.mget(['k1', 'k2']).keys()) == ['k1']
@@ -0,0 +1,102 @@
+import pandas as pd
+import pytest
+
+from isitfit.cost import cacheMemory
+from isitfit.cost.cacheMemory import MemoryLRU, get_memoryLRU
+from isitfit.tests.cost.test_cacheSerializer import MockRedis, get_df, codec_mocked
+
+
+@pytest.fixture
+def memory_enabled(monkeypatch):
+  monkeypatch.setenv("ISITFIT_CACHE_MEMORY_MB", "1")
+  monkeypatch.setattr(cacheMemory, '_shared', None)
+
+
+class TestMemoryLRU:
+  def test_evictByBytes(self):
+    lru = MemoryLRU(10)
+    lru.set('a', 1, 4)
+    lru.set('b', 2, 4)
+
+    # a is now the most recently used
+    assert lru.get('a') == 1
+    lru.set('c', 3, 4)
+    assert lru.get('b') is None
+    assert lru.get('a') == 1
+    assert lru.get('c') == 3
+    assert lru.n_bytes == 8
+
+    # too large to be kept
+    lru.set('d', 4, 11)
+    assert lru.get('d') is None
+    assert lru.n_bytes == 8
+
+  def test_expired(self, mocker):
+    lru = MemoryLRU(10)
+    lru.set('a', 1, 4, ex=60)
+    assert lru.get('a') == 1
+
+    import time
+    mocker.patch('time.time', return_value=time.time()+61)
+    assert lru.get('a') is None
+    assert lru.n_bytes == 0
+
+  def test_dataframeCopied(self):
+    lru = MemoryLRU(10)
+    df = get_df()
+    lru.set('a', df, 4)
+    df['cpu_used_max'] = 0
+    actual = lru.get('a')
+    actual['nhours'] = 0
+    pd.testing.assert_frame_equal(lru.get('a'), get_df())
+
+
+def test_getMemoryLRU(monkeypatch, memory_enabled):
+  assert get_memoryLRU() is get_memoryLRU()
+  assert get_memoryLRU().max_bytes == 1024*1024
+
+  monkeypatch.setenv("ISITFIT_CACHE_MEMORY_MB", "0")
+  assert get_memoryLRU() is None
+
+
+def test_redisPandas_shared(memory_enabled):
+  from isitfit.cost.cacheManager import RedisPandas
+  redis_client = MockRedis()
+  df = get_df()
+
+  rp1 = RedisPandas()
+  rp1.redis_client = redis_client
+  rp1.set('k1', df)
+  rp1.flush()
+
+  # another instance, eg of the redshift pipeline, reads from memory
+  rp2 = RedisPandas()
+  rp2.redis_client = redis_client
+  n_roundtrips = redis_client.n_roundtrips
+  pd.testing.assert_frame_equal(rp2.get('k1'), df)
+  assert rp2.mget(['k1']).keys() == {'k1'}
+  assert redis_client.n_roundtrips == n_roundtrips
+
+  # keys read from redis are kept in memory
+  rp3 = RedisPandas()
+  rp3.redis_client = redis_client
+  rp3.memory.clear()
+  assert rp3.mget(['k1', 'k2']).keys() == {'k1'}
+  assert rp3.get('k1') is not None
+  assert redis_client.n_roundtrips == n_roundtrips + 1
+
+
+def test_valueNbytes(codec_mocked):
+  from isitfit.cost.cacheMemory import value_nbytes
+  from isitfit.cost.cacheSerializer import serialize
+
+  # a repetitive dataframe compresses well, but is charged its in-memory size
+  df = pd.DataFrame({'a': ['abc']*10000, 'b': [1]*10000})
+  data = serialize(df)
+  assert value_nbytes(df, data) == df.memory_usage(deep=True).sum()
+  assert value_nbytes(df, data) > 10*len(data)
+
+  # other values are charged the uncompressed size of the payload
+  value = {'events': ['abc']*10000}
+  data = serialize(value)
+  assert value_nbytes(value, data) > 10*len(data)
@@ -0,0 +1,195 @@
+import datetime as dt
+import pandas as pd
+import pytest
+
+from isitfit.cost import cacheSerializer
+from isitfit.cost.cacheSerializer import serialize, deserialize, versioned_key
+
+
+def get_df():
+  return pd.DataFrame({
+    'Timestamp': [dt.date(2020,2,1), dt.date(2020,2,2)],
+    'cpu_used_max': [10.5, 20.0],
+    'nhours': [24, 3],
+    'instance_id': ['i-1', 'i-1'],
+  })
+
+
+class TestSerializer:
+  def test_arrow(self):
+    df = get_df()
+    data = serialize(df)
+    assert data[:3] == b'IFC'
+    pd.testing.assert_frame_equal(deserialize(data), df)
+
+  def test_parquet(self, monkeypatch):
+    monkeypatch.setattr(cacheSerializer, 'PARQUET_MIN_BYTES', 1)
+    df = get_df()
+    data = serialize(df)
+    assert data[4] == cacheSerializer.PAYLOAD_PARQUET
+    pd.testing.assert_frame_equal(deserialize(data), df)
+
+  def test_multiIndexAndEmpty(self):
+    df = get_df().set_index(['instance_id', 'Timestamp'])
+    pd.testing.assert_frame_equal(deserialize(serialize(df)), df)
+
+    # cloudtrail caches empty dataframes
+    actual = deserialize(serialize(pd.DataFrame()))
+    assert actual.shape[0] == 0
+
+  def test_negativeCacheEntry(self):
+    from isitfit.cost.cacheManager import NegativeCacheEntry
+    from isitfit.utils import NoCloudwatchException
+    actual = deserialize(serialize(NegativeCacheEntry(NoCloudwatchException("no data for i-1"), 'cloudwatch')))
+    assert callable(actual)
+    assert (actual.reason, actual.source, actual.miss_count) == ('NoCloudwatchException', 'cloudwatch', 1)
+    with pytest.raises(NoCloudwatchException):
+      actual()
+
+  def test_unpickleError(self, mocker):
+    data = serialize({'a': 1})
+    mocker.patch('pickle.loads', side_effect=AttributeError("Can't get attribute 'CachedError'"))
+    assert deserialize(data) is None
+
+  def test_otherVersion(self, monkeypatch):
+    data = serialize(get_df())
+    monkeypatch.setattr(cacheSerializer, 'FORMAT_VERSION', cacheSerializer.FORMAT_VERSION+1)
+    assert deserialize(data) is None
+    assert deserialize(b'foo') is None
+    assert versioned_key('foo') == 'v%i:foo'%cacheSerializer.FORMAT_VERSION
+
+
+@pytest.fixture
+def codec_mocked(monkeypatch):
+  """
+  Neither zstandard nor lz4 might be installed, so mock the zstd codec with zlib
+  """
+  import zlib
+  def get_codec_functions(codec):
+    if codec == cacheSerializer.CODEC_ZSTD: return zlib.compress, zlib.decompress
+    return None
+
+  monkeypatch.setattr(cacheSerializer, 'get_codec_functions', get_codec_functions)
+  monkeypatch.setattr(cacheSerializer, 'COMPRESS_MIN_BYTES', 1)
+
+
+class TestCompression:
+  def get_df_large(self):
+    return pd.concat([get_df()]*100, ignore_index=True)
+
+  def test_compressed(self, codec_mocked):
+    df = self.get_df_large()
+    data = serialize(df)
+    header = cacheSerializer.read_header(data)
+    assert header['codec'] == cacheSerializer.CODEC_ZSTD
+    assert header['size_stored'] < header['size_raw']
+    assert len(data) == cacheSerializer.HEADER_STRUCT.size + header['size_stored']
+    pd.testing.assert_frame_equal(deserialize(data), df)
+
+  def test_noCompression(self, codec_mocked, monkeypatch):
+    monkeypatch.setenv("ISITFIT_CACHE_COMPRESSION", "none")
+    data = serialize(self.get_df_large())
+    header = cacheSerializer.read_header(data)
+    assert header['codec'] == cacheSerializer.CODEC_NONE
+    assert header['size_stored'] == header['size_raw']
+
+    # explicit codec that is not installed
+    monkeypatch.setenv("ISITFIT_CACHE_COMPRESSION", "lz4")
+    assert cacheSerializer.get_codec() == cacheSerializer.CODEC_NONE
+
+    from isitfit.cli.click_descendents import IsitfitCliError
+    monkeypatch.setenv("ISITFIT_CACHE_COMPRESSION", "foo")
+    with pytest.raises(IsitfitCliError):
+      cacheSerializer.get_codec()
+
+  def test_codecNotInstalled(self, codec_mocked, monkeypatch):
+    data = serialize(self.get_df_large())
+    monkeypatch.setattr(cacheSerializer, 'get_codec_functions', lambda codec: None)
+    assert deserialize(data) is None
+
+
+class MockRedis:
+  def __init__(self):
+    self.data = {}
+    self.n_roundtrips = 0
+
+  def set(self, name, value, ex): self.data[name] = bytes(value)
+  def get(self, name):
+    self.n_roundtrips += 1
+    return self.data.get(name, None)
+  def mget(self, names): return [self.data.get(x, None) for x in names]
+
+  def pipeline(self, transaction):
+    client = self
+    class Pipeline:
+      def __init__(self): self.calls = []
+      def set(self, **kwargs): self.calls.append(lambda: client.set(**kwargs))
+      def mget(self, names): self.calls.append(lambda: client.mget(names))
+      def execute(self):
+        client.n_roundtrips += 1
+        return [c() for c in self.calls]
+    return Pipeline()
+
+
+def test_redisPandas_setGet():
+  from isitfit.cost.cacheManager import RedisPandas
+  rp = RedisPandas()
+  rp.redis_client = MockRedis()
+  df = get_df()
+  rp.set('cloudwatch:cpu:i-1:7', df)
+  rp.flush()
+  assert list(rp.redis_client.data.keys()) == [versioned_key('cloudwatch:cpu:i-1:7')]
+  pd.testing.assert_frame_equal(rp.get('cloudwatch:cpu:i-1:7'), df)
+  assert rp.get('cloudwatch:cpu:i-2:7') is None
+
+
+def test_redisPandas_batched():
+  from isitfit.cost.cacheManager import RedisPandas
+  rp = RedisPandas()
+  rp.redis_client = MockRedis()
+  rp.write_batchSize = 3
+  rp.mget_batchSize = 2
+  df = get_df()
+
+  # buffered writes are readable before the flush
+  rp.set('k1', df)
+  rp.set('k2', df)
+  assert rp.redis_client.data == {}
+  pd.testing.assert_frame_equal(rp.get('k1'), df)
+
+  # 3rd write flushes the buffer in 1 round trip
+  rp.set('k3', df)
+  assert len(rp.redis_client.data) == 3
+
+  # bulk get in 1 round trip
+  n_roundtrips = rp.redis_client.n_roundtrips
+  actual = rp.mget(['k1', 'k2', 'k3', 'k4', 'k5'])
+  assert set(actual.keys()) == {'k1', 'k2', 'k3'}
+  assert rp.redis_client.n_roundtrips == n_roundtrips + 1
+
+
+def test_metricCacheMixin_prefetch(mocker):
+  from isitfit.cost.cacheManager import RedisPandas
+  from isitfit.cost.metrics_cloudwatch import CloudwatchEc2
+  from isitfit.tests.cost.test_metricsDatadog_unit import get_df_days
+  rp = RedisPandas()
+  rp.redis_client = MockRedis()
+  df = get_df_days()
+
+  # 1st run caches i-1
+  cw = CloudwatchEc2(rp)
+  mocker.patch.object(cw, 'handle_main', return_value=df)
+  cw.get_metrics_derived({}, 'i-1', None)
+  rp.flush()
+
+  # 2nd run
+  cw = CloudwatchEc2(rp)
+  assert cw.cache_prefetch(['i-1', 'i-2']) == ['i-2']
+
+  # no further round trips to redis in get_metrics_derived
+  handle_main = mocker.patch.object(cw, 'handle_main', return_value=df)
+  n_roundtrips = rp.redis_client.n_roundtrips
+  pd.testing.assert_frame_equal(cw.get_metrics_derived({}, 'i-1', None), df)
+  pd.testing.assert_frame_equal(cw.get_metrics_derived({}, 'i-2', None), df)
+  assert rp.redis_client.n_roundtrips == n_roundtrips
+  assert handle_main.call_count == 1 # only for i-2
@@ -0,0 +1,112 @@
+import pandas as pd
+import pytest
+
+from isitfit.cost import cacheStats
+from isitfit.cost.cacheStats import CacheStats, key2namespace, latency2bucket
+from isitfit.tests.cost.test_cacheSerializer import MockRedis, get_df
+
+
+@pytest.fixture
+def stats(monkeypatch):
+  stats = CacheStats()
+  monkeypatch.setattr(cacheStats, '_shared', stats)
+  return stats
+
+
+def test_key2namespace():
+  assert key2namespace('cloudwatch:cpu:i-1') == 'cloudwatch'
+  assert key2namespace('datadog:cpu+ram:i-1') == 'datadog'
+  assert key2namespace('cloudtrail_ec2type._fetch') == 'cloudtrail'
+  assert key2namespace('foo') == 'other'
+
+
+def test_latency2bucket():
+  assert latency2bucket(0.0005) == '<=1ms'
+  assert latency2bucket(0.003) == '<=5ms'
+  assert latency2bucket(2) == '>1000ms'
+
+
+def test_redisPandas(stats, tmpdir):
+  from isitfit.cost.cacheManager import RedisPandas, NegativeCacheEntry
+  from isitfit.utils import NoCloudwatchException
+  rp = RedisPandas()
+  rp.redis_client = MockRedis()
+  rp.set('cloudwatch:cpu:i-1', get_df())
+  rp.set('cloudwatch:cpu:i-2', NegativeCacheEntry(NoCloudwatchException(), 'cloudwatch'))
+  rp.flush()
+
+  rp.get('cloudwatch:cpu:i-1')
+  rp.get('cloudwatch:cpu:i-3')
+  rp.mget(['cloudwatch:cpu:i-2', 'datadog:cpu+ram:i-1'])
+
+  c = stats.counters['cloudwatch']
+  assert (c['hits'], c['hits_negative'], c['misses'], c['n_set']) == (1, 1, 1, 2)
+  assert c['bytes_read'] == c['bytes_written'] > 0 # both keys read back
+  assert stats.counters['datadog']['misses'] == 1
+  assert sum(stats.latency['cloudwatch']['get'].values()) == 3
+  assert sum(stats.latency['cloudwatch']['set'].values()) == 2
+
+  # saved and loaded for `isitfit cache stats`
+  filename = str(tmpdir.join('stats.json'))
+  stats.save(filename)
+  stats_d = cacheStats.load_stats(filename)
+  assert stats_d['counters']['cloudwatch']['hits'] == 1
+  assert 'cloudwatch' in cacheStats.stats2table(stats_d)
+  assert '<=1ms' in cacheStats.latency2table(stats_d)
+
+
+def test_reportOnce(stats, tmpdir, mocker, capsys):
+  from isitfit.cost.cacheManager import RedisPandas
+  mocker.patch('isitfit.dotMan.DotMan.tempdir', return_value=str(tmpdir))
+
+  # the ec2 and redshift pipelines each flush their cache at the end, without reporting
+  rp = RedisPandas()
+  rp.redis_client = MockRedis()
+  rp.get('cloudwatch:cpu:i-1')
+  rp.handle_all({})
+  rp.handle_all({})
+  assert capsys.readouterr().out == ''
+
+  # reported once by the CLI command
+  cacheStats.report_cacheStats()
+  assert capsys.readouterr().out.count('Cache usage') == 1
+  assert cacheStats.load_stats()['counters']['cloudwatch']['misses'] == 1
+
+
+def test_scanPurge(stats, tmpdir):
+  from isitfit.cost.cacheManager import RedisPandas
+  from isitfit.cost.cacheLocal import LocalRedis
+  rp = RedisPandas()
+  rp.redis_client = LocalRedis(str(tmpdir.join('cache.sqlite')))
+  for k in ['cloudwatch:cpu:i-1', 'cloudwatch:cpu:i-2', 'datadog:cpu+ram:i-1']:
+    rp.set(k, get_df())
+
+  rp.flush()
+  actual = dict(rp.scan())
+  assert set(actual.keys()) == {'cloudwatch:cpu:i-1', 'cloudwatch:cpu:i-2', 'datadog:cpu+ram:i-1'}
+  assert actual['cloudwatch:cpu:i-1']['size_stored'] > 0
+
+  assert rp.purge('cloudwatch') == 2
+  assert [k for k, _ in rp.scan()] == ['datadog:cpu+ram:i-1']
+  assert rp.get('cloudwatch:cpu:i-1') is None
+
+
+def test_cliStats_noCache(mocker, monkeypatch, tmpdir):
+  # `isitfit cache stats` only reads the stats file, so it does not need a cache backend
+  monkeypatch.setenv("ISITFIT_CACHE_LOCAL", "0")
+  monkeypatch.delenv("ISITFIT_REDIS_HOST", raising=False)
+  mocker.patch('isitfit.dotMan.DotMan.tempdir', return_value=str(tmpdir))
+  mocker.patch('isitfit.utils.ping_matomo')
+  mocker.patch('isitfit.cli.click_descendents.display_footer')
+  mocker.patch('isitfit.cli.click_descendents.ask_feedback')
+
+  from click.testing import CliRunner
+  from isitfit.cli.cache import cache as cli_cache
+  result = CliRunner().invoke(cli_cache, ['stats'], obj={})
+  assert not result.exception
+  assert 'No cache stats found' in result.output
+
+  # ls needs the cache
+  result = CliRunner().invoke(cli_cache, ['ls'], obj={})
+  assert result.exit_code == 10
+  assert 'No cache configured' in result.output
@@ -0,0 +1,144 @@
+import pytest
+
+from isitfit.cost.cacheWarm import WarmCheckpoint, CacheWarmer
+from isitfit.utils import TokenBucket, NoCloudwatchException
+
+
+def test_tokenBucket(mocker):
+  # fake clock advanced by sleep
+  clock = [0]
+  mocker.patch('time.monotonic', side_effect=lambda: clock[0])
+  def mock_sleep(x): clock[0] += x
+  mock_sleep = mocker.patch('time.sleep', side_effect=mock_sleep)
+
+  bucket = TokenBucket(rate=2, capacity=2)
+  bucket.acquire()
+  bucket.acquire()
+  assert mock_sleep.call_count == 0
+
+  # 3rd token needs to wait for the refill
+  bucket.acquire()
+  assert mock_sleep.call_count == 1
+  assert clock[0] == 0.5
+
+  # disabled
+  TokenBucket(0).acquire(100)
+  assert mock_sleep.call_count == 1
+
+  # the parent budget is taken too, even if this bucket has no limit
+  child = TokenBucket(0, parent=bucket)
+  child.acquire()
+  assert mock_sleep.call_count == 2
+
+
+def test_rateLimitedPages():
+  from isitfit.utils import rate_limited_pages
+  from isitfit.tests.cost.test_cloudtrail_iterator_unit import MockBucket
+  bucket = MockBucket()
+  pages = [{'NextToken': 'a'}, {}]
+  assert list(rate_limited_pages(iter(pages), bucket)) == pages
+  assert bucket.n == 2
+  assert list(rate_limited_pages(iter(pages), None)) == pages
+
+
+def test_getSources_bucket(mocker):
+  mocker.patch('isitfit.cost.metrics_datadog.DatadogManager.is_configured', return_value=True)
+  bucket = TokenBucket(0)
+  warmer = CacheWarmer(mocker.Mock(), 7, 2, bucket, None)
+  source_l = warmer.get_sources([], [])
+  assert len(source_l) == 3
+  assert source_l[0][0].assistant.bucket is bucket
+  assert source_l[1][0].assistant.bucket is bucket
+  assert source_l[2][0].bucket is bucket
+
+
+class TestWarmCheckpoint:
+  def test_saveLoad(self, tmpdir):
+    fn = str(tmpdir.join('ckpt.json'))
+    ckpt = WarmCheckpoint('default', 7, fn)
+    ckpt.add('cloudwatch:cpu:i-1')
+    ckpt.save()
+
+    ckpt = WarmCheckpoint('default', 7, fn)
+    ckpt.load()
+    assert ckpt.is_done('cloudwatch:cpu:i-1')
+
+    # different ndays
+    ckpt = WarmCheckpoint('default', 30, fn)
+    ckpt.load()
+    assert not ckpt.is_done('cloudwatch:cpu:i-1')
+
+    ckpt.remove()
+    ckpt.remove()
+
+
+class MockMetrics:
+  prefetch_once = False
+
+  def __init__(self, fail_ids):
+    self.fail_ids = fail_ids
+    self.prefetched = {}
+    self.fetched = []
+    self.n_pre = []
+
+  def get_key(self, rc_id): return "cloudwatch:cpu:%s"%rc_id
+  def handle_pre(self, context_pre):
+    self.n_pre.append(len(context_pre['ec2_instances']))
+    self.prefetched = {rc_id: None for _, rc_id, _, _ in context_pre['ec2_instances'][:1]}
+
+  def get_metrics_derived(self, rc_describe_entry, rc_id, rc_created):
+    self.fetched.append(rc_id)
+    if rc_id == 'i-nodata': raise NoCloudwatchException()
+    if rc_id in self.fail_ids: raise ValueError("throttled")
+
+
+class MockIterator(list):
+  def get_regionInclude(self): return ['us-east-1']
+
+
+def test_warm_resume(mocker, tmpdir):
+  ec2_l = MockIterator([({}, rc_id, None, None) for rc_id in ['i-1', 'i-2', 'i-nodata', 'i-fail']])
+  cache_man = mocker.Mock()
+  fn = str(tmpdir.join('ckpt.json'))
+
+  # 1st run fails for 1 instance
+  metrics = MockMetrics(['i-fail'])
+  warmer = CacheWarmer(cache_man, 7, 2, TokenBucket(0), WarmCheckpoint('default', 7, fn))
+  warmer.chunk_size = 2
+  mocker.patch.object(warmer, 'get_sources', return_value=[(metrics, ec2_l)])
+  warm_cloudtrail = mocker.patch.object(warmer, 'warm_cloudtrail')
+  warmer.warm(ec2_l, MockIterator(), None)
+  assert sorted(metrics.fetched) == ['i-1', 'i-2', 'i-fail', 'i-nodata']
+  assert (warmer.n_done, warmer.n_failed) == (3, 1)
+  assert warm_cloudtrail.call_count == 1
+  assert cache_man.flush.call_count == 3
+
+  # 2nd run resumes with the failed instance only, then removes the checkpoint
+  import os
+  assert os.path.exists(fn)
+  metrics = MockMetrics([])
+  ckpt = WarmCheckpoint('default', 7, fn)
+  ckpt.load()
+  warmer = CacheWarmer(cache_man, 7, 2, TokenBucket(0), ckpt)
+  mocker.patch.object(warmer, 'get_sources', return_value=[(metrics, ec2_l)])
+  mocker.patch.object(warmer, 'warm_cloudtrail')
+  warmer.warm(ec2_l, MockIterator(), None)
+  assert metrics.fetched == ['i-fail']
+  assert (warmer.n_done, warmer.n_skipped, warmer.n_failed) == (1, 3, 0)
+  assert not os.path.exists(fn)
+
+
+@pytest.mark.parametrize("prefetch_once, n_pre", [(False, [2, 2, 1]), (True, [5])])
+def test_warm_prefetchOnce(mocker, tmpdir, prefetch_once, n_pre):
+  ec2_l = MockIterator([({}, 'i-%i'%i, None, None) for i in range(5)])
+  metrics = MockMetrics([])
+  metrics.prefetch_once = prefetch_once
+  warmer = CacheWarmer(mocker.Mock(), 7, 2, TokenBucket(0), WarmCheckpoint('default', 7, str(tmpdir.join('ckpt.json'))))
+  warmer.chunk_size = 2
+  mocker.patch.object(warmer, 'get_sources', return_value=[(metrics, ec2_l)])
+  mocker.patch.object(warmer, 'warm_cloudtrail')
+  warmer.warm(ec2_l, MockIterator(), None)
+
+  # datadog is prefetched once for all the hosts, cloudwatch per chunk
+  assert metrics.n_pre == n_pre
+  assert sorted(metrics.fetched) == ['i-%i'%i for i in range(5)]
@@ -0,0 +1,74 @@
+import datetime as dt
+
+import pandas as pd
+import pytest
+
+from isitfit.cost.cloudtrail_ec2type import CloudtrailCached
+from isitfit.utils import NoCloudtrailException
+from isitfit.tests.cost.test_cloudtrail_iterator_benchmark import EndTime, get_instances, eap_mocked
+
+
+@pytest.fixture
+def ctc_mocked(eap_mocked):
+  def factory(ec2_instances):
+    eap_mocked(ec2_instances)
+    ctc = CloudtrailCached(EndTime, None, lambda x, **kwargs: x)
+    ctc.init_data({'ec2_instances': ec2_instances, 'region_include': ['us-east-1', 'us-west-2'], 'n_ec2_total': len(ec2_instances)})
+    return ctc
+
+  return factory
+
+
+class TestCloudtrailCached:
+  def test_single(self, ctc_mocked):
+    ec2_instances = get_instances(20)
+    ctc = ctc_mocked(ec2_instances)
+    assert len(ctc.history) == 20
+
+    for ec2_dict, rc_id, _, _ in ec2_instances:
+      context_ec2 = ctc.single({'ec2_dict': ec2_dict, 'ec2_id': rc_id})
+
+      # same as the chained .loc lookups
+      df_exp = ctc.df_cloudtrail.loc[ec2_dict['Region']].loc[ec2_dict['ServiceName']].loc[rc_id]
+      event_time, event_name, size1, size2 = context_ec2['type_history']
+      assert list(event_time) == df_exp.index.tolist()
+      assert list(event_name) == df_exp.EventName.tolist()
+      assert list(size1) == df_exp.ResourceSize1.tolist()
+      assert list(size2) == df_exp.ResourceSize2.tolist()
+
+    # 2 rows, sorted descending: "now" then the synthetic event
+    event_time, _, size1, _ = ctc.single({'ec2_dict': ec2_instances[0][0], 'ec2_id': ec2_instances[0][1]})['type_history']
+    assert list(event_time) == [EndTime, EndTime - dt.timedelta(days=1)]
+    assert list(size1) == ['dc2.large', 't2.nano']
+
+
+  def test_mergeHistory(self, ctc_mocked):
+    # the arrays of single are merged with the daily metrics as the dataframe of the chained .loc lookups was
+    ec2_instances = get_instances(20)
+    ctc = ctc_mocked(ec2_instances)
+    ec2_dict, rc_id = ec2_instances[5][0], ec2_instances[5][1]
+    event_time, _, size1, _ = ctc.single({'ec2_dict': ec2_dict, 'ec2_id': rc_id})['type_history']
+
+    from isitfit.utils import mergeHistoryOnTimestampRange
+    df_metrics = pd.DataFrame({'Timestamp': [EndTime - dt.timedelta(days=i) for i in range(3)][::-1]})
+    actual = mergeHistoryOnTimestampRange(df_metrics, event_time, {'instanceType': size1})
+    assert actual.instanceType.tolist() == ['t2.nano', 't2.nano', 't2.micro']
+
+
+  def test_noData(self, ctc_mocked):
+    ctc = ctc_mocked(get_instances(5))
+    ec2_dict = {'Region': 'us-west-2', 'InstanceType': 't2.micro', 'InstanceId': 'i-other'}
+    with pytest.raises(NoCloudtrailException):
+      ctc.single({'ec2_dict': ec2_dict, 'ec2_id': 'i-other'})
+
+    # in another region
+    ec2_dict = {'Region': 'eu-west-1', 'InstanceType': 't2.micro', 'InstanceId': 'i-1'}
+    with pytest.raises(NoCloudtrailException):
+      ctc.single({'ec2_dict': ec2_dict, 'ec2_id': 'i-1'})
+
+
+  def test_empty(self, mocker):
+    mocker.patch('isitfit.cost.cloudtrail_iterator.EventAggregatorCached.get', return_value=pd.DataFrame())
+    ctc = CloudtrailCached(EndTime, None, lambda x, **kwargs: x)
+    ctc.init_data({'ec2_instances': [], 'region_include': [], 'n_ec2_total': 0})
+    assert ctc.history == {}
@@ -0,0 +1,201 @@
+"""
+Scaling checks of the cloudtrail post-processing (Pass 1/2) on synthetic fleets.
+They assert on the number of calls of the costly operations rather than on wall-clock time, which is flaky on shared CI runners
+"""
+
+import datetime as dt
+
+import pandas as pd
+import pytest
+
+from isitfit.cost.cloudtrail_iterator import EventAggregatorPostprocessed, dict2service
+
+
+EndTime = dt.datetime(2020, 2, 1)
+
+
+def get_instances(n):
+  """
+  Synthetic fleet of n resources, 1 redshift cluster for every 9 ec2 instances
+  """
+  ec2_instances = []
+  for i in range(n):
+    if i%10 == 0:
+      rc_id = 'cluster-%i'%i
+      ec2_dict = {'Region': 'us-east-1', 'NodeType': 'dc2.large', 'NumberOfNodes': 2, 'ClusterIdentifier': rc_id}
+    else:
+      rc_id = 'i-%i'%i
+      ec2_dict = {'Region': 'us-west-2', 'InstanceType': 't2.micro', 'InstanceId': rc_id}
+
+    ec2_instances.append((ec2_dict, rc_id, None, None))
+
+  return ec2_instances
+
+
+def get_cloudtrail(ec2_instances):
+  """
+  Synthetic cloudtrail history with 1 event for every 5 resources, as returned by EventAggregatorAllRegions
+  """
+  df = pd.DataFrame([
+    {
+      'Region': ec2_dict['Region'],
+      'ServiceName': dict2service(ec2_dict),
+      'ResourceName': rc_id,
+      'EventTime': EndTime - dt.timedelta(days=1),
+      'EventName': 'RunInstances',
+      'ResourceSize1': 't2.nano',
+      'ResourceSize2': None,
+    }
+    for ec2_dict, rc_id, _, _ in ec2_instances[::5]
+  ])
+  return df.set_index(["Region", "ServiceName", "ResourceName", "EventTime"]).sort_index()
+
+
+@pytest.fixture
+def eap_mocked(mocker):
+  def factory(ec2_instances):
+    mocker.patch('isitfit.cost.cloudtrail_iterator.EventAggregatorCached.get', return_value=get_cloudtrail(ec2_instances))
+    tqdmman = lambda x, **kwargs: x
+    return EventAggregatorPostprocessed(['us-east-1', 'us-west-2'], tqdmman, None, EndTime)
+
+  return factory
+
+
+def test_appendNow_sameAsPerRow(eap_mocked):
+  ec2_instances = get_instances(50)
+  eap = eap_mocked(ec2_instances)
+  df_batch = eap.get(ec2_instances, len(ec2_instances))
+
+  # reference: a pd.concat per resource, as before the rows were batched
+  df_ref = get_cloudtrail(ec2_instances).reset_index()
+  for ec2_dict, rc_id, _, _ in ec2_instances:
+    row = dict(zip(['Region', 'ServiceName', 'ResourceName', 'ResourceSize1', 'ResourceSize2'], eap._appendNow(ec2_dict, rc_id)))
+    row['EventTime'] = EndTime
+    df_ref = pd.concat([df_ref, pd.DataFrame([row])], sort=True)
+
+  df_ref = df_ref.set_index(["Region", "ServiceName", "ResourceName", "EventTime"]).sort_index(ascending=False)
+  pd.testing.assert_frame_equal(df_ref, df_batch)
+  assert df_batch.ResourceSize2.dtype == object
+  assert df_batch.loc['us-west-2', 'EC2', 'i-1', EndTime].ResourceSize2 is None
+
+
+def test_appendNow_10k(eap_mocked, mocker):
+  n_ec2 = 10000
+  ec2_instances = get_instances(n_ec2)
+  eap = eap_mocked(ec2_instances)
+
+  concat = mocker.spy(pd, 'concat')
+  df_post = eap.get(ec2_instances, n_ec2)
+  assert df_post.shape[0] == n_ec2 + n_ec2//5
+
+  # a single pd.concat for the whole fleet, instead of one per resource which took minutes
+  assert concat.call_count == 1
+
+
+#----------------------------------------
+# Parsing of CloudTrailEvent
+
+# synthetic rows, same columns as the cloudtrail fixture
+SYNTHETIC_ROWS = [
+  {'ServiceName': 'EC2', 'EventName': 'RunInstances', 'ResourceName': 'i-1', 'ResourceSize1': 't2.micro', 'ResourceSize2': None},
+  {'ServiceName': 'EC2', 'EventName': 'ModifyInstanceAttribute', 'ResourceName': 'i-1', 'ResourceSize1': 't2.large', 'ResourceSize2': None},
+  {'ServiceName': 'Redshift', 'EventName': 'CreateCluster', 'ResourceName': 'cluster-1', 'ResourceSize1': 'dc2.large', 'ResourceSize2': 2},
+  {'ServiceName': 'Redshift', 'EventName': 'ResizeCluster', 'ResourceName': 'cluster-1', 'ResourceSize1': 'dc2.large', 'ResourceSize2': 4},
+]
+
+
+def get_fixture_rows():
+  """
+  Rows of the cloudtrail fixture (one region)
+  """
+  import os
+  fix_fn = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fixture_cloudtrailIterator_oneRegion_AutofitCloud-shadi_20191202.pkl")
+  try:
+    df = pd.read_pickle(fix_fn)
+  except (AttributeError, ImportError) as e:
+    # eg "Can't get attribute 'FrozenNDArray'", since the fixture refers to pandas internals that were removed since
+    pytest.skip("Fixture %s was pickled with an older pandas and cannot be read with pandas %s: %s"%(os.path.basename(fix_fn), pd.__version__, str(e)))
+
+  return df.reset_index().to_dict(orient='records')
+
+
+def row2event(row):
+  """
+  Raw LookupEvents event of a fixture row, with a large responseElements like that of RunInstances
+  """
+  import json
+  rc_id, size1, size2 = row['ResourceName'], row['ResourceSize1'], row['ResourceSize2']
+  request = {
+    'RunInstances': {'instanceType': size1, 'instancesSet': {'items': [{'imageId': 'ami-1234', 'minCount': 1, 'maxCount': 1}]}},
+    'ModifyInstanceAttribute': {'instanceId': rc_id, 'instanceType': {'value': size1}},
+    'CreateCluster': {'clusterIdentifier': rc_id, 'nodeType': size1, 'numberOfNodes': size2},
+    'ResizeCluster': {'clusterIdentifier': rc_id, 'instanceType': size1, 'numberOfNodes': size2},
+  }[row['EventName']]
+  response = {'instancesSet': {'items': [{'instanceId': rc_id, 'blockDeviceMapping': {}, 'tagSet': {'items': [{'key': 'k%i'%i, 'value': 'v'*50} for i in range(50)]}}]}}
+  ct_event = {
+    'eventVersion': '1.05',
+    'userIdentity': {'type': 'IAMUser', 'arn': 'arn:aws:iam::123456789012:user/someone'},
+    'eventTime': '2019-12-01T00:00:00Z',
+    'eventName': row['EventName'],
+    'requestParameters': request,
+    'responseElements': response,
+    'requestID': 'abcd',
+  }
+  resource_type = 'AWS::EC2::Instance' if row['ServiceName']=='EC2' else 'AWS::Redshift::Cluster'
+  return {
+    'EventTime': EndTime,
+    'Resources': [{'ResourceType': resource_type, 'ResourceName': rc_id}],
+    'CloudTrailEvent': json.dumps(ct_event),
+  }
+
+
+def check_parseCloudTrailEvent(row_l, mocker):
+  from isitfit.cost.cloudtrail_iterator import Ec2Run, Ec2Modify, RedshiftCreate, RedshiftResize
+  from isitfit.cost import cloudtrail_parser
+  iterator_d = {cls.eventName: cls() for cls in [Ec2Run, Ec2Modify, RedshiftCreate, RedshiftResize]}
+  event_l = [(iterator_d[row['EventName']], row2event(row)) for row in row_l]
+
+  # same fields as the rows
+  for row, (it, event) in zip(row_l, event_l):
+    result = it._handleEvent(event)
+    assert (result['ResourceName'], result['ResourceSize1']) == (row['ResourceName'], row['ResourceSize1'])
+
+  # 10k events: the whole events are never decoded, and the jmespath expressions are not compiled again
+  event_l = (event_l * (10000//len(event_l) + 1))[:10000]
+  import jmespath
+  loads_full = mocker.spy(cloudtrail_parser, '_loads_full')
+  jp_compile = mocker.spy(jmespath, 'compile')
+  for it, event in event_l:
+    it._handleEvent(event)
+
+  assert loads_full.call_count == 0
+  assert jp_compile.call_count == 0
+
+
+def test_parseCloudTrailEvent(mocker):
+  check_parseCloudTrailEvent(SYNTHETIC_ROWS, mocker)
+
+
+def test_parseCloudTrailEvent_fixture(mocker):
+  check_parseCloudTrailEvent(get_fixture_rows(), mocker)
+
+
+#----------------------------------------
+# Per-resource lookup of the history, in CloudtrailCached.single
+
+def test_single_10k(eap_mocked, mocker):
+  from isitfit.cost.cloudtrail_ec2type import CloudtrailCached
+  n_ec2 = 10000
+  ec2_instances = get_instances(n_ec2)
+  eap_mocked(ec2_instances)
+  ctc = CloudtrailCached(EndTime, None, lambda x, **kwargs: x)
+  ctc.init_data({'ec2_instances': ec2_instances, 'region_include': ['us-east-1', 'us-west-2'], 'n_ec2_total': n_ec2})
+
+  # the lookup does not touch pandas, eg neither .loc on df_cloudtrail nor a dataframe per resource
+  mock_pd = mocker.patch('isitfit.cost.cloudtrail_ec2type.pd')
+  mock_df = mocker.patch.object(ctc, 'df_cloudtrail')
+  for ec2_dict, rc_id, _, _ in ec2_instances:
+    ctc.single({'ec2_dict': ec2_dict, 'ec2_id': rc_id})
+
+  assert mock_pd.mock_calls == []
+  assert mock_df.mock_calls == []
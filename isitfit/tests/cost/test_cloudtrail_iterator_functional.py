@@ -80,12 +80,13 @@ def test_cached():
 
     # set up main class, and use a test cache key
     eac = EventAggregatorCached(region_include, tqdmman, cm)
-    eac.cache_key = 'cloudtrail_iterator.test'
+    eac.cache_prefix = 'cloudtrail_iterator.test'
 
-    # delete the key if used
+    # delete the keys if used
     assert cm.isSetup()
     cm.connect()
-    cm.redis_client.delete(eac.cache_key)
+    from isitfit.cost.cacheSerializer import versioned_key
+    cm.redis_client.delete(*[versioned_key(k) for k in eac.get_keys()])
 
     # get pandas dataframe
     df_cached = eac.get()
@@ -0,0 +1,200 @@
+import datetime as dt
+import pytest
+
+from isitfit.cost.cloudtrail_iterator import EventAggregatorCached, EventAggregatorAllRegions, EventIterator, history_append, CLOUDTRAIL_CURSOR_LAG
+
+
+dt_now = dt.datetime.now(dt.timezone.utc).replace(microsecond=0)
+
+def get_event(days_ago, instance_id='i-1'):
+  return {
+    'ServiceName': 'EC2',
+    'EventName': 'RunInstances',
+    'EventTime': dt_now - dt.timedelta(days=days_ago),
+    'ResourceName': instance_id,
+    'ResourceSize1': 't2.micro',
+    'ResourceSize2': None
+  }
+
+
+class MockIterator:
+  eventName = 'RunInstances'
+
+  # events returned by the next call, and StartTime of each call
+  events = []
+  calls = []
+
+  def __init__(self, StartTime=None, EndTime=None, client=None, bucket=None):
+    self.StartTime = StartTime
+    self.EndTime = EndTime
+    self.cursor = None
+
+  def iterate_event(self):
+    MockIterator.calls.append(self.StartTime if self.EndTime is None else (self.StartTime, self.EndTime))
+    for event in MockIterator.events:
+      if self.StartTime is not None and event['EventTime'] < self.StartTime: continue
+      if self.EndTime is not None and event['EventTime'] > self.EndTime: continue
+      if self.cursor is None or event['EventTime'] > self.cursor: self.cursor = event['EventTime']
+      yield event
+
+
+class MockCacheMan:
+  def __init__(self): self.cache = {}
+  def isReady(self): return True
+  def get(self, key): return self.cache.get(key, None)
+  def set(self, key, value, ex=None): self.cache[key] = value
+
+
+@pytest.fixture
+def eac_mocked():
+  MockIterator.events = []
+  MockIterator.calls = []
+  eac = EventAggregatorCached(['us-east-1'], None, MockCacheMan())
+  eac.iterator_classes = [MockIterator]
+  return eac
+
+
+class TestEventAggregatorCached:
+  def test_keys(self, eac_mocked):
+    key_l = eac_mocked.get_keys()
+    assert len(key_l) == 1
+    assert key_l[0].startswith('cloudtrail:')
+    assert key_l[0].endswith(':us-east-1:RunInstances')
+
+
+  def test_fetchAll(self, eac_mocked):
+    MockIterator.events = [get_event(10), get_event(5)]
+    events = eac_mocked.get_events(MockIterator, 'us-east-1')
+    assert len(events) == 2
+    assert MockIterator.calls == [None]
+
+    history = eac_mocked.cache_man.cache[eac_mocked.get_keys()[0]]
+    assert history['cursor'] == dt_now - dt.timedelta(days=5)
+
+    # fresh cache, no new call
+    events = eac_mocked.get_events(MockIterator, 'us-east-1')
+    assert len(events) == 2
+    assert MockIterator.calls == [None]
+
+
+  def test_fetchAfterCursor(self, eac_mocked):
+    cursor = dt_now - dt.timedelta(days=5)
+    key = eac_mocked.get_keys()[0]
+    eac_mocked.cache_man.cache[key] = {'events': [get_event(95), get_event(10), get_event(5)], 'cursor': cursor, 'dt_refreshed': 0}
+
+    # the event at the cursor is returned again, and a new event after it
+    MockIterator.events = [get_event(10), get_event(5), get_event(1, 'i-2')]
+    events = eac_mocked.get_events(MockIterator, 'us-east-1')
+    assert MockIterator.calls == [cursor - dt.timedelta(seconds=CLOUDTRAIL_CURSOR_LAG)]
+
+    # no duplicates, and the event older than 90 days dropped
+    assert len(events) == 3
+    assert [e['ResourceName'] for e in events] == ['i-1', 'i-1', 'i-2']
+    assert eac_mocked.cache_man.cache[key]['cursor'] == dt_now - dt.timedelta(days=1)
+
+
+  def test_noNewEvents(self, eac_mocked):
+    cursor = dt_now - dt.timedelta(days=5)
+    key = eac_mocked.get_keys()[0]
+    eac_mocked.cache_man.cache[key] = {'events': [get_event(5)], 'cursor': cursor, 'dt_refreshed': 0}
+
+    events = eac_mocked.get_events(MockIterator, 'us-east-1')
+    assert len(events) == 1
+    assert eac_mocked.cache_man.cache[key]['cursor'] == cursor
+    assert eac_mocked.cache_man.cache[key]['dt_refreshed'] > 0
+
+
+  def test_window(self, eac_mocked):
+    MockIterator.events = [get_event(60), get_event(20), get_event(5)]
+    key = eac_mocked.get_keys()[0]
+
+    # ndays=7 only fetches the window, plus the day before it
+    eac_mocked.StartTime = dt_now - dt.timedelta(days=7)
+    events = eac_mocked.get_events(MockIterator, 'us-east-1')
+    fetch_start = dt_now - dt.timedelta(days=8)
+    assert MockIterator.calls == [fetch_start]
+    assert len(events) == 1
+    assert eac_mocked.cache_man.cache[key]['covered_from'] == fetch_start
+
+    # a smaller window is already covered
+    eac_mocked.StartTime = dt_now - dt.timedelta(days=3)
+    assert len(eac_mocked.get_events(MockIterator, 'us-east-1')) == 1
+    assert len(MockIterator.calls) == 1
+
+    # a larger window only fetches the missing days
+    eac_mocked.StartTime = dt_now - dt.timedelta(days=30)
+    events = eac_mocked.get_events(MockIterator, 'us-east-1')
+    assert MockIterator.calls[1] == (dt_now - dt.timedelta(days=31), fetch_start)
+    assert len(events) == 2
+    assert eac_mocked.cache_man.cache[key]['covered_from'] == dt_now - dt.timedelta(days=31)
+
+    # all 90 days, also once stale
+    eac_mocked.StartTime = None
+    eac_mocked.cache_man.cache[key]['dt_refreshed'] = 0
+    events = eac_mocked.get_events(MockIterator, 'us-east-1')
+    assert MockIterator.calls[2] == (None, dt_now - dt.timedelta(days=31))
+    assert MockIterator.calls[3] == dt_now - dt.timedelta(days=5, seconds=CLOUDTRAIL_CURSOR_LAG)
+    assert len(events) == 3
+    assert eac_mocked.cache_man.cache[key]['covered_from'] is None
+
+
+  def test_fetchStart(self, eac_mocked):
+    assert eac_mocked.get_fetchStart() is None
+    eac_mocked.StartTime = dt_now - dt.timedelta(days=10)
+    assert eac_mocked.get_fetchStart() == dt_now - dt.timedelta(days=11)
+    eac_mocked.StartTime = dt_now - dt.timedelta(days=90)
+    assert eac_mocked.get_fetchStart() is None
+
+
+def test_historyAppend():
+  assert history_append([], []) == []
+  assert len(history_append([get_event(1)], [get_event(1), get_event(1, 'i-2')])) == 2
+
+
+def test_redisPandas(tmpdir):
+  from isitfit.cost.cacheManager import RedisPandas
+  from isitfit.cost.cacheLocal import LocalRedis
+  rp = RedisPandas()
+  rp.redis_client = LocalRedis(str(tmpdir.join('cache.sqlite')))
+
+  eac = EventAggregatorCached(['us-east-1'], None, rp)
+  eac.iterator_classes = [MockIterator]
+  MockIterator.events = [get_event(5)]
+  MockIterator.calls = []
+  eac.get_events(MockIterator, 'us-east-1')
+  rp.flush()
+
+  history = rp.get(eac.get_keys()[0])
+  assert history['events'] == [get_event(5)]
+  assert history['cursor'] == dt_now - dt.timedelta(days=5)
+
+
+class MockBucket:
+  def __init__(self): self.n = 0
+  def acquire(self, n=1): self.n += n
+
+
+def test_rateLimited():
+  bucket = MockBucket()
+  it = EventIterator(bucket=bucket)
+  pages = [{'Events': [], 'NextToken': 'a'}, {'Events': [], 'NextToken': 'b'}, {'Events': []}]
+  assert list(it._rate_limited(iter(pages))) == pages
+  assert bucket.n == 3
+
+
+def test_allRegions(mocker):
+  class MockModify(MockIterator):
+    eventName = 'ModifyInstanceAttribute'
+    def iterate_event(self):
+      yield dict(get_event(3), EventName=self.eventName, ResourceSize1='t2.large')
+
+  MockIterator.events = [get_event(5)]
+  MockIterator.calls = []
+  eaa = EventAggregatorAllRegions(['us-east-1', 'us-west-2'], lambda x, **kwargs: x)
+  eaa.iterator_classes = [MockIterator, MockModify]
+  mocker.patch.object(eaa, '_get_client', side_effect=lambda region_name: 'client %s'%region_name)
+  df = eaa.get()
+  assert df.shape[0] == 4
+  assert df.index.names == ["Region", "ServiceName", "ResourceName", "EventTime"]
+  assert sorted(set(df.index.get_level_values('Region'))) == ['us-east-1', 'us-west-2']
+  assert len(MockIterator.calls) == 2 # 1 per region
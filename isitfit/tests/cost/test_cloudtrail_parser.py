@@ -0,0 +1,40 @@
+import json
+import pytest
+
+from isitfit.cost import cloudtrail_parser
+from isitfit.cost.cloudtrail_parser import loads_subtree, search, compile_expression
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def json_lib(request, monkeypatch):
+  if request.param == 'json':
+    monkeypatch.setattr(cloudtrail_parser, 'orjson', None)
+  elif cloudtrail_parser.orjson is None:
+    pytest.skip("orjson not installed")
+
+
+class TestLoadsSubtree:
+  def test_compact(self, json_lib):
+    ct_str = json.dumps({'eventName': 'RunInstances', 'requestParameters': {'instanceType': 't2.micro'}, 'responseElements': None}, separators=(',', ':'))
+    assert loads_subtree(ct_str, 'requestParameters') == {'instanceType': 't2.micro'}
+    assert loads_subtree(ct_str, 'responseElements') is None
+    assert loads_subtree(ct_str, 'additionalEventData') is None
+
+  def test_whitespace(self, json_lib):
+    ct_str = json.dumps({'requestParameters': {'instanceType': 't2.micro', 'note': 'a "quoted" string'}})
+    assert loads_subtree(ct_str, 'requestParameters') == {'instanceType': 't2.micro', 'note': 'a "quoted" string'}
+
+    # key separated from the colon: decodes the whole event
+    ct_str = '{"requestParameters" : {"instanceType": "t2.micro"}}'
+    assert loads_subtree(ct_str, 'requestParameters') == {'instanceType': 't2.micro'}
+
+  def test_invalid(self, json_lib):
+    ct_str = '{"requestParameters": {"instanceType": }}'
+    with pytest.raises(ValueError):
+      loads_subtree(ct_str, 'requestParameters')
+
+
+def test_search():
+  assert search('numberOfNodes', {'numberOfNodes': 2}) == 2
+  assert search('numberOfNodes', None) is None
+  assert compile_expression('nodeType') is compile_expression('nodeType')
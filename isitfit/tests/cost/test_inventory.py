@@ -0,0 +1,177 @@
+from isitfit.cost.inventory import InventorySnapshot
+
+
+class TestInventorySnapshot:
+  def test_setGet(self):
+    inv = InventorySnapshot()
+    assert not inv.has_region('ec2', 'us-east-1')
+
+    inv.set_region('ec2', 'us-east-1', [{'InstanceId': 'i-1'}, {'InstanceId': 'i-2'}])
+    inv.set_region('redshift', 'us-east-1', [])
+    assert inv.has_region('ec2', 'us-east-1')
+    assert inv.has_region('redshift', 'us-east-1')
+    assert not inv.has_region('ec2', 'us-west-2')
+
+    assert inv.get_region('ec2', 'us-east-1')[1]['InstanceId'] == 'i-2'
+    assert inv.count('ec2') == 2
+    assert inv.count('ec2', 'us-east-1') == 2
+    assert inv.count('ec2', 'us-west-2') == 0
+    assert inv.count('redshift') == 0
+
+
+def test_iterator_replaysSnapshot(mocker):
+  # mock the get regions part
+  mockreturn = lambda service, *args, **kwargs: ['us-west-2', 'us-east-1']
+  mockee = 'boto3.session.Session.get_available_regions'
+  mocker.patch(mockee, side_effect=mockreturn)
+
+  # do not save to the local cache file
+  mockee = 'isitfit.cost.base_iterator.SimpleCacheMan.save_key'
+  mocker.patch(mockee, autospec=True)
+
+  # mock the AWS list call
+  def mockreturn(region_name):
+    return [{'Region': region_name, 'ClusterIdentifier': 'rc-%s'%region_name}], None
+
+  from isitfit.cost.redshift_common import RedshiftPerformanceIterator
+  inv = InventorySnapshot()
+  rpi = RedshiftPerformanceIterator(inventory=inv)
+  rpi.region_include = []
+  rpi.regionInclude_ready = False
+  describe_region = mocker.patch.object(rpi, '_describe_region', side_effect=mockreturn)
+
+  # 1st pass lists, 2nd and 3rd passes replay from memory
+  x1 = list(rpi.iterate_core())
+  x2 = list(rpi.iterate_core())
+  x3 = list(rpi.iterate_core())
+  assert describe_region.call_count == 2 # once per region
+  assert x1 == x2
+  assert x1 == x3
+  assert [x['Region'] for x in x1] == ['us-west-2', 'us-east-1']
+  assert inv.count('redshift') == 2
+
+  # another iterator sharing the same snapshot does not list again
+  rpi2 = RedshiftPerformanceIterator(inventory=inv)
+  rpi2.region_include = ['us-west-2', 'us-east-1']
+  rpi2.regionInclude_ready = True
+  describe_region2 = mocker.patch.object(rpi2, '_describe_region', side_effect=mockreturn)
+  assert list(rpi2.iterate_core()) == x1
+  assert describe_region2.call_count == 0
+
+
+def test_iterator_regionErrorNotSnapshotted(mocker):
+  mockreturn = lambda service, *args, **kwargs: ['us-west-2', 'us-east-1']
+  mocker.patch('boto3.session.Session.get_available_regions', side_effect=mockreturn)
+  mocker.patch('isitfit.cost.base_iterator.SimpleCacheMan.save_key', autospec=True)
+
+  # us-east-1 fails midway with an error that is raised
+  import botocore
+  def mockreturn(region_name):
+    entries = [{'Region': region_name, 'ClusterIdentifier': 'rc-%s'%region_name}]
+    if region_name == 'us-west-2':
+      return entries, None
+
+    e = botocore.exceptions.ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}}, 'DescribeClusters')
+    return entries, e
+
+  from isitfit.cost.redshift_common import RedshiftPerformanceIterator
+  inv = InventorySnapshot()
+  rpi = RedshiftPerformanceIterator(inventory=inv)
+  rpi.region_include = []
+  rpi.regionInclude_ready = False
+  describe_region = mocker.patch.object(rpi, '_describe_region', side_effect=mockreturn)
+
+  import pytest
+  for i in range(2):
+    with pytest.raises(botocore.exceptions.ClientError):
+      list(rpi.iterate_core())
+
+  # the region with the error is described again, and its partial list never served from the snapshot
+  assert [c[0][0] for c in describe_region.call_args_list] == ['us-west-2', 'us-east-1', 'us-east-1']
+  assert inv.has_region('redshift', 'us-west-2')
+  assert not inv.has_region('redshift', 'us-east-1')
+
+
+class TestInventoryCache:
+  def _get_cache(self, mocker, tmpdir):
+    mockee = 'isitfit.dotMan.DotMan.tempdir'
+    mocker.patch(mockee, return_value=str(tmpdir))
+
+    from isitfit.cost.inventory import InventoryCache
+    return InventoryCache('default', 'ec2', 'InstanceId', ['State.Name', 'InstanceType'], ttl=600)
+
+  def test_disabled(self, mocker, tmpdir):
+    from isitfit.cost.inventory import InventoryCache
+    mocker.patch('isitfit.dotMan.DotMan.tempdir', return_value=str(tmpdir))
+    ic = InventoryCache('default', 'ec2', 'InstanceId', [])
+    assert not ic.is_enabled() # from conftest
+    ic.save('us-east-1', [{'InstanceId': 'i-1'}])
+    assert ic.load('us-east-1') is None
+
+  def test_loadFresh(self, mocker, tmpdir):
+    ic = self._get_cache(mocker, tmpdir)
+    assert ic.load('us-east-1') is None
+
+    entries = [{'InstanceId': 'i-1', 'InstanceType': 't2.micro', 'State': {'Name': 'running'}}]
+    ic.save('us-east-1', entries)
+    assert ic.load('us-east-1') == entries
+    assert ic.load('us-west-2') is None
+
+    # another object, eg in the next run, reads the same file
+    ic2 = self._get_cache(mocker, tmpdir)
+    assert ic2.load('us-east-1') == entries
+
+  def test_expiredDiff(self, mocker, tmpdir):
+    ic = self._get_cache(mocker, tmpdir)
+
+    mock_time = mocker.patch('time.time', return_value=1000)
+    e1 = {'InstanceId': 'i-1', 'InstanceType': 't2.micro', 'State': {'Name': 'running'}}
+    e2 = {'InstanceId': 'i-2', 'InstanceType': 't2.micro', 'State': {'Name': 'running'}}
+    ic.save('us-east-1', [e1, e2])
+
+    # after the TTL, the region is expired and kept for the diff
+    mock_time.return_value = 1000 + 601
+    assert ic.load('us-east-1') is None
+    assert 'us-east-1' in ic.stale
+
+    e1b = {'InstanceId': 'i-1', 'InstanceType': 't2.large', 'State': {'Name': 'stopped'}}
+    e3 = {'InstanceId': 'i-3', 'InstanceType': 't2.nano', 'State': {'Name': 'running'}}
+    ic.save('us-east-1', [e1b, e3])
+    assert ic.load('us-east-1') == [e1b, e3]
+
+    actual = [(c['change'], c['id']) for c in ic.changes]
+    assert actual == [('new', 'i-3'), ('removed', 'i-2'), ('changed', 'i-1')]
+    assert ic.changes[2]['old'] == {'State.Name': 'running', 'InstanceType': 't2.micro'}
+    assert ic.changes[2]['new'] == {'State.Name': 'stopped', 'InstanceType': 't2.large'}
+
+
+def test_iterator_loadsInventoryCache(mocker, monkeypatch, tmpdir):
+  monkeypatch.setenv("ISITFIT_INVENTORY_TTL", "600")
+  mocker.patch('isitfit.dotMan.DotMan.tempdir', return_value=str(tmpdir))
+
+  mockreturn = lambda service, *args, **kwargs: ['us-west-2', 'us-east-1']
+  mocker.patch('boto3.session.Session.get_available_regions', side_effect=mockreturn)
+
+  def mockreturn(region_name):
+    return [{'Region': region_name, 'ClusterIdentifier': 'rc-%s'%region_name}], None
+
+  from isitfit.cost.redshift_common import RedshiftPerformanceIterator
+  def get_rpi():
+    rpi = RedshiftPerformanceIterator()
+    rpi.region_include = []
+    rpi.regionInclude_ready = False
+    return rpi
+
+  # 1st run lists from AWS
+  rpi1 = get_rpi()
+  describe_region1 = mocker.patch.object(rpi1, '_describe_region', side_effect=mockreturn)
+  x1 = list(rpi1.iterate_core())
+  assert describe_region1.call_count == 2
+
+  # 2nd run, with a fresh in-memory snapshot, loads from the on-disk cache
+  rpi2 = get_rpi()
+  describe_region2 = mocker.patch.object(rpi2, '_describe_region', side_effect=mockreturn)
+  x2 = list(rpi2.iterate_core())
+  assert describe_region2.call_count == 0
+  assert x1 == x2
+  assert rpi2.region_include == ['us-west-2', 'us-east-1']
@@ -16,3 +16,100 @@ class TestMainManager:
 
 
 
+
+
+import pytest
+
+class MockIterator:
+  service_description = 'mock resources'
+
+  def __init__(self, n):
+    self.ids = ['i-%i'%i for i in range(n)]
+    self.region_include = ['us-east-1']
+
+  def count(self): return len(self.ids)
+  def get_regionInclude(self): return self.region_include
+  def __iter__(self):
+    for x in self.ids: yield {'Region': 'us-east-1'}, x, None, None
+
+
+@pytest.mark.parametrize("n_workers", [1, 4])
+class TestMainManagerWorkers:
+  def _get_mm(self, n_workers, n_resources):
+    from isitfit.cost.mainManager import MainManager
+    mm = MainManager("test", None)
+    mm.set_workers(n_workers)
+    mm.set_iterator(MockIterator(n_resources))
+    return mm
+
+  def test_orderedReduce(self, n_workers):
+    import time, threading
+    from isitfit.utils import NoCloudtrailException
+    mm = self._get_mm(n_workers, 20)
+
+    def l_map(context_ec2):
+      i = int(context_ec2['ec2_id'][2:])
+      # later resources finish first
+      time.sleep(0.001*(20-i))
+      if i==3: return None # break the chain for this resource
+      if i==5: raise NoCloudtrailException("no cloudtrail")
+      context_ec2['thread'] = threading.get_ident()
+      return context_ec2
+
+    reduced = []
+    def l_reduce(context_ec2):
+      reduced.append(context_ec2['ec2_id'])
+      assert threading.get_ident() == threading.main_thread().ident
+      return context_ec2
+
+    mm.add_listener('ec2', l_map)
+    mm.add_listener('ec2', l_reduce, ordered=True)
+    context_all = mm.get_ifi(lambda it, **kwargs: it)
+
+    assert reduced == ['i-%i'%i for i in range(20) if i not in [3, 5]]
+    assert context_all['ec2_noCloudtrail'] == ['i-5']
+
+  def test_breakIterator(self, n_workers):
+    from isitfit.utils import IsitfitCliRunnerBreakIterator
+    mm = self._get_mm(n_workers, 50)
+
+    mapped = []
+    def l_map(context_ec2):
+      mapped.append(context_ec2['ec2_id'])
+      return context_ec2
+
+    reduced = []
+    def l_reduce(context_ec2):
+      reduced.append(context_ec2['ec2_id'])
+      if len(reduced)==2: raise IsitfitCliRunnerBreakIterator
+      return context_ec2
+
+    mm.add_listener('ec2', l_map)
+    mm.add_listener('ec2', l_reduce, ordered=True)
+    mm.get_ifi(lambda it, **kwargs: it)
+    assert reduced == ['i-0', 'i-1']
+
+    # the number of resources in flight is bounded
+    assert len(mapped) <= 2 + 2*n_workers
+
+
+  def test_progressOnReduce(self, n_workers):
+    mm = self._get_mm(n_workers, 20)
+
+    reduced = []
+    def l_reduce(context_ec2):
+      reduced.append(context_ec2['ec2_id'])
+      return context_ec2
+
+    mm.add_listener('ec2', lambda context_ec2: context_ec2)
+    mm.add_listener('ec2', l_reduce, ordered=True)
+
+    # number of reduced results whenever the progress bar moves
+    progress = []
+    def tqdml2_obj(it, **kwargs):
+      for x in it:
+        progress.append(len(reduced))
+        yield x
+
+    mm.get_ifi(tqdml2_obj)
+    assert progress == list(range(20))
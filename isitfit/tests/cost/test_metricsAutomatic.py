@@ -1,4 +1,6 @@
-from isitfit.cost.metrics_automatic import MetricsAuto
+from isitfit.cost.metrics_automatic import MetricsAuto, MetricsListener
+from isitfit.cost.cacheManager import NegativeCacheEntry
+from isitfit.cost.metrics_datadog import HostNotFoundInDdg
 
 class TestMetricsAuto:
   def test_displayStatus(self):
@@ -10,6 +12,38 @@ class TestMetricsAuto:
     metrics.display_status()
 
 
+class MockMetrics:
+  def __init__(self, missing_ids=[]):
+    self.known_missing = {rc_id: NegativeCacheEntry(HostNotFoundInDdg(), 'datadog') for rc_id in missing_ids}
+    self.prefetched = []
+    self.fetched = []
+
+  def is_configured(self): return True
+  def get_known_missing(self, rc_id): return self.known_missing.get(rc_id, None)
+  def handle_pre(self, context_pre): self.prefetched += [e[1] for e in context_pre['ec2_instances']]
+  def get_metrics_derived(self, rc_describe_entry, rc_id, rc_created):
+    self.fetched.append(rc_id)
+    return 'df %s'%rc_id
+
+
+class TestKnownMissing:
+  def test_tryDatadog(self):
+    datadog = MockMetrics(['i-2'])
+    metrics = MetricsAuto(datadog, MockMetrics())
+    assert metrics._try_datadog('i-1') == ('df i-1', 'ok')
+    assert metrics._try_datadog('i-2') == (None, 'host not found')
+    assert datadog.fetched == ['i-1']
+
+  def test_handlePre(self):
+    datadog, cloudwatch = MockMetrics(['i-2']), MockMetrics()
+    metrics = MetricsListener(datadog, cloudwatch)
+    context_pre = {'ec2_instances': [({}, 'i-1', None, None), ({}, 'i-2', None, None)]}
+    metrics.handle_pre(context_pre)
+    assert datadog.prefetched == ['i-1', 'i-2']
+    assert cloudwatch.prefetched == ['i-2']
+    assert len(context_pre['ec2_instances']) == 2 # unchanged
+
+
 """
   # Tests moved from test_metricsDatadog after its per_ec2 (listener class) was deprecated in favor of the metrics_automatic listener
   # Need to uncomment these tests some day and fix them for running on the metrics_automatic listener
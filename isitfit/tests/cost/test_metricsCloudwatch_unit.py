@@ -1,71 +1,12 @@
 from isitfit.cost.metrics_cloudwatch import CloudwatchAssistant
 
-# Using moto yields "Error during pagination: The same next token was received twice"
-# so doing the mock myself
-# from moto import mock_cloudwatch
-
 import pytest
-@pytest.fixture
-def mock_cloudwatch(mocker):
-  mockee = 'boto3.setup_default_session'
-  mocker.patch(mockee, autospec=True)
-
-  def factory(iterator_dims, response):
-    class Metric:
-      def __init__(self, ndim): self.dimensions = range(ndim)
-      def get_statistics(self, *args, **kwargs): return response
-
-    class Iterator:
-      def filter(self, *args, **kwargs):
-        return [Metric(x) for x in iterator_dims]
-
-    class Resource:
-      metrics = Iterator()
-
-    mockreturn = lambda *args, **kwargs: Resource()
-    mockee = 'boto3.resource'
-    mocker.patch(mockee, side_effect=mockreturn)
-
-  return factory
-
-
-class TestCwAssUnit:
-  # @mock_cloudwatch
-  def test_ok(self, mock_cloudwatch):
-    import datetime as dt
-    dtnow = dt.datetime.now()
-
-    mock_cloudwatch(
-      [3, 1],
-      { 'Datapoints': [
-          {'Timestamp': dtnow, 'SampleCount': 2, 'Maximum': 3, 'Average': 4, 'Minimum': 5}
-        ]
-      }
-    )
-
-    ca = CloudwatchAssistant()
-    ca.set_resource("us-west-2")
-    assert True # no exception
-
-    iid = 'i-1'
-    it = ca.id2iterator(iid, 'AWS/EC2', 'InstanceId')
-    assert it is not None
-
-    me = ca.iterator2metric(it, iid)
-    assert me is not None
-
-    st = ca.metric2stats(me)
-    assert st is not None
-
-    df = ca.stats2df(st, iid, dtnow, 'AWS/EC2')
-    assert df is not None
-    assert df.shape[0] > 0
 
 
 from isitfit.cost.metrics_cloudwatch import CloudwatchEc2, CloudwatchRedshift
 
 
-from isitfit.tests.cost.test_metricsDatadog import cache_man
+from isitfit.tests.cost.test_metricsDatadog_unit import cache_man, get_df_days
 
 @pytest.mark.parametrize("AdapterCls", [CloudwatchEc2, CloudwatchRedshift])
 class TestCloudwatchEc2GetMetricsDerived:
@@ -75,7 +16,7 @@ class TestCloudwatchEc2GetMetricsDerived:
 
     # mock parent
     import pandas as pd
-    mockreturn = lambda *args, **kwargs: pd.DataFrame({'a': [1,2,3]})
+    mockreturn = lambda *args, **kwargs: get_df_days()
     mockee = 'isitfit.cost.metrics_cloudwatch.CloudwatchBase.handle_main'
     uncached_get = mocker.patch(mockee, side_effect=mockreturn)
 
@@ -97,3 +38,281 @@ class TestCloudwatchEc2GetMetricsDerived:
     assert uncached_get.call_count == 1 # no increment
     assert cache_man.get.call_count == 2 # 2nd check in cache
     assert cache_man.set.call_count == 1 # no increment
+
+
+class TestCwIncrementalCache:
+  def _get_cw(self, mocker, cache_man, ndays, df_fetched):
+    cache_man.ready = True
+    cwc = CloudwatchEc2(cache_man)
+    cwc.set_ndays(ndays)
+    spans = []
+    def mockreturn(rc_describe_entry, rc_id, rc_created, span):
+      spans.append(span)
+      if df_fetched is None:
+        from isitfit.utils import NoCloudwatchException
+        raise NoCloudwatchException("no data")
+      return df_fetched[(df_fetched.Timestamp >= span[0]) & (df_fetched.Timestamp <= span[1])]
+
+    mocker.patch.object(cwc, 'handle_main', side_effect=mockreturn)
+    return cwc, spans
+
+  def test_keyWithoutNdays(self, cache_man):
+    assert CloudwatchEc2(cache_man).get_key('i-1') == 'cloudwatch:cpu:i-1'
+
+  def test_fetchMissingDays(self, mocker, cache_man):
+    import datetime as dt
+    today = dt.datetime.utcnow().date()
+
+    # 1st run, 7 days, on a resource with data since 3 days ago
+    cwc, spans = self._get_cw(mocker, cache_man, 7, get_df_days(4))
+    actual = cwc.get_metrics_derived(None, 'i-1', None)
+    assert actual.shape[0] == 4
+    assert spans == [(today - dt.timedelta(days=7), today)]
+
+    # the cached days include the ones without data
+    df_cache = cache_man._map['cloudwatch:cpu:i-1']
+    assert df_cache.shape[0] == 8
+    assert df_cache.cpu_used_max.isna().sum() == 4
+
+    # same day, no fetch
+    cwc, spans = self._get_cw(mocker, cache_man, 7, get_df_days(4))
+    assert cwc.get_metrics_derived(None, 'i-1', None).shape[0] == 4
+    assert spans == []
+
+    # next day, only the latest cached day and today are fetched
+    df_cache = df_cache.copy()
+    df_cache['Timestamp'] = df_cache.Timestamp - dt.timedelta(days=1)
+    cache_man._map['cloudwatch:cpu:i-1'] = df_cache
+    cwc, spans = self._get_cw(mocker, cache_man, 7, get_df_days(5))
+    actual = cwc.get_metrics_derived(None, 'i-1', None)
+    assert spans == [(today - dt.timedelta(days=1), today)]
+    assert actual.shape[0] == 5
+    assert actual.Timestamp.iloc[-1] == today
+    assert cache_man._map['cloudwatch:cpu:i-1'].shape[0] == 9
+
+    # smaller window is served from the cache
+    cwc, spans = self._get_cw(mocker, cache_man, 2, get_df_days(5))
+    assert cwc.get_metrics_derived(None, 'i-1', None).shape[0] == 3
+    assert spans == []
+
+    # larger window only fetches the days before the cached ones
+    cwc, spans = self._get_cw(mocker, cache_man, 30, get_df_days(5))
+    assert cwc.get_metrics_derived(None, 'i-1', None).shape[0] == 5
+    assert spans == [(today - dt.timedelta(days=30), today - dt.timedelta(days=9))]
+
+  def test_growNdays(self, mocker, cache_man):
+    import datetime as dt
+    today = dt.datetime.utcnow().date()
+
+    # 1st run, 7 days, on a resource with data since 19 days ago
+    cwc, spans = self._get_cw(mocker, cache_man, 7, get_df_days(20))
+    assert cwc.get_metrics_derived(None, 'i-1', None).shape[0] == 8
+    assert spans == [(today - dt.timedelta(days=7), today)]
+
+    # next day with 30 days: the days before the cached ones, and the latest cached day with today
+    df_cache = cache_man._map['cloudwatch:cpu:i-1'].copy()
+    df_cache['Timestamp'] = df_cache.Timestamp - dt.timedelta(days=1)
+    cache_man._map['cloudwatch:cpu:i-1'] = df_cache
+    cwc, spans = self._get_cw(mocker, cache_man, 30, get_df_days(20))
+    actual = cwc.get_metrics_derived(None, 'i-1', None)
+    assert spans == [
+      (today - dt.timedelta(days=30), today - dt.timedelta(days=9)),
+      (today - dt.timedelta(days=1), today),
+    ]
+    assert actual.shape[0] == 20
+    assert actual.Timestamp.tolist() == get_df_days(20).Timestamp.tolist()
+
+    # the cache covers the 30 days contiguously
+    df_cache = cache_man._map['cloudwatch:cpu:i-1']
+    assert df_cache.Timestamp.tolist() == [today - dt.timedelta(days=i) for i in range(30, -1, -1)]
+
+    # same day with 30 days, no fetch
+    cwc, spans = self._get_cw(mocker, cache_man, 30, get_df_days(20))
+    assert cwc.get_metrics_derived(None, 'i-1', None).shape[0] == 20
+    assert spans == []
+
+  def test_noDataInMissingDays(self, mocker, cache_man):
+    import datetime as dt
+    today = dt.datetime.utcnow().date()
+
+    # cached until yesterday
+    cwc, spans = self._get_cw(mocker, cache_man, 7, get_df_days(3))
+    cwc.get_metrics_derived(None, 'i-1', None)
+    df_cache = cache_man._map['cloudwatch:cpu:i-1'].copy()
+    df_cache['Timestamp'] = df_cache.Timestamp - dt.timedelta(days=1)
+    cache_man._map['cloudwatch:cpu:i-1'] = df_cache
+
+    # the resource was stopped since: keep the cached days and mark today as fetched
+    cwc, spans = self._get_cw(mocker, cache_man, 7, None)
+    actual = cwc.get_metrics_derived(None, 'i-1', None)
+    assert actual.shape[0] == 3
+    assert cache_man._map['cloudwatch:cpu:i-1'].Timestamp.max() == today
+
+    # 3 days later, no data in the window, and the cached days are too old
+    df_cache = cache_man._map['cloudwatch:cpu:i-1'].copy()
+    df_cache['Timestamp'] = df_cache.Timestamp - dt.timedelta(days=3)
+    cache_man._map['cloudwatch:cpu:i-1'] = df_cache
+    from isitfit.utils import NoCloudwatchException
+    cwc, spans = self._get_cw(mocker, cache_man, 1, None)
+    with pytest.raises(NoCloudwatchException):
+      cwc.get_metrics_derived(None, 'i-1', None)
+    assert spans == [(today - dt.timedelta(days=1), today)]
+
+
+class TestCwMetricData:
+  def _mock_client(self, mocker, calls):
+    import datetime as dt
+    ts_l = [dt.datetime(2020,2,1), dt.datetime(2020,2,2)]
+
+    class Paginator:
+      def paginate(self, MetricDataQueries, **kwargs):
+        calls.append(MetricDataQueries)
+        # return data for all the queries except those of i-nodata
+        results = [{'Id': q['Id'], 'Timestamps': ts_l, 'Values': [1, 2]}
+          for q in MetricDataQueries
+          if q['MetricStat']['Metric']['Dimensions'][0]['Value'] != 'i-nodata'
+        ]
+        # split in 2 pages to check the pagination
+        return [{'MetricDataResults': results[:3], 'NextToken': 'abc'}, {'MetricDataResults': results[3:]}]
+
+    class PaginatorList:
+      def paginate(self, **kwargs):
+        calls.append(kwargs)
+        dims = lambda *v_l: [{'Name': k, 'Value': v} for k, v in zip(['InstanceId', 'NodeID'], v_l)]
+        return [
+          {'Metrics': [{'Dimensions': dims('i-1')}, {'Dimensions': dims('i-1', 'Compute-0')}], 'NextToken': 'abc'},
+          {'Metrics': [{'Dimensions': dims('i-2')}]},
+        ]
+
+    class Client:
+      def get_paginator(self, name):
+        if name == 'list_metrics': return PaginatorList()
+        assert name == 'get_metric_data'
+        return Paginator()
+
+      def get_metric_statistics(self, **kwargs):
+        calls.append(kwargs)
+        return {'Datapoints': [{'Timestamp': ts_l[0], 'SampleCount': 2, 'Maximum': 3, 'Average': 4, 'Minimum': 5}]}
+
+    mockee = 'boto3.session.Session.client'
+    mocker.patch(mockee, return_value=Client())
+
+
+  def test_metricDataBatch(self, mocker):
+    calls = []
+    self._mock_client(mocker, calls)
+
+    ca = CloudwatchAssistant()
+    ca.metricData_maxQueries = 8 # 2 resources per call
+    actual = ca.metricData_batch('us-east-1', ['i-1', 'i-2', 'i-nodata'], 'AWS/EC2', 'InstanceId')
+
+    assert len(calls) == 2
+    assert len(calls[0]) == 8
+    assert len(calls[1]) == 4
+    assert set(actual.keys()) == {'i-1', 'i-2', 'i-nodata'}
+    assert len(actual['i-1']['Datapoints']) == 2
+    assert actual['i-1']['Datapoints'][0]['Maximum'] == 1
+    assert actual['i-2']['Datapoints'][1]['SampleCount'] == 2
+    assert actual['i-nodata']['Datapoints'] == []
+
+    # same dataframe format as with get_statistics
+    df = ca.stats2df(actual['i-1'], 'i-1', None, 'AWS/EC2')
+    assert df.shape[0] == 2
+    assert set(['cpu_used_max', 'cpu_used_avg', 'cpu_used_min', 'nhours']).issubset(df.columns)
+
+    from isitfit.utils import NoCloudwatchException
+    with pytest.raises(NoCloudwatchException):
+      ca.stats2df(actual['i-nodata'], 'i-nodata', None, 'AWS/EC2')
+
+
+  def test_handlePre(self, mocker):
+    calls = []
+    self._mock_client(mocker, calls)
+
+    cw = CloudwatchEc2(None)
+    ec2_instances = [
+      ({'Region': 'us-east-1'}, 'i-1', None, None),
+      ({'Region': 'us-west-2'}, 'i-2', None, None),
+    ]
+    cw.handle_pre({'ec2_instances': ec2_instances})
+    assert len(calls) == 4 # 1 ListMetrics and 1 GetMetricData per region
+    assert set(cw.prefetched.keys()) == {'i-1', 'i-2'}
+
+    # handle_main uses the prefetched data instead of the per-resource calls
+    df = cw.handle_main({'Region': 'us-east-1'}, 'i-1', None)
+    assert df.shape[0] == 2
+    assert len(calls) == 4
+    assert 'i-1' not in cw.prefetched
+
+
+  def test_metricIndex(self, mocker):
+    calls = []
+    self._mock_client(mocker, calls)
+
+    ca = CloudwatchAssistant()
+    actual = ca.metricIndex_get('us-east-1', 'AWS/EC2', 'InstanceId')
+    assert set(actual.keys()) == {'i-1', 'i-2'} # skips the metric with 2 dimensions
+    assert actual['i-1'] == [{'Name': 'InstanceId', 'Value': 'i-1'}]
+
+    # 2nd call is from memory
+    ca.metricIndex_get('us-east-1', 'AWS/EC2', 'InstanceId')
+    assert len(calls) == 1
+
+    # resource without metrics raises without network calls
+    from isitfit.utils import NoCloudwatchException
+    with pytest.raises(NoCloudwatchException):
+      ca.id2dimensions('us-east-1', 'i-nodata', 'AWS/EC2', 'InstanceId')
+    assert len(calls) == 1
+
+
+  def test_handleMain_noPrefetch(self, mocker):
+    calls = []
+    self._mock_client(mocker, calls)
+
+    cw = CloudwatchEc2(None)
+    df = cw.handle_main({'Region': 'us-east-1'}, 'i-2', None)
+    assert df.shape[0] == 1
+    assert len(calls) == 2 # ListMetrics + GetMetricStatistics
+    assert calls[1]['Dimensions'] == [{'Name': 'InstanceId', 'Value': 'i-2'}]
+
+    from isitfit.utils import NoCloudwatchException
+    with pytest.raises(NoCloudwatchException):
+      cw.handle_main({'Region': 'us-east-1'}, 'i-nodata', None)
+    assert len(calls) == 2 # no more calls
+
+
+  def test_bucket(self, mocker):
+    calls = []
+    self._mock_client(mocker, calls)
+
+    from isitfit.tests.cost.test_cloudtrail_iterator_unit import MockBucket
+    cw = CloudwatchEc2(None)
+    cw.set_bucket(MockBucket())
+    cw.assistant.metricData_maxQueries = 8 # 2 resources per call
+    ec2_instances = [({'Region': 'us-east-1'}, rc_id, None, None) for rc_id in ['i-1', 'i-2']]
+    cw.handle_pre({'ec2_instances': ec2_instances})
+
+    # 1 token per page: 2 pages of ListMetrics and 2 pages of GetMetricData
+    assert cw.assistant.bucket.n == 4
+
+    # 1 token per GetMetricStatistics
+    import datetime as dt
+    cw.handle_main({'Region': 'us-east-1'}, 'i-2', None, (dt.date(2020,1,1), dt.date(2020,1,2)))
+    assert cw.assistant.bucket.n == 5
+
+
+  def test_metricIndex_threads(self, mocker):
+    ca = CloudwatchAssistant()
+    def mockreturn(*args):
+      import time
+      time.sleep(0.1)
+      return {'i-1': []}
+    build = mocker.patch.object(ca, '_metricIndex_build', side_effect=mockreturn)
+
+    # concurrent misses of the same key list the metrics once
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=4) as executor:
+      actual = list(executor.map(lambda x: ca.metricIndex_get('us-east-1', 'AWS/EC2', 'InstanceId'), range(4)))
+
+    assert build.call_count == 1
+    assert actual == [{'i-1': []}]*4
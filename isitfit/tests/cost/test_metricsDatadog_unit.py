@@ -157,6 +157,18 @@ class TestDatadogManager:
 
 
 
+def get_df_days(n_days=3):
+    """
+    Dataframe of daily metrics of the latest days, as returned by get_metrics_all / handle_main
+    """
+    import datetime as dt
+    d_end = dt.datetime.utcnow().date()
+    return pd.DataFrame({
+      'Timestamp': [d_end - dt.timedelta(days=i) for i in range(n_days)][::-1],
+      'cpu_used_max': [10.0]*n_days,
+    })
+
+
 @pytest.fixture
 def cache_man(mocker):
     """
@@ -169,7 +181,7 @@ def cache_man(mocker):
 
       def isReady(self): return self.ready
       def get(self, key): return self._map.get(key)
-      def set(self, key, val): self._map[key] = val
+      def set(self, key, val, ex=None): self._map[key] = val
 
     cache_man = MockCacheMan()
     mocker.spy(cache_man, 'get')
@@ -206,7 +218,7 @@ class TestDatadogCachedGetMetricsDerived:
 
   def test_notReady_yesData(self, mocker, cache_man):
     # mock parent
-    mockreturn = lambda *args, **kwargs: pd.DataFrame({'a': [1,2,3]})
+    mockreturn = lambda *args, **kwargs: get_df_days()
     mockee = 'isitfit.cost.metrics_datadog.DatadogManager.get_metrics_all'
     mocker.patch(mockee, side_effect=mockreturn)
 
@@ -245,10 +257,43 @@ class TestDatadogCachedGetMetricsDerived:
     with pytest.raises(DataNotFoundForHostInDdg):
       actual = ddc.get_metrics_derived(None, host_id, None)
 
-    assert cache_man.get.call_count == 2 # incremented
+    assert cache_man.get.call_count == 1 # no increment, known to be missing
     assert cache_man.set.call_count == 1 # no increment
     assert callable(cache_man._map[ddc.get_key(host_id)])
 
+    # in another process, it is found in the cache
+    ddc = DatadogCached(cache_man)
+    with pytest.raises(DataNotFoundForHostInDdg):
+      actual = ddc.get_metrics_derived(None, host_id, None)
+
+    assert cache_man.get.call_count == 2 # incremented
+    assert cache_man.set.call_count == 1 # no increment
+
+
+  def test_yesReady_negativeTtl(self, mocker, cache_man):
+    cache_man.ready = True
+    def mockreturn(*args, **kwargs): raise HostNotFoundInDdg("not found")
+    uncached_get = mocker.patch('isitfit.cost.metrics_datadog.DatadogManager.get_metrics_all', side_effect=mockreturn)
+
+    from isitfit.cost.cacheManager import NEGATIVE_TTL_MIN, NEGATIVE_TTL_MAX
+    host_id = 'i-123456'
+    ttl_l = []
+    for i in range(10):
+      # each run is a new process, and the entry of the previous run expired
+      ddc = DatadogCached(cache_man)
+      with pytest.raises(HostNotFoundInDdg):
+        ddc.get_metrics_derived(None, host_id, None)
+
+      entry = cache_man._map[ddc.get_key(host_id)]
+      ttl_l.append(entry.ttl)
+      entry.expires_at = 0
+
+    assert uncached_get.call_count == 10
+    assert (entry.reason, entry.source, entry.miss_count) == ('HostNotFoundInDdg', 'datadog', 10)
+    assert ttl_l[:3] == [NEGATIVE_TTL_MIN, NEGATIVE_TTL_MIN*2, NEGATIVE_TTL_MIN*4]
+    assert ttl_l[-1] == NEGATIVE_TTL_MAX
+    assert ddc.get_known_missing(host_id) is None # expired
+
 
   def test_yesReady_invalidCache(self, mocker, cache_man):
     # enable mocked cache
@@ -269,7 +314,7 @@ class TestDatadogCachedGetMetricsDerived:
     cache_man.ready = True
 
     # mock parent
-    mockreturn = lambda *args, **kwargs: pd.DataFrame({'a': [1,2,3]})
+    mockreturn = lambda *args, **kwargs: get_df_days()
     mockee = 'isitfit.cost.metrics_datadog.DatadogManager.get_metrics_all'
     uncached_get = mocker.patch(mockee, side_effect=mockreturn)
 
@@ -291,3 +336,231 @@ class TestDatadogCachedGetMetricsDerived:
     assert uncached_get.call_count == 1 # no increment
     assert cache_man.get.call_count == 2 # 2nd check in cache
     assert cache_man.set.call_count == 1 # no increment
+
+
+class TestDatadogManagerPrefetch:
+  def test_prefetchMetrics(self, datadog_manager, mocker):
+      host_list = [
+        {'aws_id': 'i-1', 'name': 'host-1', 'meta': {'gohai': '{"memory": {"total": "10kB"}}', 'cpuCores': 2}},
+        {'aws_id': 'i-2', 'name': 'host-2', 'meta': {'gohai': '{"memory": {"total": "10kB"}}', 'cpuCores': 2}},
+        {'aws_id': 'i-3', 'name': 'host-3', 'meta': {'gohai': '{"memory": {"total": "10kB"}}', 'cpuCores': 2}},
+      ]
+      def mockreturn(*args, filter=None, **kwargs):
+        if filter is None: return {'host_list': host_list}
+        h_l = [x for x in host_list if 'host:%s'%x['name']==filter]
+        return {'total_returned': len(h_l), 'host_list': h_l}
+      mocker.patch('datadog.api.Hosts.search', side_effect=mockreturn)
+
+      # grouped query returns 1 series per host in the scope, but no memory for host-3
+      queries = []
+      def mockreturn(start, end, query):
+        queries.append(query)
+        metric_name = 'count_not_null(system.mem.free)' if query.startswith('count_not_null') else query.split('{')[0]
+        series = [
+          {'metric': metric_name, 'scope': 'host:%s'%h, 'tag_set': ['host:%s'%h], 'pointlist': [[1580515200000, 5120], [1580601600000, 4]]}
+          for h in ['host-1', 'host-2', 'host-3']
+          if 'host:%s'%h in query and not (h=='host-3' and 'mem' in query)
+        ]
+        return {'status': 'ok', 'series': series}
+      mocker.patch('datadog.api.Metric.query', side_effect=mockreturn)
+
+      import datetime as dt
+      ddm = datadog_manager()
+      ddm.prefetch_hostsPerQuery = 2
+      span = (dt.date(2020,2,1), dt.date(2020,2,2))
+      ddm.prefetch_metrics([(aws_id, span) for aws_id in ['i-1', 'i-2', 'i-3', 'i-notInDdg']])
+
+      # 7 metrics x 2 chunks of hosts, each limited to the hosts of the chunk
+      assert len(queries) == 14
+      assert queries[:7] == [
+        'system.cpu.idle{host:host-1 OR host:host-2} by {host}.rollup(min,86400)',
+        'system.cpu.idle{host:host-1 OR host:host-2} by {host}.rollup(max,86400)',
+        'system.cpu.idle{host:host-1 OR host:host-2} by {host}.rollup(avg,86400)',
+        'system.mem.free{host:host-1 OR host:host-2} by {host}.rollup(min,86400)',
+        'system.mem.free{host:host-1 OR host:host-2} by {host}.rollup(max,86400)',
+        'system.mem.free{host:host-1 OR host:host-2} by {host}.rollup(avg,86400)',
+        'count_not_null(system.mem.free{host:host-1 OR host:host-2} by {host})',
+      ]
+      assert queries[7] == 'system.cpu.idle{host:host-3} by {host}.rollup(min,86400)'
+      assert set(ddm.prefetched.keys()) == {'i-1', 'i-2', 'i-3'}
+
+      # same columns as the per-host get_metrics_all
+      actual = ddm.get_metrics_all('i-1', span)
+      assert list(actual.columns) == ['Timestamp', 'cpu_used_max', 'cpu_used_min', 'cpu_used_avg', 'ram_used_max', 'ram_used_min', 'ram_used_avg', 'nhours']
+      assert actual.shape[0] == 2
+      assert actual.ram_used_max.iloc[0] == 50
+      assert 'i-1' not in ddm.prefetched
+      n_queries = len(queries)
+
+      with pytest.raises(DataNotFoundForHostInDdg):
+        ddm.get_metrics_all('i-3', span)
+
+      with pytest.raises(HostNotFoundInDdg):
+        ddm.get_metrics_all('i-notInDdg')
+
+      # no further queries
+      assert len(queries) == n_queries
+
+  def test_handlePre_hostMetaMissing(self, datadog_manager, mocker):
+      # host-2 is duplicated in datadog, so its memory total cannot be looked up
+      host_list = [
+        {'aws_id': 'i-1', 'name': 'host-1', 'meta': {}},
+        {'aws_id': 'i-2', 'name': 'host-2', 'meta': {}},
+      ]
+      def mockreturn(*args, filter=None, **kwargs):
+        if filter is None: return {'host_list': host_list}
+        h_l = [x for x in host_list if 'host:%s'%x['name']==filter]
+        if filter=='host:host-2': h_l = h_l*2
+        h_l = [dict(x, meta={'gohai': '{"memory": {"total": "10kB"}}', 'cpuCores': 2}) for x in h_l]
+        return {'total_returned': len(h_l), 'host_list': h_l}
+      search = mocker.patch('datadog.api.Hosts.search', side_effect=mockreturn)
+
+      # a point at the start of the queried window
+      def mockreturn(start, end, query):
+        metric_name = 'count_not_null(system.mem.free)' if query.startswith('count_not_null') else query.split('{')[0]
+        series = [
+          {'metric': metric_name, 'scope': 'host:%s'%h, 'tag_set': ['host:%s'%h], 'pointlist': [[start*1000, 5120]]}
+          for h in ['host-1', 'host-2']
+        ]
+        return {'status': 'ok', 'series': series}
+      mocker.patch('datadog.api.Metric.query', side_effect=mockreturn)
+
+      from isitfit.tests.cost.test_cloudtrail_iterator_unit import MockBucket
+      ddm = datadog_manager()
+      ddm.set_bucket(MockBucket())
+      ddm.handle_pre({'ec2_instances': [(None, 'i-1', None, None), (None, 'i-2', None, None)]})
+
+      # 1 map + 1 memory lookup per host, instead of 1 per ram metric
+      assert search.call_count == 3
+
+      # 1 token per API call: the host searches and the 7 grouped queries
+      assert ddm.bucket.n == 3 + 7
+
+      # only the host with the missing metadata fails, with the same exception as the per-host queries
+      assert ddm.get_metrics_all('i-1').shape[0] == 1
+      with pytest.raises(HostNotFoundInDdg):
+        ddm.get_metrics_all('i-2')
+
+  def test_prefetchMetrics_spans(self, datadog_manager, mocker):
+      host_list = [{'aws_id': 'i-%i'%i, 'name': 'host-%i'%i, 'meta': {'gohai': '{"memory": {"total": "10kB"}}', 'cpuCores': 2}} for i in [1, 2]]
+      mocker.patch('datadog.api.Hosts.search', side_effect=lambda *args, **kwargs: {'host_list': host_list})
+
+      # 3 days of data for each host
+      queries = []
+      def mockreturn(start, end, query):
+        queries.append((start, end, query))
+        metric_name = 'count_not_null(system.mem.free)' if query.startswith('count_not_null') else query.split('{')[0]
+        pointlist = [[1580515200000 + i*86400000, 5120] for i in range(3)]
+        series = [{'metric': metric_name, 'scope': 'host:%s'%h['name'], 'tag_set': ['host:%s'%h['name']], 'pointlist': pointlist} for h in host_list]
+        return {'status': 'ok', 'series': series}
+      mocker.patch('datadog.api.Metric.query', side_effect=mockreturn)
+
+      # hosts with different missing spans, eg i-1 only needs the latest day,
+      # and i-2 needs the days before and after its cached days
+      import datetime as dt
+      span_1 = (dt.date(2020,2,3), dt.date(2020,2,3))
+      span_2 = (dt.date(2020,2,1), dt.date(2020,2,1))
+      span_3 = (dt.date(2020,2,3), dt.date(2020,2,3))
+      ddm = datadog_manager()
+      ddm.prefetch_metrics([('i-1', span_1), ('i-2', span_2), ('i-2', span_3)])
+
+      # a single grouped query per metric, over the union of the spans
+      assert len(queries) == 7
+      assert queries[0][:2] == ddm.span2epoch((dt.date(2020,2,1), dt.date(2020,2,3)))
+
+      # each host sliced to its own span
+      assert ddm.get_metrics_all('i-1', span_1).Timestamp.tolist() == [dt.date(2020,2,3)]
+      assert ddm.get_metrics_all('i-2', span_2).Timestamp.tolist() == [dt.date(2020,2,1)]
+      assert 'i-2' in ddm.prefetched
+      assert ddm.get_metrics_all('i-2', span_3).Timestamp.tolist() == [dt.date(2020,2,3)]
+      assert 'i-2' not in ddm.prefetched
+      assert len(queries) == 7
+
+
+class TestHostMetaStore:
+  def test_fillGet(self, mocker):
+      from isitfit.cost.metrics_datadog import HostMetaStore, DatadogApiWrap
+      host_list = [
+        {'aws_id': 'i-1', 'name': 'host-1', 'meta': {'gohai': '{"memory": {"total": "10kB"}}', 'cpuCores': 2}},
+        {'aws_id': 'i-2', 'name': 'host-2', 'meta': {}}, # no gohai
+      ]
+      def mockreturn(*args, filter=None, **kwargs):
+        if filter is None: return {'host_list': host_list}
+        return {'total_returned': 0, 'host_list': []}
+      search = mocker.patch('datadog.api.Hosts.search', side_effect=mockreturn)
+
+      apiwrap = DatadogApiWrap()
+      hms = HostMetaStore()
+      assert apiwrap.map_aws_datadog(hms) == {'i-1': 'host-1', 'i-2': 'host-2'}
+      assert search.call_count == 1
+
+      # from the bulk host list, multiple assistants
+      for i in range(3):
+        dda = DatadogAssistant(0, 1, 'host-1', hms)
+        assert dda._get_meta() == {'cpuCores': 2, 'memory_total': 10240}
+
+      assert search.call_count == 1
+
+      # miss falls back to the single-host search, memoized
+      for i in range(3):
+        with pytest.raises(HostNotFoundInDdg):
+          hms.get('host-2', apiwrap)
+
+      assert search.call_count == 2
+
+
+class TestDatadogHostsPaginated:
+  def _mock_search(self, mocker, n_hosts):
+      host_all = [{'aws_id': 'i-%i'%i, 'name': 'host-%i'%i} for i in range(n_hosts)]
+      calls = []
+      def mockreturn(start, count, **kwargs):
+        calls.append(dict(start=start, count=count, **kwargs))
+        host_list = host_all[start:(start+count)]
+        return {'total_matching': len(host_all), 'total_returned': len(host_list), 'host_list': host_list}
+
+      mocker.patch('datadog.api.Hosts.search', side_effect=mockreturn)
+      return calls
+
+  def test_mapAwsDatadog(self, mocker):
+      calls = self._mock_search(mocker, 5)
+
+      from isitfit.cost.metrics_datadog import DatadogApiWrap
+      apiwrap = DatadogApiWrap()
+      apiwrap.hosts_pageSize = 2
+      apiwrap.hosts_maxWorkers = 2
+      actual = apiwrap.map_aws_datadog()
+      assert actual == {'i-%i'%i: 'host-%i'%i for i in range(5)}
+      assert sorted([x['start'] for x in calls]) == [0, 2, 4]
+
+  def test_buildMap_cached(self, mocker, monkeypatch, tmpdir, datadog_manager):
+      monkeypatch.setenv("ISITFIT_DATADOG_INDEX_TTL", "3600")
+      mocker.patch('isitfit.dotMan.DotMan.tempdir', return_value=str(tmpdir))
+      calls = self._mock_search(mocker, 3)
+
+      # 1st run downloads the full map
+      ddm = datadog_manager()
+      ddm.build_map_aws_dd()
+      assert len(ddm.map_aws_dd) == 3
+      assert len(calls) == 1
+      # no leftover temporary file
+      fn_l = [x.basename for x in tmpdir.listdir()]
+      assert len(fn_l) == 1
+      assert fn_l[0].endswith('.json')
+
+      # 2nd run within the TTL uses the local file without any API call
+      calls = self._mock_search(mocker, 1)
+      ddm = datadog_manager()
+      ddm.build_map_aws_dd()
+      assert len(ddm.map_aws_dd) == 3
+      assert len(calls) == 0
+
+      # expired index is downloaded again
+      import json
+      fn = tmpdir.listdir()[0]
+      cached = json.loads(fn.read())
+      cached['dt_saved'] -= 3601
+      fn.write(json.dumps(cached))
+      ddm = datadog_manager()
+      ddm.build_map_aws_dd()
+      assert len(ddm.map_aws_dd) == 1
+      assert len(calls) == 1
@@ -38,27 +38,37 @@ def mergeSeriesOnTimestampRange(df_cpu, df_type, fields):
   if df_type.iloc[0].name < df_type.iloc[-1].name:
     raise Exception("Types Dataframe should be sorted descending for utils.mergeSeriesOnTimestampRange")
 
+  # Update 2020-02 the index of df_type is the EventTime
+  return mergeHistoryOnTimestampRange(df_cpu, df_type.index, {f: df_type[f].array for f in fields})
+
+
+def mergeHistoryOnTimestampRange(df_cpu, event_time, field_d):
+  """
+  Update 2020-02 Same as mergeSeriesOnTimestampRange, with the type history as arrays instead of a dataframe,
+  eg the arrays of CloudtrailCached.index_history, so that no dataframe is built per resource
+  event_time - array of EventTime, sorted descending
+  field_d - dict: field name to set in df_cpu -> array of values, aligned with event_time
+  """
   import numpy as np
 
-  for f in fields:
+  for f in field_d.keys():
     df_cpu[f] = None
 
-  # assume df_type is sorted in decreasing EventTime order (very important)
+  # assume event_time is sorted in decreasing order (very important)
   # NB: since some instances are not present in the cloudtrail (for which we append artificially the "now" type)
-  #     Need to traverse the df_type matrix backwards
-  for index, row_type in df_type.iterrows():
-    row_i = np.where(df_cpu.Timestamp <= row_type.name)[0]
-    for f in fields:
-      # use row_type.name instead of row_type['EventTime']
+  #     Need to traverse the history backwards
+  for i_type, t_type in enumerate(event_time):
+    row_i = np.where(df_cpu.Timestamp <= t_type)[0]
+    for f, values in field_d.items():
       # check note above about needing to traverse backwards
       # df_cpu.iloc[np.where(df_cpu.Timestamp >= row_type.name)[0], df_cpu.columns.get_loc('instanceType')] = row_type['instanceType']
       col_i = df_cpu.columns.get_loc(f)
-      df_cpu.iloc[row_i, col_i] = row_type[f]
+      df_cpu.iloc[row_i, col_i] = values[i_type]
 
   # fill na at beginning with back-fill
   # (artifact of cloudwatch having data at days before the creation of the instance)
-  for f in fields:
-    df_cpu[f] = df_cpu[f].fillna(method='backfill')
+  for f in field_d.keys():
+    df_cpu[f] = df_cpu[f].bfill()
 
   return df_cpu
 
@@ -507,3 +517,62 @@ def decolorize(value_colored):
     value_nocolor = putty_escape.sub('', value_nocolor)
 
     return value_nocolor
+
+
+
+class TokenBucket:
+    """
+    Update 2020-02 Rate limiter shared between threads, eg to keep the AWS/Datadog API calls of `isitfit cache warm` under a budget.
+    Tokens are refilled at `rate` per second, up to `capacity`, and acquire blocks until a token is available.
+    A rate of 0 or None disables the limit
+    """
+    def __init__(self, rate, capacity=None, parent=None):
+      """
+      parent - TokenBucket to acquire from as well (optional), eg the budget of `isitfit cache warm` on top of the cloudtrail rate limit
+      """
+      import threading
+      import time
+      self.rate = rate
+      self.capacity = capacity if capacity is not None else max(1, rate or 1)
+      self.tokens = self.capacity
+      self.dt_last = time.monotonic()
+      self.lock = threading.Lock()
+      self.parent = parent
+
+    def acquire(self, n=1):
+      if self.parent is not None:
+        self.parent.acquire(n)
+
+      if not self.rate:
+        return
+
+      import time
+      while True:
+        with self.lock:
+          dt_now = time.monotonic()
+          self.tokens = min(self.capacity, self.tokens + (dt_now - self.dt_last)*self.rate)
+          self.dt_last = dt_now
+          if self.tokens >= n:
+            self.tokens -= n
+            return
+
+          dt_wait = (n - self.tokens)/self.rate
+
+        time.sleep(dt_wait)
+
+
+def rate_limited_pages(page_iter, bucket):
+    """
+    Update 2020-02 Acquire a token of the TokenBucket before each page of a paginated API call is requested,
+    i.e. before the first page and after each page with a NextToken.
+    bucket - TokenBucket, or None for no limit
+    """
+    if bucket is None:
+      yield from page_iter
+      return
+
+    bucket.acquire()
+    for page in page_iter:
+      yield page
+      if 'NextToken' in page:
+        bucket.acquire()
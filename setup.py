@@ -59,6 +59,11 @@ setup(
         # for issue10 command
         'pytest==5.2.1'
     ],
+    # Update 2020-02 optional compression of the cached values, check isitfit/cost/cacheSerializer.py
+    extras_require={
+        'compression': ['zstandard==0.13.0', 'lz4==3.0.2'],
+        'speedups': ['orjson==2.4.0'],
+    },
     entry_points='''
         [console_scripts]
         isitfit=isitfit.cli.core:cli_core